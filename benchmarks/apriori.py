@@ -0,0 +1,78 @@
+from benchmarks.timing import measure
+from elasticsearch.helpers import scan
+from elasticsearch_dsl import Search
+from examples.apriori.demo import SCRIPTED_METRICS
+from examples.apriori.generator import Generator
+from examples.apriori.reference import encode_fields, frequent_sets
+import itertools
+import utils.read_scripted_metric as read_scripted_metric
+
+def run(generator: Generator,
+        results,
+        number_docs: int = 35000,
+        min_supports: list = [0.1],
+        max_set_sizes: list = [4],
+        number_shards: int = 1,
+        repeat: int = 3,
+        processes: int = 1,
+        seed: int = 0):
+    '''
+    Benchmark generating, indexing and finding the frequent item sets of the demo
+    data set.
+
+    @param generator The apriori Generator whose client is benchmarked.
+    @param results The Results to which to add the measurements.
+    @param number_docs The number of documents to generate.
+    @param min_supports The minimum supports of a frequent item set to benchmark.
+    @param max_set_sizes The largest frequent item sets to find to benchmark.
+    @param number_shards The number of primary shards of the index.
+    @param repeat The number of times to repeat each search.
+    @param processes The number of processes for the reference implementation.
+    '''
+    parameters = {'number_docs': number_docs, 'number_shards': number_shards}
+
+    batches, timing = measure(lambda: list(generator.demo_data_batches(number_docs, seed)), repeat=1)
+    number_docs = sum(len(batch) for batch in batches)
+    results.add('apriori', 'generate', parameters,
+                docs_per_second=number_docs / timing['min_seconds'], **timing)
+
+    generator.recreate_index(number_shards=number_shards)
+    stats = generator.bulk_indexer.index_serialized(batches, index=Generator.INDEX_NAME, number_docs=number_docs)
+    results.add('apriori', 'index', parameters, **stats.to_dict())
+    del batches
+
+    es = generator.es_client()
+    body = read_scripted_metric.read(SCRIPTED_METRICS['strings'])
+    fields = body['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']['params']['fields']
+    def read_columns():
+        columns = [[] for _ in fields]
+        for hit in scan(es, index=Generator.INDEX_NAME, query={'_source': fields}):
+            for column, field in zip(columns, fields):
+                column.append(hit['_source'].get(field))
+        return encode_fields(columns)
+    (items, matrix, weights), timing = measure(read_columns, repeat=1)
+    results.add('apriori', 'reference_read_columns', parameters, **timing)
+
+    # The sampler is made large enough to include every document so the searches
+    # and the reference implementation do the same work.
+    for min_support, max_set_size in itertools.product(min_supports, max_set_sizes):
+        search_parameters = dict(parameters, min_support=min_support, max_set_size=max_set_size)
+        params = {'min_support': min_support, 'max_set_size': max_set_size}
+        for variant, file_name in SCRIPTED_METRICS.items():
+            template = read_scripted_metric.template(file_name)
+            template.register(es)
+            body = template.request(params)
+            body['aggs']['random_sample']['sampler']['shard_size'] = number_docs
+
+            took = []
+            def search():
+                took.append(Search.from_dict(body).using(es).index(Generator.INDEX_NAME).execute().took)
+            _, timing = measure(search, repeat=repeat)
+            results.add('apriori', 'scripted_metric_' + variant, search_parameters,
+                        took_millis=took, min_took_millis=min(took), **timing)
+
+        _, timing = measure(lambda: frequent_sets(items, matrix, weights,
+                                                  min_support=min_support,
+                                                  max_set_size=max_set_size,
+                                                  processes=processes), repeat=repeat)
+        results.add('apriori', 'reference', dict(search_parameters, processes=processes), **timing)
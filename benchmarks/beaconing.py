@@ -0,0 +1,85 @@
+from benchmarks.timing import measure
+from elasticsearch_dsl import Search
+from examples.beaconing.demo import SCRIPTED_METRICS
+from examples.beaconing.generator import Generator
+from examples.beaconing.rolling import RollingWindow
+import utils.read_scripted_metric as read_scripted_metric
+
+def run(generator: Generator,
+        results,
+        number_tags: int = 100,
+        number_docs_per_tag: int = 1000,
+        bucket_seconds: list = [60],
+        window_hours: int = 6,
+        number_shards: int = 1,
+        repeat: int = 3,
+        processes: int = 1,
+        seed: int = 0):
+    '''
+    Benchmark generating, indexing and detecting beacons in a mixture of beaconing
+    and Poisson process tags.
+
+    @param generator The beaconing Generator whose client is benchmarked.
+    @param results The Results to which to add the measurements.
+    @param number_tags The number of tags, half of which are beacons.
+    @param number_docs_per_tag The number of documents for each tag.
+    @param bucket_seconds The lengths of the time buckets to benchmark.
+    @param window_hours The length of the time window which is searched.
+    @param number_shards The number of primary shards of the index.
+    @param repeat The number of times to repeat each search.
+    @param processes The number of processes for the reference implementation.
+    '''
+    parameters = {
+        'number_tags': number_tags,
+        'number_docs_per_tag': number_docs_per_tag,
+        'window_hours': window_hours,
+        'number_shards': number_shards
+    }
+    number_beacons = number_tags // 2
+    number_docs = number_tags * number_docs_per_tag
+
+    def generate():
+        return list(generator.many_tags_batches(number_beacons, number_tags - number_beacons,
+                                                number_docs_per_tag, seed))
+    batches, timing = measure(generate, repeat=1)
+    results.add('beaconing', 'generate', parameters,
+                docs_per_second=number_docs / timing['min_seconds'], **timing)
+
+    generator.recreate_index(number_shards=number_shards)
+    stats = generator.bulk_indexer.index_serialized(batches, index=Generator.INDEX_NAME, number_docs=number_docs)
+    results.add('beaconing', 'index', parameters, **stats.to_dict())
+    del batches
+
+    es = generator.es_client()
+    for bucket_length in bucket_seconds:
+        search_parameters = dict(parameters, bucket_seconds=bucket_length)
+
+        # Override the window and bucket length of the request.
+        number_buckets = window_hours * 3600 // bucket_length
+        params = {
+            'range_start_millis': Generator.START_TIME // 1000,
+            'number_buckets_in_range': number_buckets,
+            'time_bucket_length': bucket_length
+        }
+        for variant, file_name in SCRIPTED_METRICS.items():
+            template = read_scripted_metric.template(file_name)
+            template.register(es)
+            body = template.request(params)
+            body['query']['range']['@timestamp'] = {
+                'gte': Generator.START_TIME,
+                'lt': Generator.START_TIME + window_hours * 3600 * 1000
+            }
+            body['aggs']['process']['terms']['size'] = number_tags
+
+            took = []
+            def search():
+                took.append(Search.from_dict(body).using(es).index(Generator.INDEX_NAME).execute().took)
+            _, timing = measure(search, repeat=repeat)
+            results.add('beaconing', 'scripted_metric_' + variant, search_parameters,
+                        took_millis=took, min_took_millis=min(took), **timing)
+
+        window = RollingWindow(es, number_buckets=number_buckets, bucket_millis=bucket_length * 1000)
+        _, timing = measure(lambda: window.update(Generator.START_TIME + window_hours * 3600 * 1000), repeat=1)
+        results.add('beaconing', 'reference_read_counts', search_parameters, **timing)
+        _, timing = measure(lambda: window.statistics(processes=processes), repeat=repeat)
+        results.add('beaconing', 'reference', dict(search_parameters, processes=processes), **timing)
@@ -0,0 +1,58 @@
+'''
+Compare two benchmark result files written by benchmarks.run, for example
+
+python -m benchmarks.compare baseline.json results.json
+
+Measurements are matched by benchmark, stage and parameters. For each match this
+prints the ratio of the new to the baseline median time, so values less than one
+are speedups.
+'''
+import argparse
+import json
+
+def compare(baseline: dict, results: dict):
+    '''
+    Match up the measurements of two benchmark runs.
+
+    @return A list of (benchmark, stage, parameters, baseline seconds, seconds) for
+    each measurement in both runs.
+    '''
+    def key(measurement):
+        return (measurement['benchmark'],
+                measurement['stage'],
+                json.dumps(measurement['parameters'], sort_keys=True))
+
+    baseline = {key(measurement): measurement for measurement in baseline['measurements']}
+    comparison = []
+    for measurement in results['measurements']:
+        expected = baseline.get(key(measurement))
+        if expected is None or _seconds(expected) is None or _seconds(measurement) is None:
+            continue
+        comparison.append((measurement['benchmark'],
+                           measurement['stage'],
+                           measurement['parameters'],
+                           _seconds(expected),
+                           _seconds(measurement)))
+    return comparison
+
+def _seconds(measurement: dict):
+    return measurement.get('median_seconds', measurement.get('seconds'))
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('baseline')
+    parser.add_argument('results')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.results) as file:
+        results = json.load(file)
+
+    for benchmark, stage, parameters, baseline_seconds, seconds in compare(baseline, results):
+        ratio = seconds / baseline_seconds if baseline_seconds > 0 else float('inf')
+        print('{:10} {:32} {:8.3f}s -> {:8.3f}s ({:.2f}x) {}'.format(
+            benchmark, stage, baseline_seconds, seconds, ratio, parameters))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''
+Run the benchmarks for a grid of data scales and write the results as JSON, for
+example
+
+python -m benchmarks.run --number-tags 100 1000 --bucket-seconds 60 10 --output results.json
+
+Each combination of the data parameters generates and indexes a new data set, so
+the indices of the examples are overwritten. Pass --simulate to run against an
+in-process SimulatedElasticsearch rather than a cluster.
+'''
+from benchmarks import apriori, beaconing
+from benchmarks.timing import Results
+from examples.apriori.generator import Generator as AprioriGenerator
+from examples.beaconing.generator import Generator as BeaconingGenerator
+from utils.simulator import SimulatedElasticsearch
+import argparse
+import itertools
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Benchmark the painless data science examples.')
+    parser.add_argument('--user-name', default='')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--simulate', action='store_true',
+                        help='Use an in-process simulated cluster.')
+    parser.add_argument('--simulator-processes', type=int, default=1,
+                        help='The number of processes the simulated cluster uses to search shards.')
+    parser.add_argument('--examples', nargs='+', default=['beaconing', 'apriori'],
+                        choices=['beaconing', 'apriori'])
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='The file to which to write the results.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='The number of times to repeat each search and reference run.')
+    parser.add_argument('--thread-count', type=int, default=4,
+                        help='The number of threads used to index documents.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='The number of processes used by the reference implementations.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--number-shards', type=int, nargs='+', default=[1])
+    parser.add_argument('--number-tags', type=int, nargs='+', default=[100],
+                        help='The number of beaconing example tags.')
+    parser.add_argument('--number-docs-per-tag', type=int, nargs='+', default=[1000],
+                        help='The number of beaconing example documents per tag.')
+    parser.add_argument('--bucket-seconds', type=int, nargs='+', default=[60],
+                        help='The beaconing example time bucket lengths.')
+    parser.add_argument('--window-hours', type=int, default=6,
+                        help='The beaconing example time window length.')
+    parser.add_argument('--number-docs', type=int, nargs='+', default=[35000],
+                        help='The number of apriori example documents.')
+    parser.add_argument('--min-support', type=float, nargs='+', default=[0.1],
+                        help='The apriori example minimum supports.')
+    parser.add_argument('--max-set-size', type=int, nargs='+', default=[4],
+                        help='The apriori example maximum item set sizes.')
+    args = parser.parse_args(argv)
+
+    es = SimulatedElasticsearch(processes=args.simulator_processes) if args.simulate else None
+    results = None
+
+    if 'beaconing' in args.examples:
+        generator = BeaconingGenerator(args.user_name, args.password, thread_count=args.thread_count, es=es)
+        results = results or Results(generator.es_client())
+        for number_shards, number_tags, number_docs_per_tag in itertools.product(
+                args.number_shards, args.number_tags, args.number_docs_per_tag):
+            beaconing.run(generator,
+                          results,
+                          number_tags=number_tags,
+                          number_docs_per_tag=number_docs_per_tag,
+                          bucket_seconds=args.bucket_seconds,
+                          window_hours=args.window_hours,
+                          number_shards=number_shards,
+                          repeat=args.repeat,
+                          processes=args.processes,
+                          seed=args.seed)
+
+    if 'apriori' in args.examples:
+        generator = AprioriGenerator(args.user_name, args.password, thread_count=args.thread_count, es=es)
+        results = results or Results(generator.es_client())
+        for number_shards, number_docs in itertools.product(args.number_shards, args.number_docs):
+            apriori.run(generator,
+                        results,
+                        number_docs=number_docs,
+                        min_supports=args.min_support,
+                        max_set_sizes=args.max_set_size,
+                        number_shards=number_shards,
+                        repeat=args.repeat,
+                        processes=args.processes,
+                        seed=args.seed)
+
+    if es is not None:
+        es.close()
+    results.write(args.output)
+    print('WROTE', args.output)
+
+if __name__ == '__main__':
+    main()
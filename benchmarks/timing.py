@@ -0,0 +1,86 @@
+import json
+import numpy as np
+import platform
+import statistics
+import subprocess
+import time
+
+def measure(function, repeat: int = 3):
+    '''
+    Time repeated calls of a function.
+
+    @param function The function to call, which takes no arguments.
+    @param repeat The number of times to call it.
+    @return The result of the last call and a dictionary with the wall time of every
+    call and their minimum and median in seconds.
+    '''
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return result, {
+        'seconds': seconds,
+        'min_seconds': min(seconds),
+        'median_seconds': statistics.median(seconds)
+    }
+
+class Results:
+    '''
+    Collect benchmark measurements and write them as JSON.
+
+    Every measurement is keyed by the benchmark, the stage and the parameters of the
+    run so the results of different runs can be matched up by compare.py.
+    '''
+    def __init__(self, es=None):
+        self.environment = _environment(es)
+        self.measurements = []
+
+    def add(self, benchmark: str, stage: str, parameters: dict, **values):
+        '''
+        Add a measurement.
+
+        @param benchmark The name of the benchmark, for example beaconing.
+        @param stage The name of the stage which was timed, for example index.
+        @param parameters The parameters of the benchmark run.
+        @param values The measured values, for example took_millis.
+        '''
+        measurement = {'benchmark': benchmark, 'stage': stage, 'parameters': dict(parameters)}
+        measurement.update(values)
+        self.measurements.append(measurement)
+        print(benchmark, stage, parameters, {key: _round(value) for key, value in values.items()})
+
+    def to_dict(self):
+        return {'environment': self.environment, 'measurements': self.measurements}
+
+    def write(self, file_name: str):
+        with open(file_name, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+def _environment(es):
+    environment = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor()
+    }
+    try:
+        environment['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    if es is not None:
+        try:
+            environment['elasticsearch'] = es.info()['version']['number']
+        except Exception:
+            pass
+    return environment
+
+def _round(value):
+    if isinstance(value, float):
+        return round(value, 4)
+    if isinstance(value, list):
+        return [_round(x) for x in value]
+    return value
@@ -0,0 +1,104 @@
+from collections import Counter
+from examples.apriori.reference import bounded_frequent_sets, encode_transactions, frequent_sets
+import numpy as np
+
+def client_reduce_request(body: dict):
+    '''
+    Change a frequent item sets request so the aggregation returns the combined
+    state of each shard, i.e. the unique item set counts, rather than reducing it.
+    '''
+    scripted_metric = body['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']
+    scripted_metric['reduce_script'] = 'return states'
+    return body
+
+def encode_states(states: list):
+    '''
+    Merge the shard states returned by the aggregation for either the strings or
+    bitmask scripted metric into a boolean matrix of the unique item sets together
+    with their counts.
+
+    @return The items in ordinal order, a unique item sets x items boolean matrix
+    and the count of each unique item set.
+    '''
+    transactions = []
+    counts = []
+    for state in states:
+        if 'uniques' in state:
+            for key, count in state['uniques'].items():
+                transactions.append(key.split(' ') if key != '' else [])
+                counts.append(count)
+        else:
+            items = state['items']
+            for mask, count in zip(state['masks'], state['mask_counts']):
+                # Masks are signed 64 bit integers.
+                mask &= (1 << 64) - 1
+                transactions.append([items[b] for b in range(64) if (mask >> b) & 1])
+                counts.append(count)
+            for ordinals, count in zip(state['sets'], state['set_counts']):
+                transactions.append([items[ordinal] for ordinal in ordinals])
+                counts.append(count)
+    return encode_transactions(transactions, counts)
+
+def encode_heavy_hitter_states(states: list):
+    '''
+    Merge the shard states returned by the aggregation for the heavy_hitters
+    scripted metric.
+
+    @return The items in ordinal order, a unique item sets x items boolean matrix,
+    the counted occurrences and the estimated count of each unique item set, a
+    shards x items array of the evicted occurrences of each item, the number of
+    documents and the bound on the support of the items which no shard tracked.
+    '''
+    lower = Counter()
+    estimates = Counter()
+    total_count = 0
+    for state in states:
+        for key, count in state['counts'].items():
+            lower[key] += count - state['errors'][key]
+            estimates[key] += count
+        total_count += state['total']
+
+    keys = list(lower)
+    transactions = [key.split(' ') if key != '' else [] for key in keys]
+    items = sorted(set().union(*transactions, *[state['evicted'] for state in states]))
+    ordinal = {item: i for i, item in enumerate(items)}
+
+    matrix = np.zeros((len(keys), len(items)), dtype=bool)
+    for row, transaction in enumerate(transactions):
+        matrix[row, [ordinal[item] for item in transaction]] = True
+
+    # Items which a shard didn't track are bounded by its total evicted mass.
+    evicted = np.array([[state['evicted'].get(item, 0 if state['evicted_complete'] else state['evicted_total'])
+                         for item in items] for state in states], dtype=np.int64).reshape(len(states), len(items))
+
+    return (items,
+            matrix,
+            np.array([lower[key] for key in keys], dtype=np.int64),
+            np.array([estimates[key] for key in keys], dtype=np.int64),
+            evicted,
+            total_count,
+            sum(state['evicted_total'] for state in states if not state['evicted_complete']))
+
+def reduce(states: list,
+           min_support: float = 0.1,
+           max_set_size: int = 4,
+           processes: int = 1):
+    '''
+    Find the frequent item sets from the shard states returned by a request created
+    with client_reduce_request.
+
+    This does the work of the reduce_script locally, so expensive mining doesn't use
+    resources on the coordinating node. The result has the same format as the
+    aggregation's.
+
+    @param processes If greater than one support counting is spread across a process
+    pool. This isn't supported for the heavy_hitters states.
+    '''
+    if len(states) > 0 and 'counts' in states[0]:
+        return bounded_frequent_sets(*encode_heavy_hitter_states(states),
+                                     min_support=min_support,
+                                     max_set_size=max_set_size)
+    return frequent_sets(*encode_states(states),
+                         min_support=min_support,
+                         max_set_size=max_set_size,
+                         processes=processes)
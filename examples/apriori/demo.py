@@ -1,12 +1,40 @@
 from elasticsearch_dsl import Search
 from examples.apriori.generator import Generator
+from examples.apriori.sampling import adaptive_frequent_sets, random_sampler_request
+from examples.apriori.summaries import HOUR_MILLIS, SliceStore
+import examples.apriori.client_reduce as client_reduce
+import examples.apriori.summaries as summaries
+from utils.batch_search import batch_search
+from utils.result_cache import ResultCache
+from utils.search_profile import profile_search
+import time
 import utils.read_scripted_metric as read_scripted_metric
 
+# The implementations of the frequent item set scripted metric. The bitmask variant
+# represents item sets by bit masks of item ordinals rather than string keys. The
+# heavy_hitters variant keeps at most capacity unique item sets per shard and so
+# reports bounds on the supports of the item sets which may be frequent.
+SCRIPTED_METRICS = {
+    'strings': 'examples/apriori/scripted_metric_frequent_sets.txt',
+    'bitmask': 'examples/apriori/scripted_metric_frequent_sets_bitmask.txt',
+    'heavy_hitters': 'examples/apriori/scripted_metric_frequent_sets_heavy_hitters.txt'
+}
+
+# The ways the documents can be sampled.
+SAMPLING = ['sampler', 'random', 'adaptive']
+
 class Demo:
     def __init__(self,
                  user_name: str = '',
-                 password: str = ''):
-        self.generator = Generator(user_name, password)
+                 password: str = '',
+                 es = None,
+                 cache: ResultCache = None):
+        '''
+        @param cache If supplied, a ResultCache for the responses of run, which is
+        invalidated whenever the index changes.
+        '''
+        self.generator = Generator(user_name, password, es=es)
+        self.cache = cache
 
     def setup(self):
         '''
@@ -16,21 +44,257 @@ class Demo:
 
         self.generator.generate_and_index_demo_data()
 
-    def run(self):
+    def run(self,
+            params: dict = None,
+            variant: str = 'strings',
+            client_side_reduce: bool = False,
+            processes: int = 1,
+            sampling: str = 'sampler',
+            probability: float = None,
+            seed: int = None,
+            profile: bool = False):
         '''
-        Run the aggregation to find periodic beacons.
+        Run the aggregation to find frequent item sets.
+
+        @param params Overrides for the scripted metric params.
+        @param variant The scripted metric implementation to use, one of the keys
+        of SCRIPTED_METRICS.
+        @param client_side_reduce If true the aggregation only returns the unique
+        item set counts of each shard and the frequent item sets are found locally.
+        @param processes The number of processes to use for a client side reduce.
+        @param sampling How to sample the documents, one of SAMPLING. 'sampler'
+        takes the top shard_size documents by random score, 'random' uses the
+        random_sampler aggregation with the given probability and 'adaptive' uses
+        the random_sampler aggregation with a probability chosen from min_support.
+        @param probability The probability that a document is sampled if sampling
+        is 'random'.
+        @param seed The seed for the random_sampler aggregation.
+        @param profile If true report the time spent in each phase of the aggregation
+        and the size of the shard states. For adaptive sampling each round's search
+        is profiled.
+        @return The SearchProfile of the last search if profile is true.
         '''
         print('FINDING FREQUENT ITEM SETS...')
 
-        es = self.generator.es_client()
+        template = read_scripted_metric.template(SCRIPTED_METRICS[variant])
+        body = template.request(params)
+        search_profiles = [] if profile else None
+        bounds = []
+        complete = []
 
-        scripted_metric_query_body = read_scripted_metric.read('examples/apriori/scripted_metric_frequent_sets.txt')
+        def search(body: dict):
+            if client_side_reduce:
+                results = self.__search(client_reduce.client_reduce_request(body), variant, search_profiles)
+                states = results.to_dict()['aggregations']['random_sample']['frequent_sets']['value']
+                params = body['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']['params']
+                value = client_reduce.reduce(states,
+                                             min_support=params['min_support'],
+                                             max_set_size=params['max_set_size'],
+                                             processes=processes)
+            else:
+                results = self.__search(body, variant, search_profiles)
+                value = results.to_dict()['aggregations']['random_sample']['frequent_sets']['value']
+            frequent_sets, support_bounds = _split_bounds(value)
+            bounds.append(support_bounds)
+            complete.append(not isinstance(value, dict) or value['complete'])
+            return frequent_sets
 
-        results = Search.from_dict(scripted_metric_query_body).using(es).index('apriori_demo').execute()
+        if sampling == 'sampler':
+            frequent_sets = search(body)
+        elif sampling == 'random':
+            frequent_sets = search(random_sampler_request(body, probability, seed))
+        elif sampling == 'adaptive':
+            es = self.generator.es_client()
+            es.indices.refresh(index=Generator.INDEX_NAME)
+            number_docs = es.count(index=Generator.INDEX_NAME)['count']
+            frequent_sets, sample = adaptive_frequent_sets(search, body, number_docs, seed=seed)
+            print('SAMPLED', sample['sample_size'], 'DOCUMENTS WITH PROBABILITY', sample['probability'],
+                  'IN', sample['rounds'], 'ROUND(S)')
+        else:
+            raise ValueError('Unknown sampling ' + str(sampling) + ', expected one of ' + str(SAMPLING))
 
         size = 1
-        for rules in results.aggregations.random_sample.frequent_sets.value:
+        for rules in frequent_sets:
             print('FREQUENT_SETS(size=' + str(size) + ')')
-            for key,support in rules.to_dict().items():
+            for key,support in rules.items():
+                if bounds[-1] is None:
+                    print('  ', key, '/ support =', support)
+                else:
+                    lower, upper = bounds[-1][size - 1][key]
+                    print('  ', key, '/ support =', support,
+                          '(exact)' if lower == upper else '(bounded in [' + str(lower) + ', ' + str(upper) + '])')
+            size = size + 1
+        if not complete[-1]:
+            print('SOME FREQUENT SETS MAY BE MISSING, THE EVICTED ITEMS WEREN\'T ALL TRACKED: INCREASE capacity')
+
+        if profile:
+            return search_profiles[-1]
+
+    def run_filtered(self,
+                     filters: dict = None,
+                     params: dict = None,
+                     variant: str = 'strings',
+                     max_concurrent_requests: int = 4):
+        '''
+        Find the frequent item sets of several subsets of the documents with one
+        _msearch request.
+
+        @param filters A dictionary from a name to a query clause which selects the
+        documents of each subset. By default the documents are split by the value
+        of f1.
+        @param params Overrides for the scripted metric params.
+        @param variant The scripted metric implementation to use, one of the keys
+        of SCRIPTED_METRICS.
+        @param max_concurrent_requests The maximum number of _msearch requests to run
+        at once.
+        '''
+        print('FINDING FREQUENT ITEM SETS...')
+
+        if filters is None:
+            filters = {value: {'term': {'f1': value}} for value in Generator.ALL[0]}
+        names = list(filters)
+        specs = [(SCRIPTED_METRICS[variant], params, filters[name]) for name in names]
+
+        for position, results in batch_search(self.generator.es_client(),
+                                              Generator.INDEX_NAME,
+                                              specs,
+                                              max_concurrent_requests=max_concurrent_requests):
+            print('FILTER', names[position])
+            frequent_sets, _ = _split_bounds(results.to_dict()['aggregations']['random_sample']['frequent_sets']['value'])
+            for size, rules in enumerate(frequent_sets, 1):
+                print('  FREQUENT_SETS(size=' + str(size) + ')')
+                for key, support in rules.items():
+                    print('    ', key, '/ support =', support)
+
+    def summarize(self,
+                  directory: str,
+                  days: int = 30,
+                  slice_hours: int = 1,
+                  params: dict = None):
+        '''
+        Store the unique item set counts of each slice of the last days, except the
+        most recent slice which may still be receiving documents.
+
+        @param directory The directory of the SliceStore.
+        @param slice_hours The length of each slice in hours.
+        @param params Overrides for the scripted metric params.
+        '''
+        print('SUMMARIZING ITEM SETS...')
+
+        store = self.__slice_store(directory, slice_hours, params)
+        end_millis = int(time.time() * 1000) - store.slice_millis
+        number_slices = summaries.summarize(self.generator.es_client(),
+                                            store,
+                                            end_millis - days * 24 * HOUR_MILLIS,
+                                            end_millis,
+                                            index=Generator.INDEX_NAME,
+                                            params=params)
+        print('SUMMARIZED', number_slices, 'SLICES')
+
+    def run_window(self,
+                   directory: str,
+                   days: int = 30,
+                   slice_hours: int = 1,
+                   params: dict = None,
+                   processes: int = 1):
+        '''
+        Find the frequent item sets of the last days from the slices stored by
+        summarize together with a search of the documents they don't cover.
+
+        @param directory The directory of the SliceStore.
+        @param slice_hours The length of each slice in hours, which must be the same
+        as when the slices were summarized.
+        @param params Overrides for the scripted metric params.
+        @param processes The number of processes to use to count supports.
+        '''
+        print('FINDING FREQUENT ITEM SETS...')
+
+        store = self.__slice_store(directory, slice_hours, params)
+        end_millis = int(time.time() * 1000)
+        frequent_sets, stats = summaries.frequent_sets(self.generator.es_client(),
+                                                       store,
+                                                       end_millis - days * 24 * HOUR_MILLIS,
+                                                       end_millis,
+                                                       index=Generator.INDEX_NAME,
+                                                       params=params,
+                                                       processes=processes)
+        print('MERGED', stats['summarized_slices'], 'SLICES AND SEARCHED', len(stats['live_ranges']), 'RANGES')
+
+        for size, rules in enumerate(frequent_sets, 1):
+            print('FREQUENT_SETS(size=' + str(size) + ')')
+            for key, support in rules.items():
                 print('  ', key, '/ support =', support)
-            size = size + 1
\ No newline at end of file
+
+    def compare_variants(self,
+                         params: dict = None,
+                         seed: int = 0):
+        '''
+        Run every scripted metric implementation on the same random sample and
+        compare their results and run times.
+
+        The supports of the variants which bound them, i.e. heavy_hitters, are
+        approximate by design, so rather than comparing them exactly we check the
+        exact supports lie within their bounds.
+
+        @param params Overrides for the scripted metric params.
+        @param seed The seed for the random score used to select the sample.
+        '''
+        print('COMPARING FREQUENT ITEM SETS IMPLEMENTATIONS...')
+
+        values = {}
+        for variant in SCRIPTED_METRICS:
+            body = read_scripted_metric.template(SCRIPTED_METRICS[variant]).request(params)
+            body['query']['function_score']['random_score'] = {'seed': seed, 'field': '_seq_no'}
+            results = self.__search(body, variant)
+            values[variant] = results.to_dict()['aggregations']['random_sample']['frequent_sets']['value']
+            print(variant, 'took', results.took, 'ms')
+
+        expected = values.pop('strings')
+        for variant, value in values.items():
+            actual, support_bounds = _split_bounds(value)
+            if support_bounds is None:
+                same = (len(actual) == len(expected) and
+                        all(rules.keys() == expected_rules.keys() and
+                            all(abs(rules[key] - expected_rules[key]) < 1e-8 for key in rules)
+                            for rules, expected_rules in zip(actual, expected)))
+                print(variant, 'matches' if same else 'DIFFERS FROM', 'strings')
+            else:
+                # A set may only be missing if the result is flagged as incomplete.
+                bounded = all((key in size_bounds and
+                               size_bounds[key][0] - 1e-8 <= support <= size_bounds[key][1] + 1e-8) or
+                              (key not in size_bounds and not value['complete'])
+                              for size_bounds, expected_rules in zip(support_bounds, expected)
+                              for key, support in expected_rules.items())
+                print(variant, 'bounds' if bounded else 'DOESN\'T BOUND', 'strings')
+
+    def __slice_store(self, directory: str, slice_hours: int, params: dict = None):
+        body = read_scripted_metric.template(summaries.SCRIPTED_METRIC).request(params)
+        fields = body['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']['params']['fields']
+        return SliceStore(directory, fields, slice_millis=slice_hours * HOUR_MILLIS)
+
+    def __search(self, body: dict, variant: str, search_profiles: list = None):
+        es = self.generator.es_client()
+        read_scripted_metric.template(SCRIPTED_METRICS[variant]).register(es)
+        if search_profiles is None:
+            if self.cache is not None:
+                return self.cache.search(es, 'apriori_demo', body)
+            return Search.from_dict(body).using(es).index('apriori_demo').execute()
+        results, search_profile = profile_search(es, 'apriori_demo', body, _state_entries)
+        print(search_profile)
+        search_profiles.append(search_profile)
+        return results
+
+def _split_bounds(value):
+    # The heavy_hitters variant returns the bounds on the supports together with the
+    # frequent sets. The other variants' supports are exact.
+    if isinstance(value, dict):
+        return value['frequent_sets'], value['bounds']
+    return value, None
+
+def _state_entries(state: dict):
+    # The number of unique item sets in a shard state of any variant.
+    if 'uniques' in state:
+        return len(state['uniques'])
+    if 'counts' in state:
+        return len(state['counts'])
+    return len(state['masks']) + len(state['sets'])
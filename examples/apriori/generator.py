@@ -1,6 +1,10 @@
 from datetime import datetime
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import streaming_bulk
+from utils.bulk_index import BulkIndexer
+from utils.snapshot import DATE, KEYWORD, Snapshot, SnapshotWriter
+import itertools
+import json
+import numpy as np
 import random
 
 class Generator:
@@ -36,6 +40,9 @@ class Generator:
         [PROCESS_STATE, NO_PROCESS_STATE]
     ]
 
+    # The fields of the documents and their snapshot column types.
+    FIELDS = dict([('@timestamp', DATE)] + [('f' + str(i), KEYWORD) for i in range(1, 7)])
+
     RULES = [
         [IP_NOT_REACHABLE, RELAY_LINK_STATUS, NO_PEER_GROUP_MEMBER_AVAILABLE, PROCESS_STATE],
         [IP_NOT_REACHABLE, NO_PEER_GROUP_MEMBER_AVAILABLE, DIAMETER_PEER_GROUP_DOWN_RX],
@@ -45,44 +52,98 @@ class Generator:
         [MISMATCH_REQUEST_RESPONSE, IP_REACHABLE, RELAY_LINK_STATUS, PROCESS_STATE, PAD_FAILURE]
     ]
 
-    def __init__(self, user_name: str = '', password: str = ''):
-        if user_name != '' and password != '':
+    def __init__(self,
+                 user_name: str = '',
+                 password: str = '',
+                 thread_count: int = 4,
+                 es = None):
+        '''
+        @param es The client to use, for example a SimulatedElasticsearch. By default
+        a client for a local cluster is created.
+        '''
+        if es is not None:
+            self.es = es
+        elif user_name != '' and password != '':
             self.es = Elasticsearch(http_auth=(user_name, password))
         else:
             self.es = Elasticsearch()
+        self.bulk_indexer = BulkIndexer(self.es, thread_count=thread_count)
 
     def es_client(self):
         return self.es
 
     def generate_and_index_demo_data(self,
                                      number: int = 35000,
-                                     report_progress: bool = True):
+                                     report_progress: bool = True,
+                                     vectorized: bool = False,
+                                     seed: int = None,
+                                     snapshot: str = None):
         '''
         Generate and index some demo data.
+
+        @param vectorized If true the documents are generated with NumPy and indexed
+        without creating a dictionary per document.
+        @param seed The seed for the random number generator used by vectorized mode
+        which makes the item sets reproducible.
+        @param snapshot If supplied, the directory to which to write a snapshot of
+        the documents, see utils.snapshot.
         '''
         self.recreate_index()
 
         number = int(number / (len(Generator.RULES) + 1))
+        writer = SnapshotWriter(snapshot, Generator.FIELDS) if snapshot is not None else None
+
+        if vectorized:
+            stream = self.demo_data_batches(number * (len(Generator.RULES) + 1), seed, writer)
+            stats = self.bulk_indexer.index_serialized(stream,
+                                                       index=Generator.INDEX_NAME,
+                                                       number_docs=number * (len(Generator.RULES) + 1),
+                                                       report_progress=report_progress)
+        else:
+            stream = itertools.chain(self.__rule_generator(number), self.__rand_generator(number))
+            if writer is not None:
+                stream = writer.tee(stream)
+            stats = self.bulk_indexer.index(stream,
+                                            index=Generator.INDEX_NAME,
+                                            number_docs=number * (len(Generator.RULES) + 1),
+                                            report_progress=report_progress)
+        if writer is not None:
+            writer.close()
+        print(stats)
+
+    def demo_data_batches(self,
+                          number: int = 35000,
+                          seed: int = None,
+                          writer: SnapshotWriter = None):
+        '''
+        Generate the documents indexed by generate_and_index_demo_data in vectorized
+        mode as batches of serialized documents without indexing them.
+
+        @param writer If supplied, the documents are also appended to this snapshot.
+        '''
+        number = int(number / (len(Generator.RULES) + 1))
+        rng = np.random.default_rng(seed)
+        return itertools.chain(self.__rule_batches(rng, number, writer), self.__rand_batches(rng, number, writer))
 
-        counter = 0
-        last_progress = 0
-        stream = self.__rule_generator(number)
-        for ok, response in streaming_bulk(self.es, actions=stream, chunk_size=number):
-            if not ok:
-                print(response)
-            if report_progress:
-                counter,last_progress = self.__report_progress(counter, number * (len(Generator.RULES) + 1), last_progress)
-
-        stream = self.__rand_generator(number)
-        for ok, response in streaming_bulk(self.es, actions=stream, chunk_size=10000):
-            if not ok:
-                print(response)
-            if report_progress:
-                counter,last_progress = self.__report_progress(counter, number * (len(Generator.RULES) + 1), last_progress)
-
-    def recreate_index(self):
+    def index_snapshot(self, directory: str, number_shards: int = None):
+        '''
+        Recreate the index and index the documents of a snapshot written by one of
+        the generate methods, without generating them again.
+        '''
+        self.recreate_index(number_shards=number_shards)
+        data = Snapshot(directory)
+        stats = self.bulk_indexer.index_serialized(data.batches(),
+                                                   index=Generator.INDEX_NAME,
+                                                   number_docs=data.number_docs)
+        print(stats)
+        return stats
+
+    def recreate_index(self, number_shards: int = None):
         '''
         Recreate the index containing the demo data.
+
+        @param number_shards The number of primary shards, by default the cluster's
+        default.
         '''
         mappings = {
             'mappings':{
@@ -100,6 +161,8 @@ class Generator:
                 }
             }
         }
+        if number_shards is not None:
+            mappings['settings'] = {'number_of_shards': number_shards}
         self.es.indices.delete(index=Generator.INDEX_NAME, ignore=[400, 404])
         self.es.indices.create(index=Generator.INDEX_NAME, ignore=400, body=mappings)
 
@@ -129,8 +192,62 @@ class Generator:
             yield doc
             time = time + random.expovariate(1 / (10000 * len(Generator.RULES)))
 
-    def __report_progress(self, counter, number_docs, last_progress):
-        if counter / number_docs > last_progress + 0.05:
-            print(counter,'/', number_docs)
-            last_progress = last_progress + 0.05
-        return counter + 1, last_progress
+    def __rule_batches(self,
+                       rng: np.random.Generator,
+                       number: int,
+                       writer: SnapshotWriter = None,
+                       batch_size: int = 1000000):
+        # Generates the same distribution of documents as __rule_generator in batches.
+
+        time = ((datetime.now() - datetime(1970,1,1)).total_seconds() - 86400 * 28) * 1000.0
+
+        suffixes = np.array([self.__serialize_items(rule) + '}' for rule in Generator.RULES], dtype=object)
+        rule_items = np.array([rule + [None] * (6 - len(rule)) for rule in Generator.RULES], dtype=object)
+
+        total = len(Generator.RULES) * number
+        for start in range(0, total, batch_size):
+            size = min(batch_size, total - start)
+            rules = rng.integers(0, len(Generator.RULES), size=size)
+            times = time + np.concatenate([[0], np.cumsum(rng.exponential(10000, size=size - 1))])
+            time = times[-1] + rng.exponential(10000)
+            if writer is not None:
+                writer.append(dict([('@timestamp', times)] +
+                                   [('f' + str(i + 1), rule_items[rules, i]) for i in range(0, 6)]))
+            yield self.__serialize(times, suffixes[rules])
+
+    def __rand_batches(self,
+                       rng: np.random.Generator,
+                       number: int,
+                       writer: SnapshotWriter = None,
+                       batch_size: int = 1000000):
+        # Generates the same distribution of documents as __rand_generator in batches.
+
+        time = ((datetime.now() - datetime(1970,1,1)).total_seconds() - 86400 * 28) * 1000.0
+        mean_interval = 10000 * len(Generator.RULES)
+
+        for start in range(0, number, batch_size):
+            size = min(batch_size, number - start)
+            number_conds = rng.integers(0, 6, size=size)
+            suffixes = np.full(size, '', dtype=object)
+            columns = {}
+            for i in range(0, 6):
+                items = np.array([self.__serialize_items([item], i) for item in Generator.ALL[i]], dtype=object)
+                choices = rng.integers(0, len(Generator.ALL[i]), size=size)
+                suffixes = suffixes + np.where(number_conds >= i, items[choices], '')
+                if writer is not None:
+                    values = np.array(Generator.ALL[i], dtype=object)[choices]
+                    columns['f' + str(i + 1)] = np.where(number_conds >= i, values, None)
+            times = time + np.concatenate([[0], np.cumsum(rng.exponential(mean_interval, size=size - 1))])
+            time = times[-1] + rng.exponential(mean_interval)
+            if writer is not None:
+                writer.append(dict(columns, **{'@timestamp': times}))
+            yield self.__serialize(times, suffixes + '}')
+
+    def __serialize_items(self, items: list, offset: int = 0):
+        return ''.join(',"f' + str(offset + i + 1) + '":' + json.dumps(item) for i, item in enumerate(items))
+
+    def __serialize(self, times: np.ndarray, suffixes: np.ndarray):
+        return [
+            '{"@timestamp":' + str(time) + suffix
+            for time, suffix in zip(times.astype(np.int64).tolist(), suffixes.tolist())
+        ]
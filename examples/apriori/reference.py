@@ -0,0 +1,319 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import numpy as np
+
+def encode_transactions(transactions, counts=None):
+    '''
+    Encode transactions, which are iterables of items, as a boolean matrix of the
+    unique item sets together with their counts.
+
+    Each item is assigned an ordinal and each transaction is converted to a bitset
+    of its items' ordinals. Identical bitsets are merged, in the same way that the
+    map_script merges identical keys in state.uniques.
+
+    @param counts If supplied, the number of times each transaction occurs.
+
+    @return The items in ordinal order, a unique item sets x items boolean matrix
+    and the count of each unique item set.
+    '''
+    if counts is None:
+        counts = itertools.repeat(1)
+
+    ordinals = {}
+    masks = Counter()
+    for transaction, count in zip(transactions, counts):
+        mask = 0
+        for item in transaction:
+            mask |= 1 << ordinals.setdefault(item, len(ordinals))
+        masks[mask] += count
+
+    items = list(ordinals.keys())
+    unique_masks = list(masks.keys())
+    weights = np.fromiter(masks.values(), dtype=np.int64, count=len(masks))
+
+    number_bytes = (len(items) + 7) // 8
+    packed = np.frombuffer(b''.join(mask.to_bytes(number_bytes, 'little') for mask in unique_masks),
+                           dtype=np.uint8).reshape(len(unique_masks), number_bytes)
+    matrix = np.unpackbits(packed, axis=1, count=len(items), bitorder='little').astype(bool)
+
+    return _sort_items(items, matrix, weights)
+
+def encode_fields(columns: list):
+    '''
+    Encode transactions stored as one item per field, for example the fields f1..f6
+    of the demo data, as a boolean matrix of the unique item sets together with their
+    counts.
+
+    This is vectorized over the transactions and so is much faster than
+    encode_transactions for large data sets.
+
+    @param columns A list of equal length sequences, one per field, of item values.
+    Missing values are None.
+    @return The items in ordinal order, a unique item sets x items boolean matrix
+    and the count of each unique item set.
+    '''
+    number_transactions = len(columns[0]) if len(columns) > 0 else 0
+
+    items = sorted(set().union(*[set(column) for column in columns]) - {None})
+    ordinal = {item: i for i, item in enumerate(items)}
+
+    ordinal_columns = (np.fromiter((ordinal.get(value, -1) for value in column),
+                                   dtype=np.int64, count=number_transactions) for column in columns)
+    return items, *_encode_item_ordinals(number_transactions, len(items), ordinal_columns)
+
+def encode_ordinals(columns: list, dictionaries: list):
+    '''
+    Encode transactions stored as one item per field, whose values are encoded as
+    ordinals into a dictionary per field, as a boolean matrix of the unique item sets
+    together with their counts.
+
+    This works directly on the ordinals, for example the memory mapped columns of a
+    utils.snapshot.Snapshot, without decoding the item values.
+
+    @param columns A list of equal length integer arrays, one per field, of ordinals
+    into the field's dictionary. Missing values are -1.
+    @param dictionaries A list of the values of each field in ordinal order.
+    @return The items in ordinal order, a unique item sets x items boolean matrix
+    and the count of each unique item set.
+    '''
+    number_transactions = len(columns[0]) if len(columns) > 0 else 0
+
+    items = sorted(set().union(*[set(dictionary) for dictionary in dictionaries]))
+    ordinal = {item: i for i, item in enumerate(items)}
+
+    # Map each field's ordinals to the global ordinals. The last entry of each lookup
+    # maps missing values, -1, to -1.
+    lookups = [np.array([ordinal[value] for value in dictionary] + [-1], dtype=np.int64)
+               for dictionary in dictionaries]
+    ordinal_columns = (lookup[np.asarray(column)] for column, lookup in zip(columns, lookups))
+    matrix, weights = _encode_item_ordinals(number_transactions, len(items), ordinal_columns)
+
+    # Drop items in the dictionaries which don't occur.
+    present = matrix.any(axis=0)
+    return [item for item, keep in zip(items, present) if keep], matrix[:, present], weights
+
+def frequent_sets(items: list,
+                  matrix: np.ndarray,
+                  weights: np.ndarray,
+                  min_support: float = 0.1,
+                  max_set_size: int = 4,
+                  max_block_size: int = 1 << 24,
+                  processes: int = 1):
+    '''
+    Find the frequent item sets and their support.
+
+    This is a reference implementation of the reduce_script in
+    scripted_metric_frequent_sets.txt and returns the same result, i.e. a list
+    whose k'th entry maps the space separated sorted items of every frequent item
+    set of size k + 1 to its support.
+
+    Candidate sets of each size are generated by extending the frequent sets of the
+    previous size with the frequent items which sort after their last item. Their
+    supports are counted in blocks by and-ing the item columns of the candidates
+    and summing the counts of the matching unique item sets.
+
+    @param items The items in ordinal order.
+    @param matrix A unique item sets x items boolean matrix.
+    @param weights The count of each unique item set.
+    @param max_block_size Bounds the size of the unique item sets x candidates
+    boolean array used to count supports.
+    @param processes If greater than one the blocks are counted in a process pool.
+    '''
+    items, matrix, weights = _sort_items(items, matrix, weights)
+    weights = np.asarray(weights, dtype=np.int64)
+
+    total_count = int(weights.sum())
+    threshold = min_support * total_count
+
+    supports = weights @ matrix
+    frequent_items = np.flatnonzero(supports > threshold)
+
+    result = [{items[i]: int(supports[i]) / total_count for i in frequent_items}]
+    if len(frequent_items) == 0:
+        return result + [{} for _ in range(max_set_size)]
+
+    frequent = frequent_items[:, None]
+    columns = matrix[:, frequent_items]
+    position = np.full(len(items), -1)
+    position[frequent_items] = np.arange(len(frequent_items))
+
+    executor = None
+    if processes > 1:
+        executor = ProcessPoolExecutor(max_workers=processes,
+                                       initializer=_initialize_worker,
+                                       initargs=(columns, weights))
+    try:
+        for _ in range(max_set_size):
+            candidates = _extend(frequent, frequent_items, position)
+
+            block_size = max(max_block_size // max(len(weights), 1), 1)
+            blocks = [position[candidates[start:start + block_size]]
+                      for start in range(0, len(candidates), block_size)]
+            if executor is not None:
+                block_supports = list(executor.map(_worker_supports, blocks))
+            else:
+                block_supports = [_supports(columns, weights, block) for block in blocks]
+            candidate_supports = np.concatenate(block_supports) if len(blocks) > 0 else np.zeros(0, dtype=np.int64)
+
+            is_frequent = candidate_supports > threshold
+            frequent = candidates[is_frequent]
+            result.append({' '.join(items[i] for i in candidate): support / total_count
+                           for candidate, support in zip(frequent.tolist(), candidate_supports[is_frequent].tolist())})
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return result
+
+def bounded_frequent_sets(items: list,
+                          matrix: np.ndarray,
+                          lower: np.ndarray,
+                          estimates: np.ndarray,
+                          evicted: np.ndarray,
+                          total_count: int,
+                          untracked: int = 0,
+                          min_support: float = 0.1,
+                          max_set_size: int = 4):
+    '''
+    Find the item sets which may be frequent given bounded shard summaries of the
+    unique item set counts, with bounds on their support.
+
+    This is a reference implementation of the reduce_script in
+    scripted_metric_frequent_sets_heavy_hitters.txt and returns the same result,
+    i.e. a dictionary with the estimated supports in 'frequent_sets', in the format
+    returned by frequent_sets, the lower and upper bounds on each support in
+    'bounds', 'total', the number of documents, and 'complete'.
+
+    The support of an item set is at least the sum of lower over the unique item
+    sets which contain it. On each shard the occurrences which weren't counted are
+    at most the smallest evicted mass of its items, so the sum of these over the
+    shards added to the lower bound gives an upper bound. Both bounds can only
+    decrease as an item set grows, so a set is extended if its upper bound exceeds
+    the threshold and no set of the items is missed. However, once a shard's map
+    of evicted items is full the items it drops are unknown. Their support is at
+    most untracked and if this exceeds the threshold 'complete' is false, since a
+    frequent set may be missing.
+
+    @param items The items in ordinal order.
+    @param matrix A unique item sets x items boolean matrix.
+    @param lower The number of occurrences of each unique item set which were
+    counted by the shard summaries.
+    @param estimates The summaries' estimated count of each unique item set.
+    @param evicted A shards x items array of the occurrences of item sets containing
+    each item which were evicted from each shard's summary.
+    @param total_count The number of documents.
+    @param untracked The sum of the total evicted occurrences of the shards which
+    didn't track every evicted item.
+    '''
+    order = sorted(range(len(items)), key=lambda i: items[i])
+    items, matrix, evicted = [items[i] for i in order], matrix[:, order], evicted[:, order]
+    lower = np.asarray(lower, dtype=np.int64)
+    estimates = np.asarray(estimates, dtype=np.int64)
+    threshold = min_support * total_count
+
+    def bounds(candidates: np.ndarray):
+        supports = _supports(matrix, lower, candidates)
+        estimated = _supports(matrix, estimates, candidates)
+        upper = np.minimum(supports + evicted[:, candidates].min(axis=2).sum(axis=0), total_count)
+        return supports, np.clip(estimated, supports, upper), upper
+
+    def add(candidates: np.ndarray):
+        supports, estimated, upper = bounds(candidates)
+        is_frequent = upper > threshold
+        keys = [' '.join(items[i] for i in candidate) for candidate in candidates[is_frequent].tolist()]
+        frequent_sets.append({key: support / total_count
+                              for key, support in zip(keys, estimated[is_frequent].tolist())})
+        support_bounds.append({key: [support / total_count, bound / total_count]
+                               for key, support, bound in zip(keys,
+                                                              supports[is_frequent].tolist(),
+                                                              upper[is_frequent].tolist())})
+        return candidates[is_frequent]
+
+    frequent_sets = []
+    support_bounds = []
+    frequent = add(np.arange(len(items))[:, None])
+    frequent_items = frequent[:, 0]
+    position = np.full(len(items), -1)
+    position[frequent_items] = np.arange(len(frequent_items))
+    for _ in range(max_set_size):
+        frequent = add(_extend(frequent, frequent_items, position))
+
+    return {'frequent_sets': frequent_sets, 'bounds': support_bounds, 'total': total_count,
+            'complete': bool(untracked <= threshold)}
+
+def _encode_item_ordinals(number_transactions: int, number_items: int, ordinal_columns):
+    # Encode the transactions as bitsets of the ordinals of their items and count the
+    # unique bitsets. Each of ordinal_columns holds one ordinal per transaction, with
+    # -1 for missing values.
+
+    # Use bits in as many 64 bit words as are needed to represent each transaction.
+    number_words = max((number_items + 63) // 64, 1)
+    words = np.zeros((number_transactions, number_words), dtype=np.uint64)
+    for ordinals in ordinal_columns:
+        rows = np.flatnonzero(ordinals >= 0)
+        ordinals = ordinals[rows]
+        words[rows, ordinals // 64] |= np.left_shift(np.uint64(1), (ordinals % 64).astype(np.uint64))
+
+    if number_words == 1:
+        unique_words, weights = np.unique(words[:, 0], return_counts=True)
+        unique_words = unique_words[:, None]
+    else:
+        unique_words, weights = np.unique(words, axis=0, return_counts=True)
+
+    bits = np.unpackbits(unique_words.view(np.uint8), axis=1, bitorder='little')
+    matrix = bits.reshape(len(unique_words), -1)[:, :number_items].astype(bool)
+
+    return matrix, weights.astype(np.int64)
+
+def _supports(columns: np.ndarray, weights: np.ndarray, block: np.ndarray):
+    # Count the support of a block of candidates given by the positions of their
+    # items in columns.
+
+    contains = columns[:, block[:, 0]]
+    for j in range(1, block.shape[1]):
+        contains = contains & columns[:, block[:, j]]
+    return weights @ contains
+
+# The columns and weights which are shared by all tasks in a worker process.
+_worker_state = {}
+
+def _initialize_worker(columns: np.ndarray, weights: np.ndarray):
+    _worker_state['columns'] = columns
+    _worker_state['weights'] = weights
+
+def _worker_supports(block: np.ndarray):
+    return _supports(_worker_state['columns'], _worker_state['weights'], block)
+
+def _extend(frequent: np.ndarray, frequent_items: np.ndarray, position: np.ndarray):
+    # Join each frequent set with the frequent items which sort after its last item
+    # and prune candidates which have an infrequent subset.
+
+    size = frequent.shape[1]
+    if len(frequent) == 0:
+        return np.zeros((0, size + 1), dtype=np.int64)
+
+    last = position[frequent[:, -1]]
+    repeats = len(frequent_items) - 1 - last
+    prefixes = np.repeat(frequent, repeats, axis=0)
+    offsets = np.arange(len(prefixes)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    extensions = frequent_items[np.repeat(last, repeats) + 1 + offsets]
+    candidates = np.column_stack([prefixes, extensions])
+
+    if size > 1:
+        known = set(map(tuple, frequent.tolist()))
+        keep = [all(subset in known for subset in _subsets(candidate))
+                for candidate in map(tuple, candidates.tolist())]
+        candidates = candidates[np.array(keep, dtype=bool)]
+
+    return candidates
+
+def _subsets(candidate: tuple):
+    for i in range(len(candidate) - 1):
+        yield candidate[:i] + candidate[i + 1:]
+
+def _sort_items(items: list, matrix: np.ndarray, weights: np.ndarray):
+    # Reorder the item columns so ordinals follow the sort order used for the keys.
+
+    order = sorted(range(len(items)), key=lambda i: items[i])
+    return [items[i] for i in order], matrix[:, order], weights
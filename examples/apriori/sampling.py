@@ -0,0 +1,121 @@
+from statistics import NormalDist
+import copy
+import math
+
+# The random_sampler aggregation only supports probabilities less than this, or 1.
+MAX_SAMPLING_PROBABILITY = 0.5
+
+def random_sampler_request(body: dict,
+                           probability: float,
+                           seed: int = None):
+    '''
+    Change a frequent item sets request to use the random_sampler aggregation.
+
+    The sampler aggregation in the request needs a random score for every matching
+    document, which the function_score query computes, and takes a fixed number of
+    documents from each shard. The random_sampler aggregation instead skips over
+    the documents so each is included with the given probability, which is much
+    cheaper on large indices, and it is repeatable if a seed is supplied.
+
+    @param probability The probability that each document is in the sample. This
+    must be less than 0.5 or exactly 1.
+    @param seed The seed which determines the sample.
+    '''
+    if not (0 < probability < MAX_SAMPLING_PROBABILITY or probability == 1):
+        raise ValueError('The sampling probability must be in (0, ' + str(MAX_SAMPLING_PROBABILITY) +
+                         ') or exactly 1, got ' + str(probability))
+    body = copy.deepcopy(body)
+    body['query'] = body['query'].get('function_score', {}).get('query', {'match_all': {}})
+    random_sampler = {'probability': probability}
+    if seed is not None:
+        random_sampler['seed'] = seed
+    random_sample = body['aggs']['random_sample']
+    body['aggs']['random_sample'] = {'random_sampler': random_sampler, 'aggs': random_sample['aggs']}
+    return body
+
+def required_sample_size(min_support: float,
+                         relative_error: float = 0.1,
+                         confidence: float = 0.95):
+    '''
+    The number of documents needed to estimate a support of min_support to within
+    relative_error * min_support with the given confidence.
+
+    This uses the normal approximation to the binomial distribution of the number
+    of documents in the sample which contain an item set.
+    '''
+    z = _z(confidence)
+    return int(math.ceil(z * z * (1 - min_support) / (relative_error * relative_error * min_support)))
+
+def confidence_half_width(support: float,
+                          sample_size: float,
+                          confidence: float = 0.95):
+    '''
+    The half width of the confidence interval for a support estimated from a sample
+    of sample_size documents.
+    '''
+    support = min(max(support, 0.0), 1.0)
+    return _z(confidence) * math.sqrt(support * (1 - support) / sample_size)
+
+def adaptive_frequent_sets(search,
+                           body: dict,
+                           number_docs: int,
+                           seed: int = None,
+                           relative_error: float = 0.1,
+                           confidence: float = 0.95,
+                           max_rounds: int = 4):
+    '''
+    Find the frequent item sets from a random sample whose size is chosen from the
+    min_support of the request.
+
+    The first sample is just large enough to estimate a support of min_support to
+    within relative_error with the given confidence. The aggregation is run with the
+    min_support lowered by the width of the confidence interval so item sets whose
+    true support is above the threshold aren't missed. If any estimated supports
+    are so close to the threshold that it isn't clear which side of it they are,
+    the sample is widened just enough to separate the closest from the threshold
+    and the aggregation is run again, up to max_rounds times. The sample is never
+    larger than the index.
+
+    @param search A function which runs a request body and returns the frequent sets.
+    @param body A frequent item sets request body.
+    @param number_docs The number of documents in the index.
+    @param seed The seed of the random_sampler aggregation.
+    @return The frequent item sets with supports greater than min_support and a
+    dictionary describing the final sample.
+    '''
+    params = body['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']['params']
+    min_support = params['min_support']
+
+    probability = required_sample_size(min_support, relative_error, confidence) / max(number_docs, 1)
+
+    rounds = 0
+    for attempt in range(1, max_rounds + 1):
+        rounds = attempt
+        if probability >= MAX_SAMPLING_PROBABILITY:
+            probability = 1
+        sample_size = probability * number_docs
+        half_width = confidence_half_width(min_support, sample_size, confidence) if probability < 1 else 0.0
+
+        request = random_sampler_request(body, probability, seed)
+        request['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']['params']['min_support'] = \
+            max(min_support - half_width, 0.0)
+        frequent_sets = search(request)
+
+        # The gaps between the threshold and the supports we can't yet decide.
+        gaps = [abs(support - min_support)
+                for sets in frequent_sets for support in sets.values()
+                if abs(support - min_support) <= confidence_half_width(support, sample_size, confidence)]
+        if probability == 1 or len(gaps) == 0 or attempt == max_rounds:
+            break
+
+        gap = max(min(gaps), relative_error * min_support / 8)
+        z = _z(confidence)
+        probability = max(2 * probability,
+                          z * z * min_support * (1 - min_support) / (gap * gap) / number_docs)
+
+    sample = {'probability': probability, 'sample_size': int(sample_size), 'rounds': rounds}
+    return [{key: support for key, support in sets.items() if support > min_support}
+            for sets in frequent_sets], sample
+
+def _z(confidence: float):
+    return NormalDist().inv_cdf((1 + confidence) / 2)
@@ -0,0 +1,164 @@
+from collections import Counter
+from examples.apriori.client_reduce import reduce
+from examples.apriori.demo import SCRIPTED_METRICS
+
+class FrequentSets:
+    '''
+    A Python equivalent of the frequent item set scripted metrics for
+    SimulatedElasticsearch.
+
+    The shard state is the unique item set counts of scripted_metric_frequent_sets.txt
+    and the frequent sets are found by reference.py.
+    '''
+    def init(self, params: dict):
+        return Counter()
+
+    def map(self, state: Counter, params: dict, doc):
+        columns = [doc[field].tolist() for field in params['fields']]
+        state.update(' '.join(sorted(item for item in items if item is not None)) for items in zip(*columns))
+        return state
+
+    def combine(self, state: Counter, params: dict):
+        return {'uniques': dict(state)}
+
+    def reduce(self, states: list, params: dict):
+        return reduce(states, min_support=params['min_support'], max_set_size=params['max_set_size'])
+
+class BitmaskFrequentSets:
+    '''
+    A Python equivalent of scripted_metric_frequent_sets_bitmask.txt for
+    SimulatedElasticsearch.
+
+    The shard state matches the Painless script's: items are assigned ordinals in
+    the order the shard first sees them and each item set is counted as a signed 64
+    bit mask of its ordinals or, if any ordinal is 64 or more, a sorted list of
+    them. The frequent sets are found by reference.py from the combined states.
+    '''
+    def init(self, params: dict):
+        return {'items': [], 'ordinals': {}, 'masks': Counter(), 'sets': Counter()}
+
+    def map(self, state: dict, params: dict, doc):
+        items, ordinals = state['items'], state['ordinals']
+        columns = [doc[field].tolist() for field in params['fields']]
+        for values in zip(*columns):
+            mask = 0
+            large = None
+            for item in values:
+                if item is None:
+                    continue
+                ordinal = ordinals.get(item)
+                if ordinal is None:
+                    ordinal = ordinals[item] = len(items)
+                    items.append(item)
+                if ordinal < 64:
+                    mask |= 1 << ordinal
+                else:
+                    large = (large or set()) | {ordinal}
+            if large is None:
+                # Java longs wrap, so bit 63 is the sign bit.
+                state['masks'][mask - (1 << 64) if mask >= 1 << 63 else mask] += 1
+            else:
+                large |= {b for b in range(64) if (mask >> b) & 1}
+                state['sets'][tuple(sorted(large))] += 1
+        return state
+
+    def combine(self, state: dict, params: dict):
+        return {'items': list(state['items']),
+                'masks': list(state['masks'].keys()),
+                'mask_counts': list(state['masks'].values()),
+                'sets': [list(ordinals) for ordinals in state['sets'].keys()],
+                'set_counts': list(state['sets'].values())}
+
+    def reduce(self, states: list, params: dict):
+        return reduce(states, min_support=params['min_support'], max_set_size=params['max_set_size'])
+
+class SpaceSaving:
+    '''
+    The Space-Saving summary of the unique item sets built by the map_script of
+    scripted_metric_frequent_sets_heavy_hitters.txt.
+
+    Counts only ever increase by one, so if the bucket of the smallest count empties
+    the next smallest count is one larger and it can be tracked without sorting.
+    '''
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.buckets = {}
+        self.min_count = 0
+        self.evicted = {}
+        self.evicted_total = 0
+        self.evicted_complete = True
+        self.total = 0
+
+    def add(self, key: str):
+        self.total += 1
+        count = self.counts.get(key)
+        if count is not None:
+            self.__move(key, count, count + 1)
+        elif len(self.counts) < self.capacity:
+            self.errors[key] = 0
+            self.__move(key, 0, 1)
+        else:
+            min_count = self.min_count
+            evicted_key = next(iter(self.buckets[min_count]))
+            evicted_count = min_count - self.errors.pop(evicted_key)
+            self.__move(evicted_key, min_count, 0)
+            self.evicted_total += evicted_count
+            for item in evicted_key.split(' ') if evicted_key != '' else []:
+                if item in self.evicted:
+                    self.evicted[item] += evicted_count
+                elif len(self.evicted) < self.capacity:
+                    self.evicted[item] = evicted_count
+                else:
+                    self.evicted_complete = False
+            self.errors[key] = min_count
+            self.__move(key, 0, min_count + 1)
+
+    def to_dict(self):
+        return {'counts': dict(self.counts),
+                'errors': dict(self.errors),
+                'evicted': dict(self.evicted),
+                'evicted_total': self.evicted_total,
+                'evicted_complete': self.evicted_complete,
+                'total': self.total}
+
+    def __move(self, key: str, count: int, new_count: int):
+        if count > 0:
+            bucket = self.buckets[count]
+            del bucket[key]
+            if len(bucket) == 0:
+                del self.buckets[count]
+                if self.min_count == count:
+                    self.min_count = count + 1
+        if new_count > 0:
+            self.counts[key] = new_count
+            self.buckets.setdefault(new_count, {})[key] = None
+            if new_count == 1 or len(self.counts) == 1:
+                self.min_count = new_count
+        else:
+            del self.counts[key]
+
+class HeavyHitters:
+    '''
+    A Python equivalent of scripted_metric_frequent_sets_heavy_hitters.txt for
+    SimulatedElasticsearch.
+    '''
+    def init(self, params: dict):
+        return SpaceSaving(params['capacity'])
+
+    def map(self, state: SpaceSaving, params: dict, doc):
+        columns = [doc[field].tolist() for field in params['fields']]
+        for items in zip(*columns):
+            state.add(' '.join(sorted(item for item in items if item is not None)))
+        return state
+
+    def combine(self, state: SpaceSaving, params: dict):
+        return state.to_dict()
+
+    def reduce(self, states: list, params: dict):
+        return reduce(states, min_support=params['min_support'], max_set_size=params['max_set_size'])
+
+SCRIPTS = {file_name: FrequentSets for file_name in SCRIPTED_METRICS.values()}
+SCRIPTS[SCRIPTED_METRICS['bitmask']] = BitmaskFrequentSets
+SCRIPTS[SCRIPTED_METRICS['heavy_hitters']] = HeavyHitters
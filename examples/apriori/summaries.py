@@ -0,0 +1,208 @@
+from collections import Counter
+from examples.apriori.client_reduce import client_reduce_request, reduce
+from examples.apriori.sampling import random_sampler_request
+from utils.batch_search import batch_search
+import json
+import os
+import utils.read_scripted_metric as read_scripted_metric
+
+# The scripted metric whose map_script and combine_script compute the unique item
+# set counts of each slice.
+SCRIPTED_METRIC = 'examples/apriori/scripted_metric_frequent_sets.txt'
+
+HOUR_MILLIS = 3600 * 1000
+
+class SliceStore:
+    '''
+    A local store of the unique item set counts of fixed time slices of the documents.
+
+    Slices start at multiples of slice_millis since the epoch. Each is written to a
+    JSON file in directory named by its start, so the store is only as large as the
+    number of distinct item sets in each slice. The fields and slice length are
+    written to meta.json and a store can't be reopened with different ones, since
+    its counts would then be for different item sets or slices.
+    '''
+    def __init__(self,
+                 directory: str,
+                 fields: list,
+                 slice_millis: int = HOUR_MILLIS):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fields = list(fields)
+        self.slice_millis = slice_millis
+
+        meta = {'fields': self.fields, 'slice_millis': slice_millis}
+        file_name = os.path.join(directory, 'meta.json')
+        if os.path.exists(file_name):
+            with open(file_name) as file:
+                stored = json.load(file)
+            if stored != meta:
+                raise ValueError('The slices in ' + directory + ' are for ' + str(stored) + ', not ' + str(meta))
+        else:
+            with open(file_name, 'w') as file:
+                json.dump(meta, file)
+
+    def get(self, start_millis: int):
+        '''
+        Get the unique item set counts of the slice starting at start_millis, or None
+        if it hasn't been summarized.
+        '''
+        try:
+            with open(self.__file_name(start_millis)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def put(self, start_millis: int, uniques: dict):
+        if start_millis % self.slice_millis != 0:
+            raise ValueError('Slices must start at a multiple of ' + str(self.slice_millis) + ', got ' + str(start_millis))
+        # Write then rename so readers never see a partial file.
+        file_name = self.__file_name(start_millis)
+        with open(file_name + '.tmp', 'w') as file:
+            json.dump(uniques, file)
+        os.replace(file_name + '.tmp', file_name)
+
+    def starts(self):
+        '''
+        The starts of the summarized slices in ascending order.
+        '''
+        return sorted(int(file_name[:-len('.json')]) for file_name in os.listdir(self.directory)
+                      if file_name.endswith('.json') and file_name != 'meta.json')
+
+    def __file_name(self, start_millis: int):
+        return os.path.join(self.directory, str(start_millis) + '.json')
+
+def summarize(es,
+              store: SliceStore,
+              start_millis: int,
+              end_millis: int,
+              index: str = 'apriori_demo',
+              params: dict = None,
+              max_concurrent_requests: int = 4):
+    '''
+    Compute and store the unique item set counts of every slice which lies in
+    [start_millis, end_millis) and hasn't been summarized already.
+
+    The counts are computed by the map_script and combine_script of
+    SCRIPTED_METRIC on every document of the slice, without sampling, and the
+    searches for all the slices are sent in a few _msearch requests. The slices
+    are assumed not to change once summarized, so end_millis should be far enough
+    in the past that no more documents will arrive before it.
+
+    @param params Overrides for the scripted metric params.
+    @return The number of slices summarized.
+    '''
+    params = _params(store, params)
+    summarized = set(store.starts())
+    starts = [start for start in _slice_starts(store, start_millis, end_millis) if start not in summarized]
+
+    specs = [(_CountingTemplate(), params, _range(start, start + store.slice_millis)) for start in starts]
+    for position, results in batch_search(es, index, specs, max_concurrent_requests=max_concurrent_requests):
+        store.put(starts[position], dict(_merge_states(results)))
+
+    return len(starts)
+
+def count(es,
+          store: SliceStore,
+          start_millis: int,
+          end_millis: int,
+          index: str = 'apriori_demo',
+          params: dict = None,
+          max_concurrent_requests: int = 4):
+    '''
+    Count the unique item sets of the documents in [start_millis, end_millis).
+
+    The stored counts of the summarized slices in the window are merged and the
+    scripted metric only runs on the ranges which they don't cover, such as a
+    partial slice at the start of the window and the tail which hasn't been
+    summarized yet. So the cost of a long window grows with the number of distinct
+    item sets in each slice rather than the number of documents.
+
+    @param params Overrides for the scripted metric params.
+    @return The unique item set counts and a dictionary with the number of
+    summarized_slices used and the live_ranges searched.
+    '''
+    params = _params(store, params)
+
+    uniques = Counter()
+    live_ranges = []
+    summarized_slices = 0
+    live_start = start_millis
+    for start in _slice_starts(store, start_millis, end_millis):
+        summary = store.get(start)
+        if summary is None:
+            continue
+        if live_start < start:
+            live_ranges.append((live_start, start))
+        uniques.update(summary)
+        summarized_slices += 1
+        live_start = start + store.slice_millis
+    if live_start < end_millis:
+        live_ranges.append((live_start, end_millis))
+
+    specs = [(_CountingTemplate(), params, _range(start, end)) for start, end in live_ranges]
+    for _, results in batch_search(es, index, specs, max_concurrent_requests=max_concurrent_requests):
+        uniques.update(_merge_states(results))
+
+    return uniques, {'summarized_slices': summarized_slices, 'live_ranges': live_ranges}
+
+def frequent_sets(es,
+                  store: SliceStore,
+                  start_millis: int,
+                  end_millis: int,
+                  index: str = 'apriori_demo',
+                  params: dict = None,
+                  processes: int = 1,
+                  max_concurrent_requests: int = 4):
+    '''
+    Find the frequent item sets of the documents in [start_millis, end_millis) from
+    the counts found by count.
+
+    @param params Overrides for the scripted metric params.
+    @param processes The number of processes to use to count supports.
+    @return The frequent item sets in the same format as the aggregation's and the
+    statistics returned by count.
+    '''
+    uniques, stats = count(es, store, start_millis, end_millis,
+                           index=index, params=params, max_concurrent_requests=max_concurrent_requests)
+    params = _params(store, params)
+    return reduce([{'uniques': uniques}],
+                  min_support=params['min_support'],
+                  max_set_size=params['max_set_size'],
+                  processes=processes), stats
+
+class _CountingTemplate:
+    # The SCRIPTED_METRIC template changed to count every document and return the
+    # shard states rather than reducing them.
+
+    def __init__(self):
+        self.template = read_scripted_metric.template(SCRIPTED_METRIC)
+        self.file_name = self.template.file_name
+
+    def register(self, es):
+        self.template.register(es)
+
+    def request(self, params: dict = None):
+        return client_reduce_request(random_sampler_request(self.template.request(params), probability=1))
+
+def _params(store: SliceStore, params: dict):
+    # The scripted metric params with overrides, which must be for the store's fields.
+    body = read_scripted_metric.template(SCRIPTED_METRIC).request(params)
+    params = body['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']['params']
+    if list(params['fields']) != store.fields:
+        raise ValueError('The slices are for fields ' + str(store.fields) + ', not ' + str(params['fields']))
+    return params
+
+def _slice_starts(store: SliceStore, start_millis: int, end_millis: int):
+    # The starts of the slices which lie entirely in [start_millis, end_millis).
+    first = -(-start_millis // store.slice_millis) * store.slice_millis
+    return range(first, end_millis - store.slice_millis + 1, store.slice_millis)
+
+def _range(start_millis: int, end_millis: int):
+    return {'range': {'@timestamp': {'gte': start_millis, 'lt': end_millis}}}
+
+def _merge_states(results):
+    uniques = Counter()
+    for state in results.to_dict()['aggregations']['random_sample']['frequent_sets']['value']:
+        uniques.update(state['uniques'])
+    return uniques
@@ -1,29 +1,209 @@
+from elasticsearch.helpers import scan
 from elasticsearch_dsl import Search
-from examples.beaconing.generator import Generator
-import numpy as np
+from examples.apriori.demo import SCRIPTED_METRICS
+from examples.apriori.generator import Generator
+from examples.apriori.reference import encode_fields, encode_ordinals, frequent_sets
+from examples.apriori.sampling import random_sampler_request
+from examples.apriori.summaries import HOUR_MILLIS, SliceStore
+from utils.snapshot import Snapshot
+import examples.apriori.summaries as summaries
+import tempfile
 import utils.read_scripted_metric as read_scripted_metric
 
 class Test:
     def __init__(self,
                  user_name: str = '',
-                 password: str = ''):
-        self.generator = Generator(user_name, password)
+                 password: str = '',
+                 es = None):
+        self.generator = Generator(user_name, password, es=es)
 
     def es_client(self):
         return self.generator.es_client()
 
-    def setup_generated(self):
+    def setup_generated(self, snapshot: str = None):
         '''
         Generate some data used for testing.
 
         This isn't run as part setup because it relatively heavyweight.
+
+        @param snapshot If supplied, the directory to which to write a snapshot of the
+        generated documents.
         '''
-        self.generator.generate_and_index_demo_data()
+        self.generator.generate_and_index_demo_data(snapshot=snapshot)
 
-    def test_generated(self):
+    def test_generated(self, variant: str = 'strings', random_sampler: bool = False, snapshot: str = None):
         '''
         Test the frequent item set scipted metric aggregation on the data set
         generated by setup_generated vs a python reference implementation.
+
+        @param variant The scripted metric implementation to test, one of the keys
+        of SCRIPTED_METRICS.
+        @param random_sampler If true sample with the random_sampler aggregation
+        rather than the sampler aggregation.
+        @param snapshot If supplied, the directory of the snapshot written by
+        setup_generated from which to read the documents. Otherwise they are read from
+        the index.
         '''
+        es = self.es_client()
+
+        template = read_scripted_metric.template(SCRIPTED_METRICS[variant])
+        template.register(es)
+        scripted_metric_query_body = template.request()
+        params = scripted_metric_query_body['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']['params']
+
+        # The sampler selects a random subset of the documents on each shard. In order
+        # that the aggregation and the reference implementation see the same sample we
+        # make it large enough to include every document.
+        es.indices.refresh(index=Generator.INDEX_NAME)
+        number_docs = es.count(index=Generator.INDEX_NAME)['count']
+        if random_sampler:
+            scripted_metric_query_body = random_sampler_request(scripted_metric_query_body, probability=1, seed=0)
+        else:
+            scripted_metric_query_body['aggs']['random_sample']['sampler']['shard_size'] = number_docs
+        if 'capacity' in params:
+            # The heavy_hitters shard states are exact if they can hold every document.
+            params['capacity'] = number_docs
+
+        expected_results = frequent_sets(*self.__read_encoded(params['fields'], snapshot),
+                                         min_support=params['min_support'],
+                                         max_set_size=params['max_set_size'])
+
+        actual_results = Search.from_dict(scripted_metric_query_body).using(es).index(Generator.INDEX_NAME).execute()
+        actual_results = actual_results.to_dict()['aggregations']['random_sample']['frequent_sets']['value']
+        if isinstance(actual_results, dict):
+            actual_results = actual_results['frequent_sets']
+
+        failed = False
+
+        for size, (actual_result, expected_result) in enumerate(zip(actual_results, expected_results)):
+            if (self.__assert_equal(set(actual_result.keys()), set(expected_result.keys())) or
+                any(self.__assert_close(actual_result[key], expected_result[key], 1e-8) for key in expected_result)):
+                print('mismatch for size', size + 1, ':\n', expected_result, '\nvs\n', actual_result)
+                failed = True
+                break
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def test_heavy_hitters(self, capacity: int = 100):
+        '''
+        Test the bounds on the supports found by the heavy_hitters scripted metric
+        aggregation on the data set generated by setup_generated.
+
+        Every frequent item set must be reported unless the result is flagged as
+        incomplete, every support must lie within its bounds and the supports
+        reported as exact must equal the reference implementation's.
+
+        @param capacity The maximum number of unique item sets in each shard state.
+        '''
+        es = self.es_client()
+
+        template = read_scripted_metric.template(SCRIPTED_METRICS['heavy_hitters'])
+        template.register(es)
+        scripted_metric_query_body = random_sampler_request(template.request({'capacity': capacity}),
+                                                            probability=1, seed=0)
+        params = scripted_metric_query_body['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']['params']
+
+        # Find the support of every item set which could be reported.
+        es.indices.refresh(index=Generator.INDEX_NAME)
+        expected_results = frequent_sets(*self.__read_encoded(params['fields']),
+                                         min_support=0,
+                                         max_set_size=params['max_set_size'])
+
+        actual_results = Search.from_dict(scripted_metric_query_body).using(es).index(Generator.INDEX_NAME).execute()
+        actual_results = actual_results.to_dict()['aggregations']['random_sample']['frequent_sets']['value']
+
+        failed = False
+
+        for size, (actual_result, bounds, expected_result) in enumerate(
+                zip(actual_results['frequent_sets'], actual_results['bounds'], expected_results)):
+            missing = {key for key, support in expected_result.items()
+                       if support > params['min_support'] and key not in actual_result and actual_results['complete']}
+            outside = {key for key, (lower, upper) in bounds.items()
+                       if self.__assert_outside(expected_result.get(key, 0), lower, upper, 1e-8)}
+            inexact = {key for key, (lower, upper) in bounds.items()
+                       if lower == upper and self.__assert_close(actual_result[key], expected_result.get(key, 0), 1e-8)}
+            if missing or outside or inexact:
+                print('mismatch for size', size + 1, ':\n missing', missing,
+                      '\n outside bounds', outside, '\n inexact', inexact)
+                failed = True
+                break
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def test_summaries(self, directory: str = None):
+        '''
+        Test finding the frequent item sets of a window from hourly slice summaries
+        vs the reference implementation on the documents in the window.
+
+        The first half of the data set generated by setup_generated is summarized and
+        the window starts part way through a slice, so the window's counts come from
+        both the summaries and live searches.
+
+        @param directory The directory in which to store the summaries. By default a
+        temporary directory is used.
+        '''
+        if directory is None:
+            with tempfile.TemporaryDirectory() as directory:
+                return self.test_summaries(directory)
+
+        es = self.es_client()
+        es.indices.refresh(index=Generator.INDEX_NAME)
+
+        params = read_scripted_metric.template(summaries.SCRIPTED_METRIC).request()
+        params = params['aggs']['random_sample']['aggs']['frequent_sets']['scripted_metric']['params']
+        fields = params['fields']
+
+        times = []
+        columns = [[] for _ in fields]
+        for hit in scan(es, index=Generator.INDEX_NAME, query={'_source': ['@timestamp'] + fields}):
+            times.append(hit['_source']['@timestamp'])
+            for column, field in zip(columns, fields):
+                column.append(hit['_source'].get(field))
+
+        first, last = min(times), max(times)
+        start_millis = first + HOUR_MILLIS // 2
+        end_millis = last + 1
+        store = SliceStore(directory, fields)
+        summaries.summarize(es, store, first, (first + last) // 2, index=Generator.INDEX_NAME)
+
+        in_window = [start_millis <= time < end_millis for time in times]
+        expected_results = frequent_sets(*encode_fields([[value for value, keep in zip(column, in_window) if keep]
+                                                         for column in columns]),
+                                         min_support=params['min_support'],
+                                         max_set_size=params['max_set_size'])
+
+        actual_results, stats = summaries.frequent_sets(es, store, start_millis, end_millis, index=Generator.INDEX_NAME)
+
+        failed = stats['summarized_slices'] == 0 or len(stats['live_ranges']) < 2
+        if failed:
+            print('expected summarized slices and live ranges, got', stats)
+
+        for size, (actual_result, expected_result) in enumerate(zip(actual_results, expected_results)):
+            if failed:
+                break
+            if (self.__assert_equal(set(actual_result.keys()), set(expected_result.keys())) or
+                any(self.__assert_close(actual_result[key], expected_result[key], 1e-8) for key in expected_result)):
+                print('mismatch for size', size + 1, ':\n', expected_result, '\nvs\n', actual_result)
+                failed = True
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def __read_encoded(self, fields: list, snapshot: str = None):
+        if snapshot is not None:
+            data = Snapshot(snapshot)
+            return encode_ordinals([data.column(field) for field in fields],
+                                   [data.dictionary(field) for field in fields])
+        columns = [[] for _ in fields]
+        for hit in scan(self.es_client(), index=Generator.INDEX_NAME, query={'_source': fields}):
+            for column, field in zip(columns, fields):
+                column.append(hit['_source'].get(field))
+        return encode_fields(columns)
+
+    def __assert_equal(self, lhs, rhs):
+        return lhs != rhs
+
+    def __assert_close(self, lhs: float, rhs: float, tolerance: float):
+        return abs(rhs - lhs) > tolerance
 
-        # TODO
+    def __assert_outside(self, value: float, lower: float, upper: float, tolerance: float):
+        return value < lower - tolerance or value > upper + tolerance
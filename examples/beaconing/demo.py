@@ -1,12 +1,44 @@
 from elasticsearch_dsl import Search
 from examples.beaconing.generator import Generator
+from examples.beaconing.rolling import RollingWindow
+from examples.beaconing.runner import Runner
+from examples.beaconing.streaming import StreamingDetector
+from utils.batch_search import batch_search
+from utils.result_cache import ResultCache
+from utils.search_profile import profile_search
+import math
 import utils.read_scripted_metric as read_scripted_metric
 
+# The implementations of the beaconing scripted metric. The prefix_sums variant
+# computes the autocovariances from prefix sums of the lagged products, which is
+# quadratic rather than cubic in the number of buckets. The sparse variant also
+# adapts each shard's state to the density of the tag's documents.
+SCRIPTED_METRICS = {
+    'direct': 'examples/beaconing/scripted_metric_beacons.txt',
+    'prefix_sums': 'examples/beaconing/scripted_metric_beacons_fast.txt',
+    'sparse': 'examples/beaconing/scripted_metric_beacons_sparse.txt'
+}
+
+# The shard state representations supported by the sparse variant.
+STATES = ['auto', 'sparse', 'dense']
+
+# The scripted metric which finds beacons at several resolutions in one pass. The
+# map_script counts documents at the finest resolution and the reduce_script sums
+# adjacent buckets to compute the statistics at each coarser one.
+MULTI_RESOLUTION = 'examples/beaconing/scripted_metric_beacons_multi.txt'
+
 class Demo:
     def __init__(self,
                  user_name: str = '',
-                 password: str = ''):
-        self.generator = Generator(user_name, password)
+                 password: str = '',
+                 es = None,
+                 cache: ResultCache = None):
+        '''
+        @param cache If supplied, a ResultCache for the responses of run, which is
+        invalidated whenever the index changes.
+        '''
+        self.generator = Generator(user_name, password, es=es)
+        self.cache = cache
 
     def setup(self):
         '''
@@ -16,16 +48,214 @@ class Demo:
 
         self.generator.generate_and_index_demo_data()
 
-    def run(self):
+    def run(self,
+            params: dict = None,
+            variant: str = 'direct',
+            state: str = None,
+            profile: bool = False,
+            resolutions: list = None):
         '''
         Run the aggregation to find periodic beacons.
+
+        @param params Overrides for the scripted metric params.
+        @param variant The scripted metric implementation to use, one of the keys
+        of SCRIPTED_METRICS.
+        @param state The shard state representation for the sparse variant, one of
+        STATES. If set the state bytes of every shard are reported for each tag.
+        @param resolutions If supplied, the bucket lengths in seconds at which to
+        look for beacons. These are all evaluated in one pass by MULTI_RESOLUTION,
+        rather than variant, and the best resolution and period of each tag are
+        reported.
+        @param profile If true report the time spent in each phase of the aggregation
+        and the size of the shard states.
+        @return The SearchProfile if profile is true.
         '''
         print('FIND BEACONS...')
 
+        if state is not None:
+            if variant != 'sparse' or state not in STATES:
+                raise ValueError('Unsupported state ' + str(state) + ' for variant ' + variant)
+            params = dict(params or {}, state=state)
+        if resolutions is not None:
+            if state is not None:
+                raise ValueError('Unsupported state ' + str(state) + ' for multiple resolutions')
+            params = resolution_params(resolutions, params)
+
         es = self.generator.es_client()
         
-        scripted_metric_query_body = read_scripted_metric.read('examples/beaconing/scripted_metric_beacons.txt')
-        results = Search.from_dict(scripted_metric_query_body).using(es).index('beaconing_demo').execute()
+        template = read_scripted_metric.template(SCRIPTED_METRICS[variant] if resolutions is None else MULTI_RESOLUTION)
+        template.register(es)
+        scripted_metric_query_body = template.request(params)
+        if profile:
+            results, search_profile = profile_search(es, 'beaconing_demo', scripted_metric_query_body, _state_entries)
+        elif self.cache is not None:
+            results = self.cache.search(es, 'beaconing_demo', scripted_metric_query_body)
+        else:
+            results = Search.from_dict(scripted_metric_query_body).using(es).index('beaconing_demo').execute()
 
         for bucket in results.aggregations.process.buckets:
             print(bucket.key, 'is_beaconing:', bucket.beacon_stats.value.is_beaconing)
+            if resolutions is not None and bucket.beacon_stats.value.is_beaconing:
+                print('  ', 'resolution:', bucket.beacon_stats.value.resolution,
+                      'period:', bucket.beacon_stats.value.period)
+            if state is not None:
+                print('  ', 'state_bytes:', list(bucket.beacon_stats.value.state_bytes))
+
+        if profile:
+            print(search_profile)
+            return search_profile
+
+    def run_paged(self,
+                  params: dict = None,
+                  variant: str = 'direct',
+                  page_size: int = 1000,
+                  max_concurrent_pages: int = 4):
+        '''
+        Run the aggregation to find periodic beacons for every tag, paging through
+        the tags with a composite aggregation.
+
+        @param params Overrides for the scripted metric params.
+        @param variant The scripted metric implementation to use, one of the keys
+        of SCRIPTED_METRICS.
+        @param page_size The number of tags to score in each request.
+        @param max_concurrent_pages The maximum number of requests to run at once.
+        '''
+        print('FIND BEACONS...')
+
+        runner = Runner(self.generator.es_client(),
+                        scripted_metric=SCRIPTED_METRICS[variant],
+                        page_size=page_size,
+                        max_concurrent_pages=max_concurrent_pages)
+
+        for tag, beacon_stats in runner.run(params):
+            print(tag, 'is_beaconing:', beacon_stats['is_beaconing'])
+
+    def run_windows(self,
+                    hours: list = [1, 3, 6],
+                    variant: str = 'direct',
+                    number_buckets: int = 360,
+                    max_concurrent_requests: int = 4):
+        '''
+        Find periodic beacons in several windows ending six hours after the start of
+        the demo data with one _msearch request. Each window replaces the template's
+        range query, so windows can be longer than its six hours.
+
+        @param hours The length of each window in hours.
+        @param variant The scripted metric implementation to use, one of the keys
+        of SCRIPTED_METRICS.
+        @param number_buckets The number of time buckets in each window, so longer
+        windows use longer buckets. Each window must divide into a whole number of
+        seconds per bucket.
+        @param max_concurrent_requests The maximum number of _msearch requests to run
+        at once.
+        '''
+        print('FIND BEACONS...')
+
+        end_millis = Generator.START_TIME + 6 * 3600 * 1000
+        specs = []
+        for window_hours in hours:
+            # The buckets must cover the whole window or its tail would be dropped.
+            if window_hours * 3600 % number_buckets != 0:
+                raise ValueError('A ' + str(window_hours) + ' hour window isn\'t a whole number of seconds ' +
+                                 'per bucket with ' + str(number_buckets) + ' buckets')
+            start_millis = end_millis - window_hours * 3600 * 1000
+            params = {'range_start_millis': start_millis // 1000,
+                      'number_buckets_in_range': number_buckets,
+                      'time_bucket_length': int(window_hours * 3600 // number_buckets)}
+            specs.append((_WindowTemplate(SCRIPTED_METRICS[variant], start_millis, end_millis), params, None))
+
+        for position, results in batch_search(self.generator.es_client(),
+                                              Generator.INDEX_NAME,
+                                              specs,
+                                              max_concurrent_requests=max_concurrent_requests):
+            print('LAST', hours[position], 'HOURS')
+            for bucket in results.aggregations.process.buckets:
+                print('  ', bucket.key, 'is_beaconing:', bucket.beacon_stats.value.is_beaconing)
+
+    def run_rolling(self,
+                    step_minutes: int = 10,
+                    number_steps: int = 6):
+        '''
+        Find periodic beacons in a six hour window which slides forward in steps,
+        only querying the new data at each step.
+
+        @param step_minutes The number of minutes to advance the window each step.
+        @param number_steps The number of steps to take.
+        '''
+        print('FIND BEACONS...')
+
+        window = RollingWindow(self.generator.es_client())
+
+        end_millis = Generator.START_TIME + 6 * 3600 * 1000
+        for _ in range(number_steps + 1):
+            number_buckets = window.update(end_millis)
+            print('WINDOW ENDING', end_millis, 'QUERIED', number_buckets, 'BUCKETS')
+            for tag, beacon_stats in window.statistics().items():
+                print('  ', tag, 'is_beaconing:', beacon_stats['is_beaconing'])
+            end_millis += step_minutes * 60000
+
+    def run_streaming(self,
+                      slices: int = 4,
+                      page_size: int = 10000):
+        '''
+        Find periodic beacons without scripts by streaming the tag and timestamp of
+        every document through a point in time and counting them locally.
+
+        @param slices The number of slices of the point in time to read in parallel.
+        @param page_size The number of documents to read in each request.
+        '''
+        print('FIND BEACONS...')
+
+        detector = StreamingDetector(self.generator.es_client(), slices=slices, page_size=page_size)
+        results, slice_stats = detector.run()
+
+        for stats in slice_stats:
+            print('SLICE', stats['slice'], 'READ', stats['docs'], 'DOCS IN', stats['pages'], 'PAGES',
+                  '(%.0f docs/s)' % stats['docs_per_second'],
+                  'STATE', stats['state_bytes'], 'BYTES', 'MAX PAGE', stats['max_page_bytes'], 'BYTES')
+        for tag, beacon_stats in results.items():
+            print(tag, 'is_beaconing:', beacon_stats['is_beaconing'])
+
+def resolution_params(resolutions: list, params: dict = None, range_seconds: int = 6 * 3600):
+    '''
+    The MULTI_RESOLUTION params to find beacons at each of resolutions.
+
+    The finest buckets are the greatest common divisor of the resolutions, so every
+    resolution is a whole number of them.
+
+    @param resolutions The bucket lengths in seconds.
+    @param params Overrides for the other scripted metric params.
+    @param range_seconds The length of the search range.
+    '''
+    if len(resolutions) == 0 or any(int(resolution) != resolution or resolution <= 0
+                                    for resolution in resolutions):
+        raise ValueError('Resolutions must be positive whole numbers of seconds, got ' + str(resolutions))
+    time_bucket_length = math.gcd(*resolutions)
+    return dict(params or {},
+                resolutions=sorted(resolutions),
+                time_bucket_length=time_bucket_length,
+                number_buckets_in_range=range_seconds // time_bucket_length)
+
+class _WindowTemplate:
+    # A scripted metric template whose requests search [start_millis, end_millis)
+    # in place of the template's fixed range.
+
+    def __init__(self, file_name: str, start_millis: int, end_millis: int):
+        self.template = read_scripted_metric.template(file_name)
+        self.file_name = self.template.file_name
+        self.start_millis = start_millis
+        self.end_millis = end_millis
+
+    def register(self, es):
+        self.template.register(es)
+
+    def request(self, params: dict = None):
+        body = self.template.request(params)
+        body['query'] = {'range': {'@timestamp': {'gte': self.start_millis, 'lt': self.end_millis}}}
+        return body
+
+def _state_entries(state: dict):
+    # The number of non-empty buckets, or runs of buckets for the sparse variant.
+    if 'starts' in state:
+        return len(state['starts'])
+    return sum(1 for count in state['counts'] if count > 0)
@@ -1,38 +1,175 @@
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import streaming_bulk
+from utils.bulk_index import BulkIndexer
+from utils.snapshot import DATE, KEYWORD, Snapshot, SnapshotWriter
+import itertools
+import json
+import numpy as np
 import random
 
 class Generator:
     INDEX_NAME = 'beaconing_demo'
     # 2021-06-01 00:00:00 in epoch milliseconds
     START_TIME = 1622505600000
+    # The fields of the documents and their snapshot column types.
+    FIELDS = {'@timestamp': DATE, 'tag': KEYWORD}
 
-    def __init__(self, user_name: str = '', password: str = ''):
-        if user_name != '' and password != '':
+    def __init__(self,
+                 user_name: str = '',
+                 password: str = '',
+                 thread_count: int = 4,
+                 es = None):
+        '''
+        @param es The client to use, for example a SimulatedElasticsearch. By default
+        a client for a local cluster is created.
+        '''
+        if es is not None:
+            self.es = es
+        elif user_name != '' and password != '':
             self.es = Elasticsearch(http_auth=(user_name, password))
         else:
             self.es = Elasticsearch()
+        self.bulk_indexer = BulkIndexer(self.es, thread_count=thread_count)
 
     def es_client(self):
         return self.es
 
-    def generate_and_index_demo_data(self):
+    def generate_and_index_demo_data(self,
+                                     vectorized: bool = False,
+                                     seed: int = None,
+                                     snapshot: str = None):
         '''
         Generate and index some demo data.
+
+        @param vectorized If true the documents are generated with NumPy and indexed
+        without creating a dictionary per document.
+        @param seed The seed for the random number generator used by vectorized mode
+        which makes the data set reproducible.
+        @param snapshot If supplied, the directory to which to write a snapshot of
+        the documents, see utils.snapshot.
         '''
         self.recreate_index()
-        self.generate_and_index_beacon('beacon_1m', [60000], 0.01)
-        self.generate_and_index_beacon('beacon_5m', [300000], 0.05)
-        self.generate_and_index_beacon('beacon_10m', [600000], 0.05)
-        self.generate_and_index_beacon('beacon_irregular', [300000, 180000], 0.01)
+
+        writer = SnapshotWriter(snapshot, Generator.FIELDS) if snapshot is not None else None
+
+        if vectorized:
+            rng = np.random.default_rng(seed)
+            batches = [
+                self.__serialize(['beacon_1m'], self.__periodic_with_jitter_times(rng, [60000], [0.01], 1000), writer),
+                self.__serialize(['beacon_5m'], self.__periodic_with_jitter_times(rng, [300000], [0.05], 1000), writer),
+                self.__serialize(['beacon_10m'], self.__periodic_with_jitter_times(rng, [600000], [0.05], 1000), writer),
+                self.__serialize(['beacon_irregular'],
+                                 self.__periodic_with_jitter_times(rng, [[300000, 180000]], [0.01], 1000), writer),
+                self.__serialize(['poisson_' + str(i) for i in range(1, 5)],
+                                 self.__poisson_process_times(rng, [300000] * 4, 1000), writer),
+                self.__serialize(['poisson_' + str(i) for i in range(5, 10)],
+                                 self.__poisson_process_times(rng, [10000] * 5, 6000), writer)
+            ]
+            stats = self.bulk_indexer.index_serialized(batches, index=Generator.INDEX_NAME)
+            if writer is not None:
+                writer.close()
+            print(stats)
+            return
+
+        # Index all the series through one pipeline so they are loaded concurrently.
+        streams = [
+            self.__periodic_with_jitter_generator('beacon_1m', [60000], 0.01, 1000),
+            self.__periodic_with_jitter_generator('beacon_5m', [300000], 0.05, 1000),
+            self.__periodic_with_jitter_generator('beacon_10m', [600000], 0.05, 1000),
+            self.__periodic_with_jitter_generator('beacon_irregular', [300000, 180000], 0.01, 1000)
+        ]
         for i in range(1, 5):
-            self.generate_and_index_poisson_process('poisson_' + str(i), 300000)
+            streams.append(self.__poisson_process_generator('poisson_' + str(i), 300000, 1000))
         for i in range(5, 10):
-            self.generate_and_index_poisson_process('poisson_' + str(i), 10000, 6000)
+            streams.append(self.__poisson_process_generator('poisson_' + str(i), 10000, 6000))
+
+        stream = itertools.chain(*streams)
+        if writer is not None:
+            stream = writer.tee(stream)
+        stats = self.bulk_indexer.index(stream, index=Generator.INDEX_NAME)
+        if writer is not None:
+            writer.close()
+        print(stats)
+
+    def index_snapshot(self, directory: str, number_shards: int = None):
+        '''
+        Recreate the index and index the documents of a snapshot written by one of
+        the generate methods, without generating them again.
+        '''
+        self.recreate_index(number_shards=number_shards)
+        data = Snapshot(directory)
+        stats = self.bulk_indexer.index_serialized(data.batches(),
+                                                   index=Generator.INDEX_NAME,
+                                                   number_docs=data.number_docs)
+        print(stats)
+        return stats
+
+    def generate_and_index_many_tags(self,
+                                     number_beacons: int = 1000,
+                                     number_poisson: int = 1000,
+                                     number: int = 1000,
+                                     seed: int = None,
+                                     report_progress: bool = False,
+                                     snapshot: str = None):
+        '''
+        Generate and index a mixture of many beaconing and Poisson process tags with
+        random parameters.
+
+        Beacons are named beacon_i and have periods which are a whole number of minutes
+        between 1 and 30 and jitter up to 5% of the period. Poisson processes are named
+        poisson_i and have mean intervals between 10 seconds and 10 minutes. Documents
+        are generated for batches of tags at once with NumPy.
+
+        @param number The number of documents to create for each tag.
+        @param seed The seed for the random number generator which makes the data set
+        reproducible.
+        @param snapshot If supplied, the directory to which to write a snapshot of
+        the documents, see utils.snapshot.
+        '''
+        writer = SnapshotWriter(snapshot, Generator.FIELDS) if snapshot is not None else None
+        batches = self.many_tags_batches(number_beacons, number_poisson, number, seed, writer)
+        stats = self.bulk_indexer.index_serialized(batches,
+                                                   index=Generator.INDEX_NAME,
+                                                   number_docs=(number_beacons + number_poisson) * number,
+                                                   report_progress=report_progress)
+        if writer is not None:
+            writer.close()
+        print(stats)
+        return stats
+
+    def many_tags_batches(self,
+                          number_beacons: int = 1000,
+                          number_poisson: int = 1000,
+                          number: int = 1000,
+                          seed: int = None,
+                          writer: SnapshotWriter = None):
+        '''
+        Generate the documents indexed by generate_and_index_many_tags as batches
+        of serialized documents without indexing them.
 
-    def recreate_index(self):
+        @param writer If supplied, the documents are also appended to this snapshot.
+        '''
+        rng = np.random.default_rng(seed)
+
+        # Bound the memory used by each batch.
+        batch_size = max(self.bulk_indexer.chunk_size // number, 1)
+
+        for start in range(0, number_beacons, batch_size):
+            tags = ['beacon_' + str(i) for i in range(start, min(start + batch_size, number_beacons))]
+            periods = 60000 * rng.integers(1, 31, size=(len(tags), 1))
+            jitters = rng.uniform(0, 0.05, size=len(tags))
+            yield self.__serialize(tags, self.__periodic_with_jitter_times(rng, periods, jitters, number), writer)
+        for start in range(0, number_poisson, batch_size):
+            tags = ['poisson_' + str(i) for i in range(start, min(start + batch_size, number_poisson))]
+            mean_intervals = rng.uniform(10000, 600000, size=len(tags))
+            yield self.__serialize(tags, self.__poisson_process_times(rng, mean_intervals, number), writer)
+
+    def recreate_index(self, number_shards: int = None, index: str = INDEX_NAME):
         '''
         Recreate the index containing the demo data.
+
+        @param number_shards The number of primary shards, by default the cluster's
+        default.
+        @param index The index to recreate with the demo data's mappings.
         '''
         mappings = {
             'mappings': {
@@ -45,9 +182,11 @@ class Generator:
                 }
             }
         }
+        if number_shards is not None:
+            mappings['settings'] = {'number_of_shards': number_shards}
 
-        self.es.indices.delete(index=Generator.INDEX_NAME, ignore=[400, 404])
-        self.es.indices.create(index=Generator.INDEX_NAME, ignore=400, body=mappings)
+        self.es.indices.delete(index=index, ignore=[400, 404])
+        self.es.indices.create(index=index, ignore=400, body=mappings)
 
     def generate_and_index_beacon(self,
                                   tag: str,
@@ -62,15 +201,11 @@ class Generator:
         should be in the range [0, 1].
         @param number The approximate number of documents to create.
         '''
-        counter = 0
-        last_progress = 0
-
         stream = self.__periodic_with_jitter_generator(tag, period, jitter, number)
-        for ok, response in streaming_bulk(self.es, actions=stream, chunk_size=number):
-            if not ok:
-                print(response)
-            if report_progress:
-                counter,last_progress = self.__report_progress(counter, number, last_progress)
+        return self.bulk_indexer.index(stream,
+                                       index=Generator.INDEX_NAME,
+                                       number_docs=number,
+                                       report_progress=report_progress)
 
     def generate_and_index_poisson_process(self,
                                            tag: str,
@@ -82,15 +217,11 @@ class Generator:
         
         @param: mean_interval The inverse rate in milliseconds.
         '''
-        counter = 0
-        last_progress = 0
         stream = self.__poisson_process_generator(tag, mean_interval, number)
-
-        for ok, response in streaming_bulk(self.es, actions=stream, chunk_size=number):
-            if not ok:
-                print(response)
-            if report_progress:
-                counter,last_progress = self.__report_progress(counter, number, last_progress)
+        return self.bulk_indexer.index(stream,
+                                       index=Generator.INDEX_NAME,
+                                       number_docs=number,
+                                       report_progress=report_progress)
 
     def __poisson_process_generator(self,
                                     tag: str,
@@ -121,11 +252,52 @@ class Generator:
             time = time + int(period[i] + random.uniform(-jitter, jitter) * period[i] + 0.5)
             i = (i + 1) % len(period)
 
-    def __report_progress(self,
-                          counter: int,
-                          number_docs: int,
-                          last_progress: int):
-        if counter / number_docs > last_progress + 0.05:
-            print(counter,'/', number_docs)
-            last_progress = last_progress + 0.05
-        return counter + 1, last_progress
+    def __periodic_with_jitter_times(self,
+                                     rng: np.random.Generator,
+                                     periods,
+                                     jitters,
+                                     number: int):
+        # Generate the times for a batch of periodic series. The periods are either
+        # one per series or a list per series which is cycled through.
+
+        periods = np.asarray(periods, dtype=np.float64)
+        if periods.ndim == 1:
+            periods = periods[:, None]
+        periods = np.tile(periods, (1, -(-number // periods.shape[1])))[:, :number]
+        jitters = np.asarray(jitters, dtype=np.float64)[:, None]
+
+        shape = (len(jitters), number)
+        intervals = (periods + rng.uniform(-1, 1, size=shape) * jitters * periods + 0.5).astype(np.int64)
+        return self.__times(intervals)
+
+    def __poisson_process_times(self,
+                                rng: np.random.Generator,
+                                mean_intervals,
+                                number: int):
+        # Generate the times for a batch of Poisson processes.
+
+        mean_intervals = np.asarray(mean_intervals, dtype=np.float64)[:, None]
+        intervals = rng.exponential(mean_intervals, size=(len(mean_intervals), number)).astype(np.int64)
+        return self.__times(intervals)
+
+    def __times(self, intervals: np.ndarray):
+        # Each series starts at START_TIME and is followed by the intervals.
+
+        times = np.empty_like(intervals)
+        times[:, 0] = Generator.START_TIME
+        np.cumsum(intervals[:, :-1], axis=1, out=times[:, 1:])
+        times[:, 1:] += Generator.START_TIME
+        return times
+
+    def __serialize(self, tags: list, times: np.ndarray, writer: SnapshotWriter = None):
+        # Serialize one row of times per tag as JSON documents.
+
+        if writer is not None:
+            writer.append({'@timestamp': times.reshape(-1),
+                           'tag': np.repeat(np.array(tags, dtype=object), times.shape[1])})
+
+        batch = []
+        for tag, row in zip(tags, times.tolist()):
+            prefix = '{"tag":' + json.dumps(tag) + ',"@timestamp":'
+            batch.extend([prefix + str(time) + '}' for time in row])
+        return batch
@@ -0,0 +1,267 @@
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+import numpy as np
+
+def beacon_statistics(counts,
+                      max_beaconing_cov: float = 0.1,
+                      min_beaconing_autocovariance: float = 0.7,
+                      max_jitter: float = 0.1,
+                      batch_size: int = 1024,
+                      processes: int = 1):
+    '''
+    Compute the beaconing test statistics for every row of a tags x buckets matrix
+    of document counts.
+
+    This is a vectorized reference implementation of the reduce_script in
+    scripted_metric_beacons.txt. Rows are grouped by the length of their trimmed
+    range, i.e. after dropping the empty and partial buckets at either end, so each
+    group shares the same window layout and all its rows are processed together.
+
+    @param counts A 2-D array of bucket counts with one row per tag.
+    @param batch_size The maximum number of rows to process in one step. This bounds
+    the size of the lagged product arrays.
+    @param processes If greater than one the batches are spread across a process pool.
+    @return A dictionary of arrays: is_beaconing, non_empty_buckets, mean, variance,
+    pearson and period. The period, in buckets, is the shortest whose autocovariance
+    is large enough for the row to be beaconing, or if there is none the period with
+    the largest autocovariance. Statistics which are not computed for a row are NaN.
+    '''
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    number_rows, number_buckets = counts.shape
+
+    results = {
+        'is_beaconing': np.zeros(number_rows, dtype=bool),
+        'non_empty_buckets': np.zeros(number_rows, dtype=np.int64),
+        'mean': np.full(number_rows, np.nan),
+        'variance': np.full(number_rows, np.nan),
+        'pearson': np.full(number_rows, np.nan),
+        'period': np.full(number_rows, np.nan)
+    }
+    if number_rows == 0:
+        return results
+
+    # Drop zero counts at start and end and first and last partial buckets to allow
+    # for signals which are intermittent. This matches firstComplete and lastComplete
+    # in the Painless script, including their behaviour for rows with no documents.
+    non_zero = counts > 0
+    any_non_zero = non_zero.any(axis=1)
+    a = np.where(any_non_zero, np.argmax(non_zero, axis=1) + 1, number_buckets + 1)
+    b = np.where(any_non_zero, number_buckets - np.argmax(non_zero[:, ::-1], axis=1) - 1, -1)
+    results['non_empty_buckets'] = b - a
+
+    # There are too few buckets to be confident in the test statistics.
+    tasks = []
+    for length in np.unique(results['non_empty_buckets']):
+        if length < 16:
+            continue
+        rows = np.flatnonzero(results['non_empty_buckets'] == length)
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            trimmed = counts[batch[:, None], a[batch][:, None] + np.arange(length)]
+            tasks.append((batch, trimmed))
+
+    arguments = (max_beaconing_cov, min_beaconing_autocovariance, max_jitter)
+    if processes > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_trimmed_statistics, trimmed, *arguments)
+                       for _, trimmed in tasks]
+            batch_results = [future.result() for future in futures]
+    else:
+        batch_results = [_trimmed_statistics(trimmed, *arguments) for _, trimmed in tasks]
+
+    for (batch, _), batch_result in zip(tasks, batch_results):
+        for key, value in batch_result.items():
+            results[key][batch] = value
+
+    return results
+
+def coarsen(counts, factor: int):
+    '''
+    Sum runs of factor adjacent buckets of each row of a tags x buckets matrix of
+    document counts, dropping a partial run at the end.
+    '''
+    counts = np.atleast_2d(np.asarray(counts))
+    number_buckets = counts.shape[1] // factor
+    return counts[:, :number_buckets * factor].reshape(counts.shape[0], number_buckets, factor).sum(axis=2)
+
+def multi_resolution_statistics(counts,
+                                time_bucket_length: int,
+                                resolutions: list,
+                                max_beaconing_cov: float = 0.1,
+                                min_beaconing_autocovariance: float = 0.7,
+                                max_jitter: float = 0.1,
+                                batch_size: int = 1024,
+                                processes: int = 1):
+    '''
+    Compute the beaconing test statistics at several resolutions for every row of a
+    tags x buckets matrix of document counts.
+
+    This is a reference implementation of the reduce_script in
+    scripted_metric_beacons_multi.txt. The counts at each resolution are found by
+    summing adjacent buckets of the finest counts.
+
+    @param counts A 2-D array of bucket counts with one row per tag.
+    @param time_bucket_length The length of the buckets of counts in seconds.
+    @param resolutions The bucket lengths in seconds at which to compute the
+    statistics. Each must be a multiple of time_bucket_length.
+    @return A list with the statistics of each row in the same format as the result
+    of the scripted metric aggregation.
+    '''
+    counts = np.atleast_2d(np.asarray(counts))
+    resolutions = sorted(resolutions)
+
+    levels = []
+    for resolution in resolutions:
+        statistics = beacon_statistics(coarsen(counts, resolution // time_bucket_length),
+                                       max_beaconing_cov=max_beaconing_cov,
+                                       min_beaconing_autocovariance=min_beaconing_autocovariance,
+                                       max_jitter=max_jitter,
+                                       batch_size=batch_size,
+                                       processes=processes)
+        levels.append((resolution, statistics))
+
+    results = []
+    for row in range(counts.shape[0]):
+        result = {'is_beaconing': False, 'resolutions': []}
+        best_score = -np.inf
+        for resolution, statistics in levels:
+            level = dict(resolution=resolution, **row_statistics(statistics, row))
+            if 'mean' in level:
+                # The period of a regular signal is shorter than a bucket and is
+                # estimated from the mean count per bucket.
+                if 'pearson' in level:
+                    level['period'] = resolution * int(statistics['period'][row])
+                else:
+                    level['period'] = resolution / level['mean']
+                # Prefer the finest resolution if several score equally.
+                score = level.get('pearson', 1.0)
+                if score > best_score:
+                    best_score = score
+                    result.update(is_beaconing=level['is_beaconing'],
+                                  resolution=resolution,
+                                  period=level['period'])
+            result['resolutions'].append(level)
+        results.append(result)
+
+    return results
+
+def bucket_counts(tags: np.ndarray,
+                  times: np.ndarray,
+                  number_tags: int,
+                  start_millis: int,
+                  bucket_millis: int = 60000,
+                  number_buckets: int = 360,
+                  chunk_size: int = 1 << 22):
+    '''
+    Count the documents of each tag in each time bucket, as the map_script does.
+
+    The columns are read in chunks, so they can be the memory mapped columns of a
+    utils.snapshot.Snapshot without loading them into memory.
+
+    @param tags The ordinal of each document's tag. Missing tags are -1.
+    @param times The epoch millisecond timestamp of each document.
+    @param number_tags The number of tag ordinals.
+    @param start_millis The start of the first bucket.
+    @return A tags x buckets matrix of document counts.
+    '''
+    counts = np.zeros(number_tags * number_buckets, dtype=np.int64)
+    for start in range(0, len(tags), chunk_size):
+        chunk_tags = np.asarray(tags[start:start + chunk_size], dtype=np.int64)
+        buckets = (np.asarray(times[start:start + chunk_size], dtype=np.int64) - start_millis) // bucket_millis
+        keep = (chunk_tags >= 0) & (buckets >= 0) & (buckets < number_buckets)
+        counts += np.bincount(chunk_tags[keep] * number_buckets + buckets[keep],
+                              minlength=number_tags * number_buckets)
+    return counts.reshape(number_tags, number_buckets)
+
+def row_statistics(results: dict, row: int):
+    '''
+    Extract the statistics for a single row in the same format as the result of the
+    scripted metric aggregation.
+    '''
+    statistics = {
+        'is_beaconing': bool(results['is_beaconing'][row]),
+        'non_empty_buckets': int(results['non_empty_buckets'][row])
+    }
+    if statistics['non_empty_buckets'] < 16:
+        return statistics
+
+    statistics['mean'] = float(results['mean'][row])
+    statistics['variance'] = float(results['variance'][row])
+    # The pearson statistic is NaN, rather than missing, for a constant signal.
+    if not statistics['is_beaconing'] or not np.isnan(results['pearson'][row]):
+        statistics['pearson'] = float(results['pearson'][row])
+    return statistics
+
+def _trimmed_statistics(counts: np.ndarray,
+                        max_beaconing_cov: float,
+                        min_beaconing_autocovariance: float,
+                        max_jitter: float):
+    # All rows of counts have the same length, which is at least 16.
+
+    number_rows, length = counts.shape
+
+    mean = counts.mean(axis=1)
+    variance = counts.var(axis=1)
+    pearson = np.full(number_rows, np.nan)
+    period = np.full(number_rows, np.nan)
+
+    # If the period less than the bucket interval then we expect to see low variation
+    # in the count per bucket. For Poisson process we expect the variance to be equal
+    # to the mean so this condition implies that the signal is much more regular than
+    # a Poisson process.
+    regular = variance < max_beaconing_cov * np.abs(mean)
+    rows = np.flatnonzero(~regular)
+
+    if len(rows) > 0:
+        autocovariances = _autocovariances(counts[rows] - mean[rows, None], max_jitter)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pearson[rows] = np.minimum(autocovariances.max(axis=1) / variance[rows], 1.0)
+        # The shortest period which is strong enough to be beaconing on its own, or
+        # failing that the strongest period.
+        strong = autocovariances >= min_beaconing_autocovariance * variance[rows, None]
+        period[rows] = np.where(strong.any(axis=1), strong.argmax(axis=1), autocovariances.argmax(axis=1)) + 2
+
+    return {
+        'is_beaconing': regular | (pearson >= min_beaconing_autocovariance),
+        'mean': mean,
+        'variance': variance,
+        'pearson': pearson,
+        'period': period
+    }
+
+def _autocovariances(centered: np.ndarray, max_jitter: float):
+    # Compute the jitter tolerant autocovariance for every period in [2, length / 4]
+    # and then average over multiples of each period.
+
+    number_rows, length = centered.shape
+    max_period = int(length / 4)
+
+    autocovariances = np.zeros((number_rows, max_period - 1))
+
+    for period in range(2, max_period + 1):
+
+        # Allow for jitter <= max_jitter of period.
+        jitter = int(max_jitter * period)
+
+        # The windows start at multiples of period and each needs period buckets
+        # followed by a shifted copy which can extend a further jitter buckets.
+        number_windows = len(range(0, length - 2 * period - jitter + 1, period))
+        span = number_windows * period
+
+        # shifted[:, k, j] = centered[:, k + period - jitter + j] for j in [0, 2 * jitter].
+        shifted = sliding_window_view(centered, 2 * jitter + 1, axis=1)
+        shifted = shifted[:, period - jitter:period - jitter + span, :]
+        shifted = shifted.reshape(number_rows, number_windows, period, 2 * jitter + 1)
+        windows = centered[:, :span].reshape(number_rows, number_windows, period)
+
+        window_sums = np.einsum('rwk,rwkj->rwj', windows, shifted)
+        autocovariances[:, period - 2] = window_sums.max(axis=2).sum(axis=1) / span
+
+    # We use the fact that if a signal is periodic with period p it will have high
+    # autocovariance for any shift i * p for integer i. So we average over the
+    # autocovariance for multiples of the period.
+    averaged = np.empty_like(autocovariances)
+    for i in range(autocovariances.shape[1]):
+        averaged[:, i] = autocovariances[:, i::i + 2].mean(axis=1)
+
+    return averaged
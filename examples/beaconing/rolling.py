@@ -0,0 +1,153 @@
+from elasticsearch_dsl import Search
+from examples.beaconing.generator import Generator
+from examples.beaconing.reference import beacon_statistics, row_statistics
+import numpy as np
+
+class RollingWindow:
+    '''
+    Re-evaluate beacon detection over a sliding window.
+
+    scripted_metric_beacons.txt scans the whole window on every run. Instead, this
+    keeps the bucket counts of every tag in a tags x buckets matrix and each update
+    only queries the buckets which have completed since the last update. The matrix
+    is shifted forward by the number of new buckets, the new counts are written to
+    its end and the test statistics are recomputed locally by reference.py. So the
+    cost of the query depends on the amount of new data rather than on the length
+    of the window.
+
+    The counts for the last overlap_buckets buckets are queried again on every update
+    and replace the cached counts, which allows for documents which arrive late.
+    '''
+    def __init__(self,
+                 es,
+                 index: str = Generator.INDEX_NAME,
+                 time_field: str = '@timestamp',
+                 number_buckets: int = 360,
+                 bucket_millis: int = 60000,
+                 overlap_buckets: int = 1,
+                 page_size: int = 10000):
+        '''
+        @param number_buckets The number of buckets in the window.
+        @param bucket_millis The length of each bucket in milliseconds.
+        @param overlap_buckets The number of trailing buckets which are queried again
+        on each update.
+        @param page_size The number of (tag, bucket) pairs to read in each request.
+        '''
+        self.es = es
+        self.index = index
+        self.time_field = time_field
+        self.number_buckets = number_buckets
+        self.bucket_millis = bucket_millis
+        self.overlap_buckets = overlap_buckets
+        self.page_size = page_size
+        self.end_millis = None
+        self.tags = []
+        self.rows = {}
+        self.counts = np.zeros((0, number_buckets), dtype=np.int32)
+
+    def update(self, end_millis: int):
+        '''
+        Advance the window so it ends at end_millis, which is rounded down to a whole
+        number of buckets, and read the counts for the new buckets.
+
+        @return The number of buckets which were queried.
+        '''
+        end_millis = end_millis - end_millis % self.bucket_millis
+        window_start_millis = end_millis - self.number_buckets * self.bucket_millis
+
+        if self.end_millis is None:
+            start_millis = window_start_millis
+        else:
+            if end_millis < self.end_millis:
+                raise ValueError('The window can\'t move backwards: ' +
+                                 str(end_millis) + ' < ' + str(self.end_millis))
+            self.__shift((end_millis - self.end_millis) // self.bucket_millis)
+            start_millis = max(self.end_millis - self.overlap_buckets * self.bucket_millis,
+                               window_start_millis)
+        self.end_millis = end_millis
+
+        # The queried buckets are replaced rather than added to so that reading the
+        # overlap again doesn't double count.
+        first = (start_millis - window_start_millis) // self.bucket_millis
+        self.counts[:, first:] = 0
+
+        for tag, key, count in self.__read(start_millis, end_millis):
+            row = self.rows.get(tag)
+            if row is None:
+                row = self.__add_tag(tag)
+            self.counts[row, (key - window_start_millis) // self.bucket_millis] = count
+
+        return self.number_buckets - first
+
+    def statistics(self, processes: int = 1, **kwargs):
+        '''
+        Compute the beacon statistics for every tag in the window.
+
+        @param processes The number of processes to use to compute the statistics.
+        @param kwargs The thresholds of beacon_statistics, for example max_jitter.
+        @return A dictionary of the statistics keyed by tag in the same format as the
+        result of the scripted metric aggregation.
+        '''
+        results = beacon_statistics(self.counts[:len(self.tags)], processes=processes, **kwargs)
+        return {tag: row_statistics(results, row) for row, tag in enumerate(self.tags)}
+
+    def __shift(self, number_buckets: int):
+        # Move the counts number_buckets buckets earlier and drop the tags which no
+        # longer have any documents in the window.
+        if number_buckets >= self.number_buckets:
+            self.counts[:] = 0
+        elif number_buckets > 0:
+            self.counts[:, :-number_buckets] = self.counts[:, number_buckets:]
+            self.counts[:, -number_buckets:] = 0
+
+        keep = np.flatnonzero(self.counts[:len(self.tags)].any(axis=1))
+        if len(keep) < len(self.tags):
+            self.counts = self.counts[keep]
+            self.tags = [self.tags[row] for row in keep]
+            self.rows = {tag: row for row, tag in enumerate(self.tags)}
+
+    def __add_tag(self, tag: str):
+        # Grow the counts matrix geometrically so adding tags is amortized constant
+        # time.
+        row = len(self.tags)
+        if row == len(self.counts):
+            counts = np.zeros((max(2 * row, 16), self.number_buckets), dtype=self.counts.dtype)
+            counts[:row] = self.counts[:row]
+            self.counts = counts
+        self.tags.append(tag)
+        self.rows[tag] = row
+        return row
+
+    def __read(self, start_millis: int, end_millis: int):
+        # Yield (tag, bucket key, count) for every non-empty bucket in the range using
+        # a composite aggregation so any number of tags can be read.
+        body = {
+            'size': 0,
+            'query': {
+                'range': {
+                    self.time_field: {
+                        'gte': start_millis,
+                        'lt': end_millis
+                    }
+                }
+            },
+            'aggs': {
+                'counts': {
+                    'composite': {
+                        'size': self.page_size,
+                        'sources': [
+                            {'tag': {'terms': {'field': 'tag'}}},
+                            {'time': {'date_histogram': {'field': self.time_field,
+                                                         'fixed_interval': str(self.bucket_millis) + 'ms'}}}
+                        ]
+                    }
+                }
+            }
+        }
+        while True:
+            result = Search.from_dict(body).using(self.es).index(self.index).execute()
+            for bucket in result.aggregations.counts.buckets:
+                yield bucket.key.tag, bucket.key.time, bucket.doc_count
+            if len(result.aggregations.counts.buckets) < self.page_size:
+                return
+            body['aggs']['counts']['composite']['after'] = result.aggregations.counts.after_key.to_dict()
@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from elasticsearch_dsl import Search
+from examples.beaconing.generator import Generator
+import utils.read_scripted_metric as read_scripted_metric
+
+class Runner:
+    '''
+    Run beacon detection over any number of tags.
+
+    The scripted_metric_beacons.txt request computes the beacon statistics for the
+    top tags of a terms aggregation, so scoring every tag would need a single huge
+    response and reduce on the coordinating node. Instead, this pages through the
+    tags with a composite aggregation and runs up to max_concurrent_pages pages at
+    once. Each page is a separate request with page_size tags so the memory and
+    latency of each request are independent of the total number of tags.
+
+    The after key of every page is found by paging through the tags with the same
+    composite aggregation, but without the scripted metric, which is cheap. This
+    runs ahead of the scripted metric requests so pages can be scored in parallel.
+    '''
+    def __init__(self,
+                 es,
+                 index: str = Generator.INDEX_NAME,
+                 scripted_metric: str = 'examples/beaconing/scripted_metric_beacons.txt',
+                 page_size: int = 1000,
+                 max_concurrent_pages: int = 4):
+        self.es = es
+        self.index = index
+        self.page_size = page_size
+        self.max_concurrent_pages = max_concurrent_pages
+        self.template = read_scripted_metric.template(scripted_metric)
+
+    def run(self, params: dict = None):
+        '''
+        Find the beacon statistics for every tag.
+
+        This is a generator which yields (tag, statistics) pairs as the pages which
+        contain them complete, so the results for all tags never need to be held in
+        memory at once.
+
+        @param params Overrides for the scripted metric params.
+        '''
+        self.template.register(self.es)
+        body = self.template.request(params)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_pages) as executor:
+            pending = set()
+            for after in self.__page_starts(body['query']):
+                pending.add(executor.submit(self.__run_page, body, after))
+                if len(pending) >= self.max_concurrent_pages:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+            for future in pending:
+                yield from future.result()
+
+    def __page_starts(self, query: dict):
+        # Yield the after key for each page of tags, None for the first page.
+
+        body = {
+            'size': 0,
+            'query': query,
+            'aggs': {'process': {'composite': self.__composite(None)}}
+        }
+        after = None
+        while True:
+            yield after
+            body['aggs']['process']['composite'] = self.__composite(after)
+            result = Search.from_dict(body).using(self.es).index(self.index).execute()
+            if len(result.aggregations.process.buckets) < self.page_size:
+                return
+            after = result.aggregations.process.after_key.to_dict()
+
+    def __run_page(self, body: dict, after: dict):
+        body = dict(body)
+        body['aggs'] = {
+            'process': {
+                'composite': self.__composite(after),
+                'aggs': body['aggs']['process']['aggs']
+            }
+        }
+        result = Search.from_dict(body).using(self.es).index(self.index).execute()
+        return [(bucket.key.tag, bucket.beacon_stats.value.to_dict())
+                for bucket in result.aggregations.process.buckets]
+
+    def __composite(self, after: dict):
+        composite = {
+            'size': self.page_size,
+            'sources': [{'tag': {'terms': {'field': 'tag'}}}]
+        }
+        if after is not None:
+            composite['after'] = after
+        return composite
@@ -0,0 +1,90 @@
+from examples.beaconing.demo import MULTI_RESOLUTION, SCRIPTED_METRICS
+from examples.beaconing.reference import beacon_statistics, multi_resolution_statistics, row_statistics
+import numpy as np
+
+class BeaconStatistics:
+    '''
+    A Python equivalent of the beaconing scripted metrics for SimulatedElasticsearch.
+
+    The map step receives the doc values of all the shard's documents in the bucket
+    at once so it can be vectorized. The statistics are computed by reference.py.
+    For the prefix_sums variant the pearson statistic is always the maximum, i.e.
+    as if stop_early were false.
+    '''
+    def init(self, params: dict):
+        return {'counts': np.zeros(params['number_buckets_in_range'], dtype=np.int64)}
+
+    def map(self, state: dict, params: dict, doc):
+        # Painless truncates the bucket index towards zero.
+        seconds = np.floor(doc[params['time_field']] / 1000) - params['range_start_millis']
+        buckets = np.fix(seconds / params['time_bucket_length'])
+        buckets = buckets[(buckets >= 0) & (buckets < len(state['counts']))].astype(np.int64)
+        state['counts'] += np.bincount(buckets, minlength=len(state['counts']))
+        return state
+
+    def combine(self, state: dict, params: dict):
+        if 'state' in params:
+            state['bytes'] = _state_bytes(state['counts'], params)
+        return state
+
+    def reduce(self, states: list, params: dict):
+        counts = np.zeros(params['number_buckets_in_range'], dtype=np.int64)
+        for state in states:
+            counts += state['counts']
+        statistics = _skipped_statistics(counts, params) if 'max_sparse_fraction' in params else None
+        if statistics is not None:
+            statistics['state_bytes'] = [state['bytes'] for state in states]
+            return statistics
+        statistics = row_statistics(beacon_statistics(counts,
+                                                      max_beaconing_cov=params['max_beaconing_cov'],
+                                                      min_beaconing_autocovariance=params['min_beaconing_autocovariance'],
+                                                      max_jitter=params.get('max_jitter', 0.1)), 0)
+        if 'state' in params:
+            statistics['state_bytes'] = [state['bytes'] for state in states]
+        return statistics
+
+class MultiResolutionStatistics(BeaconStatistics):
+    '''
+    A Python equivalent of scripted_metric_beacons_multi.txt. The map step is the
+    same as the other variants' at the finest resolution.
+    '''
+    def reduce(self, states: list, params: dict):
+        counts = np.zeros(params['number_buckets_in_range'], dtype=np.int64)
+        for state in states:
+            counts += state['counts']
+        return multi_resolution_statistics(counts,
+                                           params['time_bucket_length'],
+                                           params['resolutions'],
+                                           max_beaconing_cov=params['max_beaconing_cov'],
+                                           min_beaconing_autocovariance=params['min_beaconing_autocovariance'],
+                                           max_jitter=params['max_jitter'])[0]
+
+def _state_bytes(counts: np.ndarray, params: dict):
+    # The estimated size of the shard state of scripted_metric_beacons_sparse.txt.
+    non_empty = int(np.count_nonzero(counts))
+    if params['state'] == 'sparse' or (
+        params['state'] == 'auto' and non_empty <= params['max_sparse_fraction'] * len(counts)):
+        return 64 * non_empty
+    return (4 if counts.max(initial=0) > np.iinfo(np.int16).max else 2) * len(counts)
+
+def _skipped_statistics(counts: np.ndarray, params: dict):
+    # The statistics of scripted_metric_beacons_sparse.txt for tags which skip the
+    # autocovariance test because too few buckets of their trimmed range are
+    # non-empty, or None if the tag isn't skipped.
+    non_zero = np.flatnonzero(counts)
+    if len(non_zero) == 0 or non_zero[-1] - non_zero[0] - 1 < 16:
+        return None
+    trimmed = counts[non_zero[0] + 1:non_zero[-1]]
+    mean = trimmed.mean()
+    variance = trimmed.var()
+    if (variance < params['max_beaconing_cov'] * abs(mean) or
+        np.count_nonzero(trimmed) >= params['max_sparse_fraction'] * len(trimmed)):
+        return None
+    return {'is_beaconing': False,
+            'non_empty_buckets': len(trimmed),
+            'mean': float(mean),
+            'variance': float(variance),
+            'autocovariance_skipped': True}
+
+SCRIPTS = {file_name: BeaconStatistics for file_name in SCRIPTED_METRICS.values()}
+SCRIPTS[MULTI_RESOLUTION] = MultiResolutionStatistics
@@ -0,0 +1,207 @@
+from concurrent.futures import ThreadPoolExecutor
+from examples.beaconing.generator import Generator
+from examples.beaconing.reference import beacon_statistics, row_statistics
+import numpy as np
+import sys
+import time
+
+class BucketCounts:
+    '''
+    The document counts of each tag in each time bucket of a fixed window, updated
+    online from batches of documents.
+
+    The counts are a tags x buckets matrix, whose rows are added as new tags are
+    seen, so the memory used depends on the number of tags and buckets rather than
+    the number of documents.
+    '''
+    def __init__(self,
+                 start_millis: int,
+                 number_buckets: int = 360,
+                 bucket_millis: int = 60000):
+        self.start_millis = start_millis
+        self.number_buckets = number_buckets
+        self.bucket_millis = bucket_millis
+        self.tags = []
+        self.rows = {}
+        self.counts = np.zeros((0, number_buckets), dtype=np.int32)
+
+    def add(self, tags: list, times: np.ndarray):
+        '''
+        Count a batch of documents. Documents without a tag or outside the window
+        are ignored.
+
+        @param tags The tag of each document, or None if it is missing.
+        @param times The epoch millisecond timestamp of each document.
+        '''
+        buckets = (np.asarray(times, dtype=np.int64) - self.start_millis) // self.bucket_millis
+        rows = np.fromiter((-1 if tag is None else self.__row(tag) for tag in tags), dtype=np.int64, count=len(tags))
+        keep = (rows >= 0) & (buckets >= 0) & (buckets < self.number_buckets)
+        np.add.at(self.counts, (rows[keep], buckets[keep]), 1)
+
+    def merge(self, other: 'BucketCounts'):
+        '''
+        Add the counts of other, which must have the same window.
+        '''
+        if (other.start_millis, other.number_buckets, other.bucket_millis) != \
+           (self.start_millis, self.number_buckets, self.bucket_millis):
+            raise ValueError('Can\'t merge the counts of different windows')
+        rows = np.array([self.__row(tag) for tag in other.tags], dtype=np.int64)
+        self.counts[rows] += other.counts[:len(other.tags)]
+
+    def state_bytes(self):
+        '''
+        The bytes allocated for the counts matrix.
+        '''
+        return self.counts.nbytes
+
+    def statistics(self, processes: int = 1, **kwargs):
+        '''
+        Compute the beacon statistics for every tag.
+
+        @param processes The number of processes to use to compute the statistics.
+        @param kwargs The thresholds of beacon_statistics, for example max_jitter.
+        @return A dictionary of the statistics keyed by tag in the same format as the
+        result of the scripted metric aggregation.
+        '''
+        results = beacon_statistics(self.counts[:len(self.tags)], processes=processes, **kwargs)
+        return {tag: row_statistics(results, row) for row, tag in enumerate(self.tags)}
+
+    def __row(self, tag: str):
+        # Grow the counts matrix geometrically so adding tags is amortized constant
+        # time.
+        row = self.rows.get(tag)
+        if row is None:
+            row = len(self.tags)
+            if row == len(self.counts):
+                counts = np.zeros((max(2 * row, 16), self.number_buckets), dtype=self.counts.dtype)
+                counts[:row] = self.counts[:row]
+                self.counts = counts
+            self.tags.append(tag)
+            self.rows[tag] = row
+        return row
+
+class StreamingDetector:
+    '''
+    Detect beacons without scripts, for clusters which set script.allowed_types to
+    none.
+
+    The tag and timestamp of every document in the window are read as doc values,
+    without their _source, through a point in time with search_after. The point in
+    time is split into slices which are read in parallel. Each slice is a pipeline
+    of generators, which pages through the hits, converts each page to columns and
+    adds them to the slice's BucketCounts, so at most one page per slice is held in
+    memory. The slices' counts are merged at the end and the test statistics are
+    computed as the reduce_script of scripted_metric_beacons.txt does.
+    '''
+    def __init__(self,
+                 es,
+                 index: str = Generator.INDEX_NAME,
+                 time_field: str = '@timestamp',
+                 tag_field: str = 'tag',
+                 number_buckets: int = 360,
+                 bucket_millis: int = 60000,
+                 slices: int = 4,
+                 page_size: int = 10000,
+                 keep_alive: str = '5m'):
+        '''
+        @param number_buckets The number of buckets in the window.
+        @param bucket_millis The length of each bucket in milliseconds.
+        @param slices The number of slices to read in parallel.
+        @param page_size The number of documents to read in each request.
+        @param keep_alive How long the point in time is kept between requests.
+        '''
+        self.es = es
+        self.index = index
+        self.time_field = time_field
+        self.tag_field = tag_field
+        self.number_buckets = number_buckets
+        self.bucket_millis = bucket_millis
+        self.slices = slices
+        self.page_size = page_size
+        self.keep_alive = keep_alive
+
+    def run(self, start_millis: int = Generator.START_TIME, processes: int = 1, **kwargs):
+        '''
+        Find the beacons in the window starting at start_millis.
+
+        @param processes The number of processes to use to compute the statistics.
+        @param kwargs The thresholds of beacon_statistics, for example max_jitter.
+        @return A dictionary of the statistics keyed by tag in the same format as the
+        result of the scripted metric aggregation and a list with the docs, pages,
+        seconds, docs_per_second, state_bytes and max_page_bytes, the bytes of the
+        largest page's columns, of each slice.
+        '''
+        pit_id = self.es.open_point_in_time(index=self.index, keep_alive=self.keep_alive)['id']
+        try:
+            with ThreadPoolExecutor(max_workers=self.slices) as executor:
+                futures = [executor.submit(self.__count_slice, pit_id, slice_id, start_millis)
+                           for slice_id in range(self.slices)]
+                results = [future.result() for future in futures]
+        finally:
+            self.es.close_point_in_time(body={'id': pit_id})
+
+        counts = BucketCounts(start_millis, self.number_buckets, self.bucket_millis)
+        for slice_counts, _ in results:
+            counts.merge(slice_counts)
+
+        return counts.statistics(processes=processes, **kwargs), [stats for _, stats in results]
+
+    def __count_slice(self, pit_id: str, slice_id: int, start_millis: int):
+        start = time.perf_counter()
+        counts = BucketCounts(start_millis, self.number_buckets, self.bucket_millis)
+        stats = {'slice': slice_id, 'docs': 0, 'pages': 0, 'max_page_bytes': 0}
+        for tags, times in self.__columns(self.__pages(pit_id, slice_id, start_millis)):
+            counts.add(tags, times)
+            stats['docs'] += len(times)
+            stats['pages'] += 1
+            # The raw hits of a page are dropped once they are converted, so this
+            # and the counts bound the memory the slice holds.
+            page_bytes = times.nbytes + sum(sys.getsizeof(tag) for tag in tags)
+            stats['max_page_bytes'] = max(stats['max_page_bytes'], page_bytes)
+        stats['seconds'] = time.perf_counter() - start
+        stats['docs_per_second'] = stats['docs'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+        stats['state_bytes'] = counts.state_bytes()
+        return counts, stats
+
+    def __columns(self, pages):
+        # Convert each page of hits to a list of tags and an array of timestamps.
+        for hits in pages:
+            tags = []
+            times = np.empty(len(hits), dtype=np.int64)
+            for i, hit in enumerate(hits):
+                fields = hit.get('fields', {})
+                tags.append(fields[self.tag_field][0] if self.tag_field in fields else None)
+                times[i] = int(fields[self.time_field][0]) if self.time_field in fields else -1
+            yield tags, times
+
+    def __pages(self, pit_id: str, slice_id: int, start_millis: int):
+        # Yield the hits of each page of one slice of the window in _shard_doc order,
+        # which is the cheapest order to read.
+        body = {
+            'size': self.page_size,
+            'query': {
+                'range': {
+                    self.time_field: {
+                        'gte': start_millis,
+                        'lt': start_millis + self.number_buckets * self.bucket_millis
+                    }
+                }
+            },
+            '_source': False,
+            'docvalue_fields': [self.tag_field, {'field': self.time_field, 'format': 'epoch_millis'}],
+            'sort': ['_shard_doc'],
+            'track_total_hits': False,
+            'pit': {'id': pit_id, 'keep_alive': self.keep_alive}
+        }
+        if self.slices > 1:
+            body['slice'] = {'id': slice_id, 'max': self.slices}
+        while True:
+            result = self.es.search(body=body)
+            hits = result['hits']['hits']
+            if len(hits) > 0:
+                yield hits
+            if len(hits) < self.page_size:
+                return
+            # The point in time id can change between requests.
+            body['pit']['id'] = result.get('pit_id', body['pit']['id'])
+            body['search_after'] = hits[-1]['sort']
@@ -1,32 +1,330 @@
 from elasticsearch_dsl import Search
+from examples.beaconing.demo import MULTI_RESOLUTION, SCRIPTED_METRICS, STATES, resolution_params
 from examples.beaconing.generator import Generator
+from examples.beaconing.reference import beacon_statistics, bucket_counts, multi_resolution_statistics, row_statistics
+from examples.beaconing.streaming import StreamingDetector
+from utils.snapshot import Snapshot
 import numpy as np
 import utils.read_scripted_metric as read_scripted_metric
 
+# The index of the documents indexed by test_sparse_bounded.
+SPARSE_INDEX_NAME = 'beaconing_sparse'
+
 class Test:
     def __init__(self,
                  user_name: str = '',
-                 password: str = ''):
-        self.generator = Generator(user_name, password)
+                 password: str = '',
+                 es = None):
+        self.generator = Generator(user_name, password, es=es)
 
     def es_client(self):
         return self.generator.es_client()
 
-    def setup_generated(self):
+    def setup_generated(self, snapshot: str = None):
         '''
         Generate some data used for testing.
 
         This isn't run as part setup because it relatively heavyweight.
+
+        @param snapshot If supplied, the directory to which to write a snapshot of the
+        generated documents.
         '''
-        self.generator.generate_and_index_demo_data()
+        self.generator.generate_and_index_demo_data(snapshot=snapshot)
 
-    def test_generated(self):
+    def test_generated(self, snapshot: str = None):
         '''
         Test the beaconing detection scipted metric aggregation on the data set
         generated by setup_generated vs a python reference implementation.
+
+        @param snapshot If supplied, the directory of the snapshot written by
+        setup_generated from which to compute the expected bucket counts. Otherwise
+        they are read from the index.
+        '''
+        es = self.es_client()
+
+        if snapshot is not None:
+            data = Snapshot(snapshot)
+            tags = data.dictionary('tag')
+            counts = bucket_counts(data.column('tag'), data.column('@timestamp'), len(tags), Generator.START_TIME)
+        else:
+            tags, counts = self.__read_bucket_counts(es)
+
+        statistics = beacon_statistics(counts)
+        expected_results = {tag: row_statistics(statistics, row) for row, tag in enumerate(tags)}
+
+        template = read_scripted_metric.template(SCRIPTED_METRICS['direct'])
+        template.register(es)
+        scripted_metric_query_body = template.request()
+        actual_results = Search.from_dict(scripted_metric_query_body).using(es).index('beaconing_demo').execute()
+
+        failed = False
+
+        for bucket in actual_results.aggregations.process.buckets:
+            expected_result = expected_results[bucket.key]
+            if (self.__assert_equal(bucket.beacon_stats.value.is_beaconing, expected_result['is_beaconing']) or
+                self.__assert_equal(bucket.beacon_stats.value.non_empty_buckets, expected_result['non_empty_buckets']) or
+                self.__assert_close(bucket.beacon_stats.value.mean, expected_result['mean'], 1e-4) or
+                self.__assert_close(bucket.beacon_stats.value.variance, expected_result['variance'], 1e-4) or
+                ('pearson' in expected_result and
+                 self.__assert_close(bucket.beacon_stats.value.pearson, expected_result['pearson'], 1e-4))):
+                print('mismatch:\n', expected_result, '\nvs\n', bucket.beacon_stats.value.to_dict())
+                failed = True
+                break
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def test_prefix_sums(self):
+        '''
+        Test the prefix_sums beaconing scripted metric vs the direct one on the data
+        set generated by setup_generated.
+
+        Without early stopping every statistic should match. With early stopping the
+        pearson statistic of beaconing tags is only a lower bound, so we just check
+        the decisions match.
+        '''
+        es = self.es_client()
+
+        results = {}
+        for variant, params in [('direct', None),
+                                ('prefix_sums', {'stop_early': False}),
+                                ('prefix_sums_stop_early', {'stop_early': True})]:
+            template = read_scripted_metric.template(SCRIPTED_METRICS[variant.replace('_stop_early', '')])
+            template.register(es)
+            result = Search.from_dict(template.request(params)).using(es).index(Generator.INDEX_NAME).execute()
+            results[variant] = {bucket.key: bucket.beacon_stats.value.to_dict()
+                                for bucket in result.aggregations.process.buckets}
+
+        failed = False
+
+        for tag, expected_result in results['direct'].items():
+            actual_result = results['prefix_sums'][tag]
+            stop_early_result = results['prefix_sums_stop_early'][tag]
+            if (self.__assert_equal(set(actual_result.keys()), set(expected_result.keys())) or
+                any(self.__assert_close(actual_result[key], expected_result[key], 1e-8)
+                    for key in ['non_empty_buckets', 'mean', 'variance', 'pearson'] if key in expected_result) or
+                self.__assert_equal(actual_result['is_beaconing'], expected_result['is_beaconing']) or
+                self.__assert_equal(stop_early_result['is_beaconing'], expected_result['is_beaconing'])):
+                print('mismatch for', tag, ':\n', expected_result, '\nvs\n', actual_result, '\nand\n', stop_early_result)
+                failed = True
+                break
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def test_sparse(self):
+        '''
+        Test the sparse beaconing scripted metric vs the direct one, for every shard
+        state representation, on the data set generated by setup_generated.
+        '''
+        es = self.es_client()
+
+        results = {}
+        for variant, params in [('direct', None)] + [('sparse', {'state': state, 'stop_early': False})
+                                                     for state in STATES]:
+            template = read_scripted_metric.template(SCRIPTED_METRICS[variant])
+            template.register(es)
+            result = Search.from_dict(template.request(params)).using(es).index(Generator.INDEX_NAME).execute()
+            results[variant if params is None else params['state']] = {
+                bucket.key: bucket.beacon_stats.value.to_dict()
+                for bucket in result.aggregations.process.buckets
+            }
+
+        failed = False
+
+        for state in STATES:
+            for tag, expected_result in results['direct'].items():
+                actual_result = results[state][tag]
+                if (self.__assert_equal(set(actual_result.keys()), set(expected_result.keys()) | {'state_bytes'}) or
+                    self.__assert_equal(actual_result['is_beaconing'], expected_result['is_beaconing']) or
+                    any(self.__assert_close(actual_result[key], expected_result[key], 1e-8)
+                        for key in ['non_empty_buckets', 'mean', 'variance', 'pearson'] if key in expected_result)):
+                    print('mismatch for', tag, 'with', state, 'state:\n', expected_result, '\nvs\n', actual_result)
+                    failed = True
+                    break
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def test_sparse_bounded(self,
+                            number_buckets: int = 2600000,
+                            number_events: int = 40,
+                            number_tags: int = 3,
+                            seed: int = 0):
+        '''
+        Test the sparse beaconing scripted metric on tags with a few events spread
+        over a very long range. Their shard states should stay sparse and the reduce
+        should skip the autocovariance test, which would need dense arrays the size of
+        the range.
+
+        This indexes its own documents in SPARSE_INDEX_NAME.
+
+        @param number_buckets The number of one minute buckets in the range.
+        @param number_events The number of events of each tag.
+        '''
+        es = self.es_client()
+        rng = np.random.default_rng(seed)
+
+        self.generator.recreate_index(index=SPARSE_INDEX_NAME)
+        buckets = {'sparse_' + str(i): np.sort(rng.choice(number_buckets, number_events, replace=False))
+                   for i in range(number_tags)}
+        self.generator.bulk_indexer.index(({'_index': SPARSE_INDEX_NAME,
+                                            'tag': tag,
+                                            '@timestamp': Generator.START_TIME + int(bucket) * 60000}
+                                           for tag, tag_buckets in buckets.items() for bucket in tag_buckets),
+                                          index=SPARSE_INDEX_NAME,
+                                          number_docs=number_tags * number_events)
+
+        template = read_scripted_metric.template(SCRIPTED_METRICS['sparse'])
+        template.register(es)
+        body = template.request({'number_buckets_in_range': number_buckets, 'state': 'auto'})
+        body['query'] = {'range': {'@timestamp': {'gte': Generator.START_TIME,
+                                                  'lt': Generator.START_TIME + number_buckets * 60000}}}
+        result = Search.from_dict(body).using(es).index(SPARSE_INDEX_NAME).execute()
+        actual_results = {bucket.key: bucket.beacon_stats.value.to_dict()
+                          for bucket in result.aggregations.process.buckets}
+
+        failed = self.__assert_equal(set(actual_results.keys()), set(buckets.keys()))
+        if failed:
+            print('mismatch:', sorted(actual_results.keys()), 'vs', sorted(buckets.keys()))
+
+        for tag, tag_buckets in buckets.items():
+            if failed:
+                break
+            actual_result = actual_results[tag]
+            if (self.__assert_equal(actual_result.get('autocovariance_skipped'), True) or
+                self.__assert_equal(actual_result['is_beaconing'], False) or
+                self.__assert_equal(actual_result['non_empty_buckets'], int(tag_buckets[-1] - tag_buckets[0] - 1)) or
+                # Every shard state is a map entry per non-empty bucket.
+                self.__assert_equal(max(actual_result['state_bytes']) <= 64 * number_events, True)):
+                print('mismatch for', tag, ':', actual_result)
+                failed = True
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def test_resolutions(self, resolutions: list = [10, 60, 300]):
+        '''
+        Test the multiple resolution beaconing scripted metric on the data set
+        generated by setup_generated vs a python reference implementation.
+
+        @param resolutions The bucket lengths in seconds at which to look for beacons.
+        '''
+        es = self.es_client()
+
+        params = resolution_params(resolutions)
+        tags, counts = self.__read_bucket_counts(es, params['time_bucket_length'])
+        expected_results = dict(zip(tags, multi_resolution_statistics(counts,
+                                                                      params['time_bucket_length'],
+                                                                      params['resolutions'])))
+
+        template = read_scripted_metric.template(MULTI_RESOLUTION)
+        template.register(es)
+        actual_results = Search.from_dict(template.request(params)).using(es).index(Generator.INDEX_NAME).execute()
+
+        failed = False
+
+        for bucket in actual_results.aggregations.process.buckets:
+            expected_result = expected_results[bucket.key]
+            actual_result = bucket.beacon_stats.value.to_dict()
+            if (self.__assert_equal(actual_result['is_beaconing'], expected_result['is_beaconing']) or
+                self.__assert_equal(actual_result.get('resolution'), expected_result.get('resolution')) or
+                ('period' in expected_result and
+                 self.__assert_close(actual_result['period'], expected_result['period'], 1e-4)) or
+                self.__assert_equal(len(actual_result['resolutions']), len(expected_result['resolutions'])) or
+                any(self.__assert_equal(set(actual_level.keys()), set(expected_level.keys())) or
+                    self.__assert_equal(actual_level['is_beaconing'], expected_level['is_beaconing']) or
+                    any(self.__assert_close(actual_level[key], expected_level[key], 1e-4)
+                        for key in ['resolution', 'non_empty_buckets', 'mean', 'variance', 'pearson', 'period']
+                        if key in expected_level)
+                    for actual_level, expected_level in zip(actual_result['resolutions'], expected_result['resolutions']))):
+                print('mismatch for', bucket.key, ':\n', expected_result, '\nvs\n', actual_result)
+                failed = True
+                break
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def test_streaming(self, slices: int = 3, page_size: int = 1000):
+        '''
+        Test the streaming beacon detection on the data set generated by
+        setup_generated vs the python reference implementation on the bucket counts
+        of a date histogram aggregation.
+
+        @param slices The number of slices of the point in time to read.
+        @param page_size The number of documents to read in each request.
         '''
         es = self.es_client()
 
+        tags, counts = self.__read_bucket_counts(es)
+        statistics = beacon_statistics(counts)
+        expected_results = {tag: row_statistics(statistics, row) for row, tag in enumerate(tags)}
+
+        actual_results, slice_stats = StreamingDetector(es, slices=slices, page_size=page_size).run()
+
+        failed = (self.__assert_equal(set(actual_results.keys()), set(expected_results.keys())) or
+                  self.__assert_equal(sum(stats['docs'] for stats in slice_stats), int(counts.sum())))
+        if failed:
+            print('mismatch:', sorted(actual_results.keys()), 'vs', sorted(expected_results.keys()),
+                  'and', sum(stats['docs'] for stats in slice_stats), 'vs', int(counts.sum()), 'docs')
+
+        for tag, expected_result in expected_results.items():
+            if failed:
+                break
+            actual_result = actual_results[tag]
+            if (self.__assert_equal(set(actual_result.keys()), set(expected_result.keys())) or
+                self.__assert_equal(actual_result['is_beaconing'], expected_result['is_beaconing']) or
+                any(self.__assert_close(actual_result[key], expected_result[key], 1e-8)
+                    for key in ['non_empty_buckets', 'mean', 'variance', 'pearson'] if key in expected_result)):
+                print('mismatch for', tag, ':\n', expected_result, '\nvs\n', actual_result)
+                failed = True
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def test_reference(self,
+                       number_tags: int = 200,
+                       number_buckets: int = 360,
+                       seed: int = 0):
+        '''
+        Test the vectorized reference implementation vs the python loop implementation
+        on random bucket counts.
+
+        This doesn't need any data to be indexed.
+        '''
+        rng = np.random.default_rng(seed)
+
+        counts = np.zeros((number_tags, number_buckets), dtype=np.int64)
+        for row in range(number_tags):
+            start = rng.integers(0, number_buckets // 4)
+            end = rng.integers(3 * number_buckets // 4, number_buckets + 1)
+            if row % 2 == 0:
+                period = rng.integers(2, 30)
+                counts[row, start:end:period] = rng.integers(1, 3)
+            else:
+                counts[row, start:end] = rng.poisson(rng.uniform(0.1, 5), end - start)
+
+        statistics = beacon_statistics(counts)
+
+        failed = False
+
+        for row in range(number_tags):
+            expected_result = self.__is_beaconing(list(counts[row]))
+            actual_result = row_statistics(statistics, row)
+            if (self.__assert_equal(actual_result['is_beaconing'], expected_result['is_beaconing']) or
+                self.__assert_equal(actual_result['non_empty_buckets'], expected_result['non_empty_buckets']) or
+                ('mean' in expected_result and
+                 self.__assert_close(actual_result['mean'], expected_result['mean'], 1e-8)) or
+                ('variance' in expected_result and
+                 self.__assert_close(actual_result['variance'], expected_result['variance'], 1e-8)) or
+                ('pearson' in expected_result and
+                 self.__assert_close(actual_result['pearson'], expected_result['pearson'], 1e-8))):
+                print('mismatch:\n', expected_result, '\nvs\n', actual_result)
+                failed = True
+                break
+
+        print('TEST', 'FAILED' if failed else 'PASSED')
+
+    def __read_bucket_counts(self, es, time_bucket_length: int = 60):
+        # Read the tags x buckets counts of the documents in the test window with a
+        # terms and date_histogram aggregation.
+
+        number_buckets = 6 * 3600 // time_bucket_length
+
         terms_date_histogram_result = Search.from_dict({
             "size": 0,
             "query": {
@@ -47,7 +345,7 @@ class Test:
                         "time_buckets": {
                             "date_histogram": {
                                 "field": "@timestamp",
-                                "fixed_interval": "1m"
+                                "fixed_interval": str(time_bucket_length) + "s"
                             }
                         }
                     }
@@ -55,31 +353,16 @@ class Test:
             }
         }).using(es).index(Generator.INDEX_NAME).execute()
 
-        expected_results = {}
-        for bucket in terms_date_histogram_result.aggregations.counts.buckets:
-            counts = []
+        # Place the date histogram counts at their offset in the range window so every
+        # tag has the same number of buckets.
+        tags = []
+        counts = np.zeros((len(terms_date_histogram_result.aggregations.counts.buckets), number_buckets))
+        for row, bucket in enumerate(terms_date_histogram_result.aggregations.counts.buckets):
+            tags.append(bucket['key'])
             for count in bucket['time_buckets']:
-                counts.append(count['doc_count'])
-            expected_results[bucket['key']] = self.__is_beaconing(counts)
-
-        scripted_metric_query_body = read_scripted_metric.read('examples/beaconing/scripted_metric_beacons.txt')
-        actual_results = Search.from_dict(scripted_metric_query_body).using(es).index('beaconing_demo').execute()
+                counts[row, (count['key'] - Generator.START_TIME) // (1000 * time_bucket_length)] = count['doc_count']
 
-        failed = False
-
-        for bucket in actual_results.aggregations.process.buckets:
-            expected_result = expected_results[bucket.key]
-            if (self.__assert_equal(bucket.beacon_stats.value.is_beaconing, expected_result['is_beaconing']) or
-                self.__assert_equal(bucket.beacon_stats.value.non_empty_buckets, expected_result['non_empty_buckets']) or
-                self.__assert_close(bucket.beacon_stats.value.mean, expected_result['mean'], 1e-4) or
-                self.__assert_close(bucket.beacon_stats.value.variance, expected_result['variance'], 1e-4) or
-                ('pearson' in expected_result and
-                 self.__assert_close(bucket.beacon_stats.value.pearson, expected_result['pearson'], 1e-4))):
-                print('mismatch:\n', expected_result, '\nvs\n', bucket.beacon_stats.value.to_dict())
-                failed = True
-                break
-
-        print('TEST', 'FAILED' if failed else 'PASSED')
+        return tags, counts
 
     def __is_beaconing(self, counts: list):
         '''
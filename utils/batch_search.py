@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+import utils.read_scripted_metric as read_scripted_metric
+
+class BatchSearchError(Exception):
+    '''
+    Raised if one of the searches of a batch fails.
+    '''
+    def __init__(self, position: int, error):
+        super().__init__('Search ' + str(position) + ' failed: ' + str(error))
+        self.position = position
+        self.error = error
+
+def request(template, params: dict = None, filter: dict = None):
+    '''
+    Create the request body for a scripted metric template restricted to the
+    documents which match filter.
+
+    @param template A ScriptedMetricTemplate or the file name of a request body.
+    @param params Overrides for the scripted metric params.
+    @param filter A query clause which documents must also match, or None.
+    '''
+    if isinstance(template, str):
+        template = read_scripted_metric.template(template)
+    body = template.request(params)
+    if filter is not None:
+        # The original query remains in a must clause so it still scores documents,
+        # which matters for the sampler aggregation.
+        body['query'] = {'bool': {'must': [body.get('query', {'match_all': {}})], 'filter': [filter]}}
+    return body
+
+def batch_search(es,
+                 index: str,
+                 specs: list,
+                 batch_size: int = 8,
+                 max_concurrent_requests: int = 4):
+    '''
+    Run many scripted metric searches with a few _msearch requests.
+
+    Each spec is a (template, params, filter) tuple, see request. The searches are
+    sent in _msearch requests of batch_size searches, so a fan out over N windows
+    or filters costs about one round trip rather than N, and up to
+    max_concurrent_requests of these are in flight at once. The requests share the
+    client, and so its connection pool, which should allow at least
+    max_concurrent_requests connections per node.
+
+    This is a generator which yields (position, response) pairs, where position is
+    the index of the spec in specs and response an elasticsearch_dsl Response, as
+    each _msearch request completes.
+
+    @raise BatchSearchError If any search fails.
+    '''
+    searches = []
+    registered = set()
+    for template, params, filter in specs:
+        if isinstance(template, str):
+            template = read_scripted_metric.template(template)
+        if template.file_name not in registered:
+            template.register(es)
+            registered.add(template.file_name)
+        searches.append(Search.from_dict(request(template, params, filter)).using(es).index(index))
+
+    batches = [list(range(start, min(start + batch_size, len(searches))))
+               for start in range(0, len(searches), batch_size)]
+
+    def run(batch: list):
+        body = []
+        for position in batch:
+            body.extend([{'index': index}, searches[position].to_dict()])
+        responses = es.msearch(body=body)
+        responses = responses.body if hasattr(responses, 'body') else responses
+        return list(zip(batch, responses['responses']))
+
+    with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        pending = set()
+        for batch in batches:
+            pending.add(executor.submit(run, batch))
+            if len(pending) >= max_concurrent_requests:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from _responses(done, searches)
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from _responses(done, searches)
+
+def _responses(futures, searches: list):
+    for future in futures:
+        for position, response in future.result():
+            if 'error' in response:
+                raise BatchSearchError(position, response['error'])
+            yield position, Response(searches[position], response)
@@ -0,0 +1,257 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+import numpy as np
+import threading
+import time
+
+class IndexingStats:
+    '''
+    Statistics for a bulk load.
+    '''
+    def __init__(self):
+        self.docs = 0
+        self.failed = 0
+        self.retries = 0
+        self.requests = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+    def docs_per_second(self):
+        return self.docs / self.seconds if self.seconds > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            'docs': self.docs,
+            'failed': self.failed,
+            'retries': self.retries,
+            'requests': self.requests,
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+            'docs_per_second': self.docs_per_second(),
+            'errors': dict(self.errors)
+        }
+
+    def __str__(self):
+        summary = '{} docs in {:.1f}s ({:.0f} docs/s), {} requests, {} retries, {} failed'.format(
+            self.docs, self.seconds, self.docs_per_second(), self.requests, self.retries, self.failed)
+        if len(self.errors) > 0:
+            summary += ' ' + str(dict(self.errors))
+        return summary
+
+class BulkIndexer:
+    '''
+    Index documents with a pool of workers each sending bulk requests.
+
+    Documents are serialized to NDJSON and split into chunks bounded by both the
+    number of documents and the number of bytes. At most max_in_flight chunks are
+    queued or being sent at any time, so the producer of the documents is blocked
+    rather than buffering without limit when the cluster can't keep up. Documents
+    rejected because the cluster is overloaded, i.e. with status 429, are retried
+    with exponential backoff.
+    '''
+    def __init__(self,
+                 es,
+                 thread_count: int = 4,
+                 chunk_size: int = 5000,
+                 max_chunk_bytes: int = 10 * 1024 * 1024,
+                 max_in_flight: int = 8,
+                 max_retries: int = 5,
+                 initial_backoff: float = 1.0,
+                 max_backoff: float = 60.0):
+        self.es = es
+        self.thread_count = thread_count
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_in_flight = max(max_in_flight, thread_count)
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+    def index(self,
+              actions,
+              index: str = None,
+              number_docs: int = None,
+              report_progress: bool = False):
+        '''
+        Index a stream of documents.
+
+        @param actions The documents to index. These are dictionaries in the format
+        accepted by the bulk helpers, i.e. with '_index' and optionally '_id' keys.
+        @param index If supplied, refresh is disabled and replicas are dropped for
+        this index for the duration of the load.
+        @param number_docs The expected number of documents used to report progress.
+        @return The IndexingStats for the load.
+        '''
+        return self.__index_payloads(self.__chunk(actions), index, number_docs, report_progress)
+
+    def index_serialized(self,
+                         batches,
+                         index: str,
+                         number_docs: int = None,
+                         report_progress: bool = False):
+        '''
+        Index a stream of documents which have already been serialized.
+
+        This avoids creating a dictionary per document and having the client serialize
+        them. Each batch is split into bulk request bodies, which respect the chunk
+        limits, with a single join per request.
+
+        @param batches An iterable of lists of documents serialized as JSON strings.
+        @param index The index to which to add the documents. Refresh is disabled and
+        replicas are dropped for this index for the duration of the load.
+        @param number_docs The expected number of documents used to report progress.
+        @return The IndexingStats for the load.
+        '''
+        action = '{"index":{"_index":' + json.dumps(index) + '}}\n'
+        payloads = self.__chunk_serialized(batches, action)
+        return self.__index_payloads(payloads, index, number_docs, report_progress)
+
+    def __chunk(self, actions):
+        # Serialize the actions into bulk request bodies.
+
+        chunk = []
+        size = 0
+        for action in actions:
+            lines = _serialize(action)
+            length = len(lines[0]) + len(lines[1])
+            if len(chunk) > 0 and (len(chunk) == 2 * self.chunk_size or size + length > self.max_chunk_bytes):
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+            chunk.extend(lines)
+            size += length
+        if len(chunk) > 0:
+            yield b''.join(chunk)
+
+    def __chunk_serialized(self, batches, action: str):
+        separator = '\n' + action
+        for batch in batches:
+            # Find the largest runs of documents which fit in the byte limit.
+            sizes = np.cumsum(np.fromiter(map(len, batch), dtype=np.int64, count=len(batch)) + len(separator))
+            start = 0
+            while start < len(batch):
+                offset = sizes[start - 1] if start > 0 else 0
+                end = int(np.searchsorted(sizes, offset + self.max_chunk_bytes, side='right'))
+                end = min(max(end, start + 1), start + self.chunk_size)
+                yield (action + separator.join(batch[start:end]) + '\n').encode()
+                start = end
+
+    def __index_payloads(self, payloads, index: str, number_docs: int, report_progress: bool):
+        if index is None:
+            return self.__send_all(payloads, number_docs, report_progress)
+        with bulk_load_settings(self.es, index):
+            return self.__send_all(payloads, number_docs, report_progress)
+
+    def __send_all(self, payloads, number_docs: int, report_progress: bool):
+        stats = IndexingStats()
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        progress = _Progress(number_docs) if report_progress else None
+
+        def send(payload):
+            try:
+                self.__send(payload, stats)
+                if progress is not None:
+                    progress.update(stats)
+            finally:
+                in_flight.release()
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            pending = []
+            for payload in payloads:
+                in_flight.acquire()
+                pending.append(executor.submit(send, payload))
+                # Surface any errors as early as possible.
+                done = [future for future in pending if future.done()]
+                for future in done:
+                    future.result()
+                pending = [future for future in pending if future not in done]
+            for future in pending:
+                future.result()
+        stats.seconds = time.monotonic() - start
+
+        return stats
+
+    def __send(self, payload: bytes, stats: IndexingStats):
+        backoff = self.initial_backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.es.bulk(body=payload)
+            except Exception as e:
+                if getattr(e, 'status_code', None) != 429 or attempt == self.max_retries:
+                    raise
+                rejected = None
+            else:
+                rejected = []
+                with stats.lock:
+                    stats.requests += 1
+                    stats.bytes += len(payload)
+                    for i, item in enumerate(response['items']):
+                        result = next(iter(item.values()))
+                        status = result.get('status', 500)
+                        if 200 <= status < 300:
+                            stats.docs += 1
+                        elif status == 429 and attempt < self.max_retries:
+                            rejected.append(i)
+                        else:
+                            stats.failed += 1
+                            stats.errors[result.get('error', {}).get('type', str(status))] += 1
+                if len(rejected) == 0:
+                    return
+
+            # Every document is an action line followed by a source line.
+            lines = payload.split(b'\n')
+            if rejected is not None:
+                payload = b''.join(lines[2 * i] + b'\n' + lines[2 * i + 1] + b'\n' for i in rejected)
+
+            with stats.lock:
+                stats.retries += len(lines) // 2 if rejected is None else len(rejected)
+            time.sleep(backoff)
+            backoff = min(2 * backoff, self.max_backoff)
+
+@contextmanager
+def bulk_load_settings(es, index: str):
+    '''
+    Disable refresh and replicas for an index while it is bulk loaded.
+
+    The original settings are restored, and the index refreshed, on exit.
+    '''
+    settings = es.indices.get_settings(index=index)[index]['settings']['index']
+    original = {
+        'refresh_interval': settings.get('refresh_interval'),
+        'number_of_replicas': settings.get('number_of_replicas')
+    }
+    es.indices.put_settings(index=index, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+    try:
+        yield
+    finally:
+        # A value of None resets a setting to its default.
+        es.indices.put_settings(index=index, body={'index': original})
+        es.indices.refresh(index=index)
+
+def _serialize(action: dict):
+    # Like the client's bulk helpers, routing is the only metadata field which drops
+    # its underscore.
+    metadata = {key.replace('_routing', 'routing'): value
+                for key, value in action.items() if key in ('_index', '_id', '_routing')}
+    source = {key: value for key, value in action.items() if not key.startswith('_')}
+    return (json.dumps({'index': metadata}, separators=(',', ':')).encode() + b'\n',
+            json.dumps(source, separators=(',', ':')).encode() + b'\n')
+
+class _Progress:
+    def __init__(self, number_docs: int):
+        self.number_docs = number_docs
+        self.last_progress = 0
+        self.lock = threading.Lock()
+
+    def update(self, stats: IndexingStats):
+        if self.number_docs is None:
+            return
+        with self.lock:
+            if stats.docs / self.number_docs > self.last_progress + 0.05:
+                print(stats.docs, '/', self.number_docs)
+                self.last_progress = self.last_progress + 0.05
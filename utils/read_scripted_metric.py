@@ -1,26 +1,116 @@
+import copy
+import hashlib
 import json
+import os
+import weakref
+
+SCRIPT_TYPES = ['init_script', 'map_script', 'combine_script', 'reduce_script']
+
+# The parsed request bodies keyed by file name. Each entry also stores the file's
+# modification time so edits to the file are picked up.
+_cache = {}
 
 def recursive_find_and_replace(json, placeholder, replace):
-    for key,value in json.items():
+    items = json.items() if isinstance(json, dict) else enumerate(json)
+    for key,value in items:
         if value == placeholder:
             json[key] = replace
-        elif isinstance(json[key], dict):
+        elif isinstance(json[key], (dict, list)):
             recursive_find_and_replace(json[key], placeholder, replace)
 
 def read(file_name):
+    '''
+    Read a scripted metric request body.
+
+    The file is only parsed the first time it is read, or if it has been modified
+    since, and each call returns a copy which the caller is free to modify.
+    '''
+    file_name = os.path.abspath(file_name)
+    mtime = os.stat(file_name).st_mtime_ns
+    if file_name not in _cache or _cache[file_name][0] != mtime:
+        _cache[file_name] = (mtime, _parse(file_name))
+    return copy.deepcopy(_cache[file_name][1])
+
+def template(file_name):
+    '''
+    Get the ScriptedMetricTemplate for a scripted metric request body.
+    '''
+    return ScriptedMetricTemplate(file_name)
+
+class ScriptedMetricTemplate:
+    '''
+    A scripted metric request body whose scripts are stored in the cluster.
+
+    Inline scripts are compiled whenever they aren't in the script cache and count
+    towards the script compilation rate limit. Instead, this registers the init, map,
+    combine and reduce scripts as stored scripts and creates requests which refer to
+    them by id, so each script is compiled once per cluster. Script ids include a
+    hash of the script source so that editing a script registers a new version.
+    '''
+    # The stored script ids registered for each client.
+    _registered = weakref.WeakKeyDictionary()
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.name = os.path.splitext(os.path.basename(file_name))[0]
+
+    def register(self, es):
+        '''
+        Store the scripts, if they haven't been already, using the _scripts API.
+        '''
+        registered = ScriptedMetricTemplate._registered.setdefault(es, set())
+        for _, _, script_id, source in self.__scripts(read(self.file_name)):
+            if script_id not in registered:
+                es.put_script(id=script_id, body={'script': {'lang': 'painless', 'source': source}})
+                registered.add(script_id)
+
+    def request(self, params: dict = None):
+        '''
+        Create a request body which refers to the stored scripts.
+
+        @param params Values to override in the params of each scripted metric.
+        '''
+        body = read(self.file_name)
+        for scripted_metric, script_type, script_id, _ in self.__scripts(body):
+            scripted_metric[script_type] = {'id': script_id}
+        if params is not None:
+            for scripted_metric in _find_scripted_metrics(body):
+                scripted_metric.setdefault('params', {}).update(copy.deepcopy(params))
+        return body
+
+    def __scripts(self, body: dict):
+        for scripted_metric in _find_scripted_metrics(body):
+            for script_type in SCRIPT_TYPES:
+                if isinstance(scripted_metric.get(script_type), str):
+                    source = scripted_metric[script_type]
+                    digest = hashlib.sha1(source.encode()).hexdigest()[:12]
+                    script_id = '-'.join([self.name, script_type, digest]).replace('_', '-')
+                    yield scripted_metric, script_type, script_id, source
+
+def _find_scripted_metrics(body):
+    if isinstance(body, dict):
+        if 'scripted_metric' in body:
+            yield body['scripted_metric']
+        values = body.values()
+    elif isinstance(body, list):
+        values = body
+    else:
+        return
+    for value in values:
+        yield from _find_scripted_metrics(value)
+
+def _parse(file_name):
     # We need special handling of triple quoted strings for script bodies which are
     # not supported in the JSON reader. These just need to be copied as strings into
     # the request body for the aggregation. We also drop painless comments, which are
     # prefixed by //.
 
-    scripted_metric = ''
+    lines = []
     with open(file_name, 'r') as file:
-        for line in file.readlines():
+        for line in file:
             comment = line.find('//')
-            if comment != -1:
-                scripted_metric += line[:comment]
-            else:
-                scripted_metric += line
+            lines.append(line[:comment] if comment != -1 else line)
+    scripted_metric = ''.join(lines)
 
     split_scripted_metric = scripted_metric.split('"""')
 
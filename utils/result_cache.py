@@ -0,0 +1,165 @@
+from collections import OrderedDict
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+import hashlib
+import json
+import os
+import threading
+
+class ResultCache:
+    '''
+    A client side cache of search responses which is invalidated when the index
+    changes.
+
+    The shard request cache doesn't cache the examples' searches because they use
+    scripts and, for apriori, random_score. Instead, this caches the response of a
+    search keyed by the index and the request body. The bodies created by
+    read_scripted_metric templates refer to stored scripts whose ids include a hash
+    of their source, so the key changes if either a script or its params change.
+    Each entry also stores a change token of the index, comprising the maximum
+    sequence number and document counts of every shard copy, which is read with one
+    cheap _stats request per lookup. If any document has been indexed, updated or
+    deleted, or made searchable, since the response was cached the entry is
+    discarded and the search runs again. The refresh count isn't part of the token
+    because scheduled refreshes increment it even when nothing has changed.
+
+    Entries are evicted least recently used first once there are more than
+    max_entries. If a directory is supplied the entries are also written there, so
+    they survive restarts, and evicted entries are read back from it on a miss. The
+    directory holds at most max_disk_entries entries.
+    '''
+    def __init__(self,
+                 max_entries: int = 128,
+                 directory: str = None,
+                 max_disk_entries: int = 1024):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def search(self, es, index: str, body: dict):
+        '''
+        Run a search, or return its cached response if the index hasn't changed.
+
+        @return The elasticsearch_dsl Response for the search.
+        '''
+        search = Search.from_dict(body).using(es).index(index)
+        return Response(search, self.raw_search(es, index, search.to_dict()))
+
+    def raw_search(self, es, index: str, body: dict):
+        '''
+        Run a search, or return its cached response if the index hasn't changed.
+
+        @return The response dictionary.
+        '''
+        key = cache_key(index, body)
+        token = change_token(es, index)
+        response = self.get(key, token)
+        if response is None:
+            response = es.search(index=index, body=body)
+            response = response.body if hasattr(response, 'body') else response
+            self.put(key, token, response)
+        return response
+
+    def get(self, key: str, token: str):
+        '''
+        Get the cached response for key if it was cached with the same change token.
+        '''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.__entries.move_to_end(key)
+        if entry is None:
+            entry = self.__read(key)
+            if entry is not None:
+                self.__add(key, entry)
+        if entry is None or entry['token'] != token:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['response']
+
+    def put(self, key: str, token: str, response: dict):
+        entry = {'token': token, 'response': response}
+        self.__add(key, entry)
+        self.__write(key, entry)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+        for file_name in self.__files():
+            os.remove(file_name)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __add(self, key: str, entry: dict):
+        with self.__lock:
+            self.__entries[key] = entry
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def __read(self, key: str):
+        if self.directory is None:
+            return None
+        file_name = self.__file_name(key)
+        try:
+            with open(file_name) as file:
+                entry = json.load(file)
+            os.utime(file_name)
+            return entry
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def __write(self, key: str, entry: dict):
+        if self.directory is None:
+            return
+        # Write then rename so readers never see a partial file.
+        file_name = self.__file_name(key)
+        with open(file_name + '.tmp', 'w') as file:
+            json.dump(entry, file)
+        os.replace(file_name + '.tmp', file_name)
+        files = sorted(self.__files(), key=lambda file_name: os.stat(file_name).st_mtime_ns)
+        for file_name in files[:max(len(files) - self.max_disk_entries, 0)]:
+            os.remove(file_name)
+
+    def __file_name(self, key: str):
+        return os.path.join(self.directory, key + '.json')
+
+    def __files(self):
+        if self.directory is None:
+            return []
+        return [os.path.join(self.directory, file_name)
+                for file_name in os.listdir(self.directory) if file_name.endswith('.json')]
+
+def cache_key(index: str, body: dict):
+    '''
+    The key of a search of index with the request body.
+    '''
+    return hashlib.sha256(json.dumps([index, body], sort_keys=True).encode('utf-8')).hexdigest()
+
+def change_token(es, index: str):
+    '''
+    A token which changes whenever documents are indexed, updated or deleted in any
+    shard of the index, and again when the changes are made searchable by a refresh,
+    which changes the document counts.
+    '''
+    stats = es.indices.stats(index=index, level='shards', metric='docs,seq_no')
+    stats = stats.body if hasattr(stats, 'body') else stats
+    token = []
+    for index_name, index_stats in sorted(stats['indices'].items()):
+        for shard, copies in sorted(index_stats['shards'].items()):
+            for copy in copies:
+                token.append([index_name,
+                              shard,
+                              copy['routing']['primary'],
+                              copy.get('seq_no', {}).get('max_seq_no'),
+                              copy['docs']['count'],
+                              copy['docs']['deleted']])
+    return json.dumps(sorted(token, key=str))
@@ -0,0 +1,176 @@
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+import copy
+import json
+import time
+
+# The Elasticsearch aggregator which runs scripted metrics.
+SCRIPTED_METRIC_AGGREGATOR = 'ScriptedMetricAggregator'
+
+class SearchProfile:
+    '''
+    Where the time goes in a search with scripted metric aggregations.
+
+    Any random sampling is seeded so every search of the profile sees the same
+    documents. Map and combine times are per shard, from the profile API, which
+    reports the map_script as collect and the combine_script as build_aggregation.
+    The combined shard states are sized by fetching them with a reduce_script which
+    returns them unchanged. The reduce time is estimated as the difference between
+    the took times of that search and the original one, both run without the
+    profile API. It is still approximate since it includes the noise between the
+    two runs.
+    '''
+    def __init__(self):
+        self.took_millis = 0
+        self.round_trip_millis = 0.0
+        self.response_bytes = 0
+        self.deserialize_millis = 0.0
+        self.reduce_millis = 0
+        self.shards = []
+        self.state_bytes = []
+        self.state_entries = []
+
+    def to_dict(self):
+        return {
+            'took_millis': self.took_millis,
+            'round_trip_millis': self.round_trip_millis,
+            'response_bytes': self.response_bytes,
+            'deserialize_millis': self.deserialize_millis,
+            'reduce_millis': self.reduce_millis,
+            'shards': self.shards,
+            'states': len(self.state_bytes),
+            'state_bytes': self.state_bytes,
+            'state_entries': self.state_entries
+        }
+
+    def __str__(self):
+        lines = ['PROFILE took {} ms, round trip {:.1f} ms'.format(self.took_millis, self.round_trip_millis)]
+        for shard in self.shards:
+            lines.append('  shard {}: query {:.1f} ms, map {:.1f} ms, combine {:.1f} ms'.format(
+                shard['id'], shard['query_millis'], shard['map_millis'], shard['combine_millis']))
+        if len(self.state_bytes) > 0:
+            lines.append('  combine payload: {} states, {} bytes (max {}), {} entries (max {})'.format(
+                len(self.state_bytes), sum(self.state_bytes), max(self.state_bytes),
+                sum(self.state_entries), max(self.state_entries)))
+        lines.append('  reduce: ~{} ms (approximate, took difference vs returning the states)'.format(self.reduce_millis))
+        lines.append('  client: {} byte response deserialized in {:.1f} ms'.format(
+            self.response_bytes, self.deserialize_millis))
+        return '\n'.join(lines)
+
+def profile_search(es,
+                   index: str,
+                   body: dict,
+                   state_entries = None,
+                   seed: int = 0):
+    '''
+    Run a search with scripted metric aggregations and profile each of its phases.
+
+    This runs the search three times: once with the profile API enabled, whose
+    response is returned, and, to estimate the reduce time, once as is and once with
+    every scripted metric's reduce_script replaced to return the combined shard
+    states. Any random_score query and random_sampler aggregation which aren't
+    seeded are seeded first, so all three searches sample the same documents.
+
+    @param state_entries A function which counts the entries in a shard state. If
+    None the lengths of the lists and maps in the state are summed.
+    @param seed The seed used for unseeded random sampling.
+    @return The elasticsearch_dsl Response for the search and its SearchProfile.
+    '''
+    state_entries = state_entries or _count_entries
+    profile = SearchProfile()
+    body = _seed(copy.deepcopy(body), seed)
+    body.pop('profile', None)
+
+    search = Search.from_dict(dict(body, profile=True)).using(es).index(index)
+    start = time.perf_counter()
+    raw = es.search(index=index, body=search.to_dict())
+    profile.round_trip_millis = 1000 * (time.perf_counter() - start)
+    raw = raw.body if hasattr(raw, 'body') else raw
+
+    # The client decodes the JSON body and wraps it in response objects. We time
+    # this on the serialized response since the transport hides it.
+    serialized = json.dumps(raw)
+    profile.response_bytes = len(serialized.encode('utf-8'))
+    start = time.perf_counter()
+    response = Response(search, json.loads(serialized))
+    response.aggregations.to_dict()
+    profile.deserialize_millis = 1000 * (time.perf_counter() - start)
+
+    profile.took_millis = raw['took']
+    for shard in raw.get('profile', {}).get('shards', []):
+        query_nanos = sum(query['time_in_nanos']
+                          for searches in shard.get('searches', []) for query in searches.get('query', []))
+        map_nanos, combine_nanos = _scripted_metric_nanos(shard.get('aggregations', []))
+        profile.shards.append({'id': shard['id'],
+                               'query_millis': query_nanos / 1e6,
+                               'map_millis': map_nanos / 1e6,
+                               'combine_millis': combine_nanos / 1e6})
+
+    # Time the search with and without the reduce the same way, i.e. without the
+    # profile API's overhead.
+    timed_raw = es.search(index=index, body=body)
+    timed_raw = timed_raw.body if hasattr(timed_raw, 'body') else timed_raw
+
+    states_body = copy.deepcopy(body)
+    names = _return_states(states_body.get('aggs', {}))
+    states_raw = es.search(index=index, body=states_body)
+    states_raw = states_raw.body if hasattr(states_raw, 'body') else states_raw
+    for state in _find_states(states_raw.get('aggregations', {}), names):
+        profile.state_bytes.append(len(json.dumps(state).encode('utf-8')))
+        profile.state_entries.append(state_entries(state))
+    profile.reduce_millis = max(timed_raw['took'] - states_raw['took'], 0)
+
+    return response, profile
+
+def _scripted_metric_nanos(aggregations: list):
+    map_nanos = 0
+    combine_nanos = 0
+    for aggregation in aggregations:
+        if aggregation['type'] == SCRIPTED_METRIC_AGGREGATOR:
+            breakdown = aggregation.get('breakdown', {})
+            map_nanos += breakdown.get('initialize', 0) + breakdown.get('collect', 0)
+            combine_nanos += breakdown.get('build_aggregation', 0)
+        child_map_nanos, child_combine_nanos = _scripted_metric_nanos(aggregation.get('children', []))
+        map_nanos += child_map_nanos
+        combine_nanos += child_combine_nanos
+    return map_nanos, combine_nanos
+
+def _seed(body, seed: int):
+    # Seed every random_score function and random_sampler aggregation which isn't.
+    if isinstance(body, dict):
+        for key, value in body.items():
+            if key == 'random_score' and isinstance(value, dict) and 'seed' not in value:
+                value.update(seed=seed, field='_seq_no')
+            elif key == 'random_sampler' and isinstance(value, dict) and 'seed' not in value:
+                value['seed'] = seed
+            _seed(value, seed)
+    elif isinstance(body, list):
+        for value in body:
+            _seed(value, seed)
+    return body
+
+def _return_states(aggs: dict):
+    # Replace the reduce_script of every scripted metric and return their names.
+    names = set()
+    for name, agg in aggs.items():
+        if 'scripted_metric' in agg:
+            agg['scripted_metric']['reduce_script'] = 'return states'
+            names.add(name)
+        names |= _return_states(agg.get('aggs', agg.get('aggregations', {})))
+    return names
+
+def _find_states(aggregations, names: set):
+    if isinstance(aggregations, dict):
+        for key, value in aggregations.items():
+            if key in names and isinstance(value, dict) and 'value' in value:
+                yield from value['value']
+            else:
+                yield from _find_states(value, names)
+    elif isinstance(aggregations, list):
+        for value in aggregations:
+            yield from _find_states(value, names)
+
+def _count_entries(state):
+    if isinstance(state, dict):
+        return sum(len(value) if isinstance(value, (dict, list)) else 0 for value in state.values())
+    return len(state) if isinstance(state, list) else 1
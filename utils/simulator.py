@@ -0,0 +1,1057 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import bisect
+import importlib
+import itertools
+import json
+import numpy as np
+import re
+import threading
+import time
+import zlib
+import utils.read_scripted_metric as read_scripted_metric
+
+# The modules which provide Python equivalents of the examples' scripted metrics.
+# Each defines SCRIPTS, a dictionary from scripted metric file name to a class with
+# init, map, combine and reduce methods.
+SCRIPT_MODULES = ['examples.beaconing.simulated_scripts', 'examples.apriori.simulated_scripts']
+
+# The Elasticsearch aggregator which implements each aggregation type, as named in
+# profile results.
+_AGGREGATORS = {
+    'sampler': 'SamplerAggregator',
+    'random_sampler': 'RandomSamplerAggregator',
+    'terms': 'GlobalOrdinalsStringTermsAggregator',
+    'composite': 'CompositeAggregator',
+    'date_histogram': 'DateHistogramAggregator',
+    'scripted_metric': 'ScriptedMetricAggregator'
+}
+
+# Painless only has the double overloads of Math.min and Math.max, so declaring an
+# integer variable with their result, without a cast, fails to compile.
+_NARROWING_MATH = re.compile(r'\b(?:byte|short|int|long)\s+\w+\s*=\s*Math\.(?:min|max)\s*\(')
+
+# The number of milliseconds in each fixed interval unit.
+_UNITS = {'ms': 1, 's': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000}
+
+class SimulatorError(Exception):
+    '''
+    Raised for requests which fail or which the simulator doesn't support.
+    '''
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+    def __reduce__(self):
+        # Errors raised by the process pool's workers are pickled.
+        return (SimulatorError, (self.status_code, str(self)))
+
+class SimulatedElasticsearch:
+    '''
+    An in-process stand-in for the Elasticsearch client.
+
+    This stores documents in memory, partitioned into number_shards shards, and
+    supports the subset of the client API and the search DSL which the examples use.
+    In particular, it reproduces the lifecycle of a scripted metric aggregation: the
+    init, map and combine steps run on each shard, and the reduce step runs on the
+    combined states of every shard. Painless isn't executed. Instead, each scripted
+    metric is matched to a Python equivalent by its map_script, see SCRIPT_MODULES. The
+    scripts are checked for some common Painless compile errors.
+
+    If processes is greater than one the shard level work of each search, i.e. the
+    query, aggregations and scripted metric init, map and combine steps, runs in a
+    process pool, so it is possible to profile the algorithms and to model how they
+    scale with the number of shards without a cluster. Pass it to a generator with,
+    for example, Generator(es=SimulatedElasticsearch(number_shards=4)).
+
+    Documents are visible to searches after a refresh, which happens before every
+    search unless refresh is disabled on the index.
+    '''
+    def __init__(self,
+                 number_shards: int = 1,
+                 processes: int = 1,
+                 scripts: dict = None):
+        '''
+        @param number_shards The default number of shards of each index.
+        @param processes The number of processes used to search the shards.
+        @param scripts A dictionary from scripted metric file name to the Python
+        equivalent of its scripts. By default these are loaded from SCRIPT_MODULES.
+        '''
+        self.number_shards = number_shards
+        self.processes = processes
+        self.indices = _Indices(self)
+        self.__indices = {}
+        self.__stored_scripts = {}
+        self.__scrolls = {}
+        self.__points_in_time = {}
+        self.__pit_ids = itertools.count()
+        self.__lock = threading.RLock()
+        self.__pool = None
+        self.__pool_version = None
+        self.__version = 0
+        self.__implementations = {}
+        if scripts is None:
+            scripts = {}
+            for module in SCRIPT_MODULES:
+                scripts.update(importlib.import_module(module).SCRIPTS)
+        for file_name, implementation in scripts.items():
+            self.register_script(file_name, implementation)
+
+    def register_script(self, file_name: str, implementation):
+        '''
+        Use implementation in place of the Painless scripts of the scripted metric
+        in file_name.
+        '''
+        for scripted_metric in read_scripted_metric._find_scripted_metrics(read_scripted_metric.read(file_name)):
+            self.__implementations[scripted_metric['map_script']] = implementation
+
+    def options(self, **kwargs):
+        return self
+
+    def info(self, **kwargs):
+        return _Response({'name': 'simulator', 'version': {'number': 'simulated'}})
+
+    def close(self):
+        '''
+        Shut down the process pool, if there is one.
+        '''
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.shutdown()
+                self.__pool = None
+
+    def put_script(self, id: str, body: dict = None, script: dict = None, **kwargs):
+        script = script if script is not None else body['script']
+        with self.__lock:
+            self.__stored_scripts[id] = script['source']
+        return _Response({'acknowledged': True})
+
+    def bulk(self, body=None, operations=None, index: str = None, **kwargs):
+        body = body if body is not None else operations
+        if isinstance(body, bytes):
+            body = body.decode()
+        lines = [line for line in body.split('\n') if line.strip() != '']
+        start = time.perf_counter()
+        items = []
+        with self.__lock:
+            for action_line, source_line in zip(lines[0::2], lines[1::2]):
+                (action, metadata), = json.loads(action_line).items()
+                name = metadata.get('_index', index)
+                self.__create_if_missing(name)
+                metadata_id = self.__indices[name].add(json.loads(source_line), metadata.get('_id'))
+                items.append({action: {'_index': name, '_id': metadata_id, 'status': 201, 'result': 'created'}})
+            self.__version += 1
+        return _Response({'took': _millis(start), 'errors': False, 'items': items})
+
+    def count(self, index: str = None, body: dict = None, query: dict = None, **kwargs):
+        body = dict(body or {})
+        if query is not None:
+            body['query'] = query
+        body['size'] = 0
+        body.pop('aggs', None)
+        return _Response({'count': self.search(index=index, body=body)['hits']['total']['value']})
+
+    def search(self, index: str = None, body: dict = None, scroll: str = None, **kwargs):
+        '''
+        Search the shards of the indices.
+
+        Supported queries are match_all, term, terms, range, bool and function_score
+        with random_score. Supported aggregations are terms, composite, sampler,
+        random_sampler, date_histogram and scripted_metric.
+
+        If the body has profile set the response includes the time each shard spent
+        in the query and in each aggregation in the format of the profile API. The
+        scripted metric init, map and combine times are reported as the initialize,
+        collect and build_aggregation times, respectively.
+
+        Hits can be sorted on numeric and date fields and, for a point in time search,
+        on _shard_doc, and paged with search_after. A point in time search can also
+        be split with slice and read docvalue_fields. It searches the shards as they
+        were when the point in time was opened in the calling thread, since the
+        process pool's copies of the shards may be newer.
+        '''
+        body = dict(body or {})
+        for key in ['query', 'aggs', 'aggregations', 'size', 'from_', '_source', 'profile',
+                    'sort', 'search_after', 'slice', 'docvalue_fields', 'pit']:
+            if key in kwargs:
+                body[key.rstrip('_')] = kwargs.pop(key)
+        if 'aggregations' in body:
+            body['aggs'] = body.pop('aggregations')
+
+        start = time.perf_counter()
+        pit = body.get('pit')
+        if pit is not None:
+            if index is not None:
+                raise SimulatorError(400, 'A point in time search can\'t specify an index')
+            shards = self.__pit_shards(pit['id'])
+        else:
+            shards = self.__refresh_and_get_shards(index)
+        request = {
+            'query': body.get('query', {'match_all': {}}),
+            'aggs': self.__resolve_scripts(body.get('aggs', {})),
+            'size': body.get('size', 10) + body.get('from', 0) if scroll is None else None,
+            'source': body.get('_source', True),
+            'profile': body.get('profile', False),
+            'sort': _sort_fields(body.get('sort')),
+            'search_after': body.get('search_after'),
+            'slice': body.get('slice'),
+            'docvalue_fields': body.get('docvalue_fields', [])
+        }
+        if pit is None and any(field == '_shard_doc' for field, _ in request['sort']):
+            raise SimulatorError(400, 'Sorting on _shard_doc requires a point in time')
+        if pit is None and request['slice'] is not None:
+            raise SimulatorError(400, 'Only point in time searches can be sliced')
+        if pit is None:
+            shard_results = self.__search_shards(shards, request)
+        else:
+            shard_results = [_search_shard(shard, dict(request, shard_index=i)) for i, shard in enumerate(shards)]
+
+        if len(request['sort']) > 0:
+            hits = sorted(itertools.chain(*[result['hits'] for result in shard_results]),
+                          key=lambda hit: _sort_keys(hit['sort'], request['sort']))
+        else:
+            hits = sorted(itertools.chain(*[result['hits'] for result in shard_results]),
+                          key=lambda hit: -hit['_score'])
+        total = sum(result['total'] for result in shard_results)
+        aggregations = _reduce_aggs(request['aggs'], [result['aggs'] for result in shard_results])
+
+        response = {
+            'took': 0,
+            'timed_out': False,
+            '_shards': {'total': len(shards), 'successful': len(shards), 'skipped': 0, 'failed': 0},
+            'hits': {
+                'total': {'value': total, 'relation': 'eq'},
+                'max_score': hits[0]['_score'] if len(hits) > 0 else None,
+                'hits': []
+            }
+        }
+        if pit is not None:
+            response['pit_id'] = pit['id']
+        if len(request['aggs']) > 0:
+            response['aggregations'] = aggregations
+        if request['profile']:
+            response['profile'] = {'shards': [result['profile'] for result in shard_results]}
+        if scroll is None:
+            response['hits']['hits'] = hits[body.get('from', 0):body.get('from', 0) + body.get('size', 10)]
+        else:
+            size = body.get('size', 10)
+            with self.__lock:
+                scroll_id = 'scroll_' + str(len(self.__scrolls))
+                self.__scrolls[scroll_id] = (hits[size:], size)
+            response['_scroll_id'] = scroll_id
+            response['hits']['hits'] = hits[:size]
+        response['took'] = _millis(start)
+        return _Response(response)
+
+    def msearch(self, body=None, index: str = None, searches=None, **kwargs):
+        '''
+        Run the searches of a multi search request, whose body is a list or new line
+        delimited string of alternating headers and search bodies.
+        '''
+        body = body if body is not None else searches
+        if isinstance(body, str):
+            body = [json.loads(line) for line in body.split('\n') if line.strip() != '']
+        start = time.perf_counter()
+        responses = []
+        for header, search_body in zip(body[0::2], body[1::2]):
+            try:
+                response = dict(self.search(index=header.get('index', index), body=search_body))
+                response['status'] = 200
+            except SimulatorError as e:
+                response = {'error': {'type': 'simulator_error', 'reason': str(e)}, 'status': e.status_code}
+            responses.append(response)
+        return _Response({'took': _millis(start), 'responses': responses})
+
+    def scroll(self, scroll_id: str = None, body: dict = None, **kwargs):
+        scroll_id = scroll_id if scroll_id is not None else body['scroll_id']
+        with self.__lock:
+            if scroll_id not in self.__scrolls:
+                raise SimulatorError(404, 'No search context found for ' + scroll_id)
+            hits, size = self.__scrolls[scroll_id]
+            self.__scrolls[scroll_id] = (hits[size:], size)
+        return _Response({
+            '_scroll_id': scroll_id,
+            'took': 0,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'hits': hits[:size]}
+        })
+
+    def clear_scroll(self, scroll_id=None, body: dict = None, **kwargs):
+        scroll_ids = scroll_id if scroll_id is not None else (body or {}).get('scroll_id', [])
+        with self.__lock:
+            for scroll_id in [scroll_ids] if isinstance(scroll_ids, str) else scroll_ids:
+                self.__scrolls.pop(scroll_id, None)
+        return _Response({'succeeded': True})
+
+    def open_point_in_time(self, index: str = None, keep_alive: str = None, **kwargs):
+        '''
+        Fix the searchable documents of the indices for searches with the returned
+        id. Points in time don't expire and must be closed.
+        '''
+        shards = self.__refresh_and_get_shards(index)
+        with self.__lock:
+            pit_id = 'pit_' + str(next(self.__pit_ids))
+            self.__points_in_time[pit_id] = shards
+        return _Response({'id': pit_id})
+
+    def close_point_in_time(self, body: dict = None, id: str = None, **kwargs):
+        pit_id = id if id is not None else body['id']
+        with self.__lock:
+            freed = self.__points_in_time.pop(pit_id, None) is not None
+        return _Response({'succeeded': True, 'num_freed': int(freed)})
+
+    def _create_index(self, name: str, body: dict):
+        with self.__lock:
+            if name in self.__indices:
+                raise SimulatorError(400, 'index [' + name + '] already exists')
+            settings = dict((body or {}).get('settings', {}))
+            settings = dict(settings.get('index', settings))
+            number_shards = int(settings.get('number_of_shards', self.number_shards))
+            self.__indices[name] = _Index(name, number_shards, (body or {}).get('mappings', {}), settings)
+            self.__version += 1
+
+    def _delete_index(self, name: str):
+        with self.__lock:
+            if name not in self.__indices:
+                raise SimulatorError(404, 'no such index [' + name + ']')
+            del self.__indices[name]
+            self.__version += 1
+
+    def _get_index(self, name: str):
+        with self.__lock:
+            if name not in self.__indices:
+                raise SimulatorError(404, 'no such index [' + name + ']')
+            return self.__indices[name]
+
+    def _index_stats(self, name: str = None):
+        with self.__lock:
+            return {index_name: self.__indices[index_name].stats() for index_name in self.__index_names(name)}
+
+    def _has_index(self, name: str):
+        with self.__lock:
+            return name in self.__indices
+
+    def _refresh(self, name: str = None):
+        with self.__lock:
+            for index_name in self.__index_names(name):
+                if self.__indices[index_name].refresh():
+                    self.__version += 1
+
+    def __create_if_missing(self, name: str):
+        if name not in self.__indices:
+            self.__indices[name] = _Index(name, self.number_shards, {}, {})
+
+    def __index_names(self, name: str):
+        if name is None or name in ['_all', '*']:
+            return list(self.__indices.keys())
+        names = name.split(',') if isinstance(name, str) else list(name)
+        for index_name in names:
+            if index_name not in self.__indices:
+                raise SimulatorError(404, 'no such index [' + index_name + ']')
+        return names
+
+    def __refresh_and_get_shards(self, name: str):
+        with self.__lock:
+            shards = []
+            for index_name in self.__index_names(name):
+                index = self.__indices[index_name]
+                if str(index.settings.get('refresh_interval')) != '-1':
+                    if index.refresh():
+                        self.__version += 1
+                shards.extend(index.searchable)
+            return shards
+
+    def __pit_shards(self, pit_id: str):
+        with self.__lock:
+            if pit_id not in self.__points_in_time:
+                raise SimulatorError(404, 'No search context found for id [' + pit_id + ']')
+            return self.__points_in_time[pit_id]
+
+    def __resolve_scripts(self, aggs: dict):
+        # Replace each scripted metric's scripts with its Python implementation.
+        resolved = {}
+        for name, agg in aggs.items():
+            agg = dict(agg)
+            if 'scripted_metric' in agg:
+                scripted_metric = dict(agg['scripted_metric'])
+                sources = {}
+                for script_type in read_scripted_metric.SCRIPT_TYPES:
+                    script = scripted_metric.get(script_type)
+                    if isinstance(script, dict) and 'id' in script:
+                        with self.__lock:
+                            if script['id'] not in self.__stored_scripts:
+                                raise SimulatorError(404, 'unable to find script [' + script['id'] + ']')
+                            script = self.__stored_scripts[script['id']]
+                    elif isinstance(script, dict):
+                        script = script['source']
+                    sources[script_type] = script
+                    _check_script(script_type, script)
+                implementation = self.__implementations.get(sources['map_script'])
+                if implementation is None:
+                    raise SimulatorError(400, 'No Python implementation of map_script ' + str(sources['map_script']))
+                agg['scripted_metric'] = {
+                    'params': scripted_metric.get('params', {}),
+                    'implementation': implementation,
+                    'return_states': ' '.join(str(sources.get('reduce_script')).split()) == 'return states'
+                }
+            if 'aggs' in agg or 'aggregations' in agg:
+                agg['aggs'] = self.__resolve_scripts(agg.pop('aggs', agg.pop('aggregations', {})))
+            resolved[name] = agg
+        return resolved
+
+    def __search_shards(self, shards: list, request: dict):
+        if self.processes <= 1 or len(shards) <= 1:
+            return [_search_shard(shard, request) for shard in shards]
+        with self.__lock:
+            # The workers hold a copy of every shard which is refreshed if the data
+            # have changed since the pool was created.
+            if self.__pool is None or self.__pool_version != self.__version:
+                if self.__pool is not None:
+                    self.__pool.shutdown()
+                all_shards = {(shard.index, shard.number): shard
+                              for index in self.__indices.values() for shard in index.searchable}
+                self.__pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                  initializer=_initialize_worker,
+                                                  initargs=(all_shards,))
+                self.__pool_version = self.__version
+            pool = self.__pool
+        futures = [pool.submit(_worker_search_shard, (shard.index, shard.number), request) for shard in shards]
+        return [future.result() for future in futures]
+
+class _Indices:
+    # The indices namespace of the client.
+
+    def __init__(self, client: SimulatedElasticsearch):
+        self.client = client
+
+    def create(self, index: str, body: dict = None, ignore=None, **kwargs):
+        body = dict(body or {})
+        for key in ['mappings', 'settings']:
+            if key in kwargs:
+                body[key] = kwargs.pop(key)
+        return self.__call(ignore, lambda: self.client._create_index(index, body),
+                           {'acknowledged': True, 'index': index})
+
+    def delete(self, index: str, ignore=None, **kwargs):
+        return self.__call(ignore, lambda: self.client._delete_index(index), {'acknowledged': True})
+
+    def exists(self, index: str, **kwargs):
+        return self.client._has_index(index)
+
+    def refresh(self, index: str = None, ignore=None, **kwargs):
+        return self.__call(ignore, lambda: self.client._refresh(index), {'_shards': {'failed': 0}})
+
+    def stats(self, index: str = None, **kwargs):
+        return _Response({'indices': self.client._index_stats(index)})
+
+    def get_settings(self, index: str, **kwargs):
+        settings = self.client._get_index(index).settings
+        return _Response({index: {'settings': {'index': {key: str(value) for key, value in settings.items()}}}})
+
+    def put_settings(self, index: str, body: dict = None, settings: dict = None, **kwargs):
+        body = body if body is not None else settings
+        index_settings = self.client._get_index(index).settings
+        for key, value in body.get('index', body).items():
+            if value is None:
+                index_settings.pop(key, None)
+            else:
+                index_settings[key] = value
+        return _Response({'acknowledged': True})
+
+    def __call(self, ignore, function, response):
+        ignore = [ignore] if isinstance(ignore, int) else (ignore or [])
+        try:
+            function()
+        except SimulatorError as e:
+            if e.status_code not in ignore:
+                raise
+            return _Response({'error': str(e), 'status': e.status_code})
+        return _Response(response)
+
+class _Response(dict):
+    # The client returns an API response whose body is the response dictionary.
+
+    @property
+    def body(self):
+        return self
+
+class _Index:
+    def __init__(self, name: str, number_shards: int, mappings: dict, settings: dict):
+        self.name = name
+        self.mappings = mappings.get('properties', {})
+        self.settings = settings
+        self.settings['number_of_shards'] = number_shards
+        self.number_shards = number_shards
+        self.pending = [[] for _ in range(number_shards)]
+        self.searchable = [_Shard(name, i, [], self.mappings) for i in range(number_shards)]
+        self.next_id = 0
+        self.max_seq_nos = [-1] * number_shards
+        self.refreshes = [0] * number_shards
+
+    def add(self, source: dict, doc_id: str = None):
+        if doc_id is None:
+            doc_id = str(self.next_id)
+            self.next_id += 1
+        shard = zlib.crc32(doc_id.encode()) % self.number_shards
+        self.pending[shard].append((doc_id, source))
+        self.max_seq_nos[shard] += 1
+        return doc_id
+
+    def refresh(self):
+        # Make the pending documents searchable. Returns true if anything changed.
+        changed = False
+        for i, pending in enumerate(self.pending):
+            if len(pending) > 0:
+                self.searchable[i] = _Shard(self.name, i, self.searchable[i].docs + pending, self.mappings)
+                self.pending[i] = []
+                self.refreshes[i] += 1
+                changed = True
+        return changed
+
+    def stats(self):
+        # The index statistics in the format of the _stats API with level shards.
+        shards = {}
+        for i, shard in enumerate(self.searchable):
+            shards[str(i)] = [{'routing': {'primary': True, 'node': 'simulated'},
+                               'docs': {'count': len(shard.docs), 'deleted': 0},
+                               'refresh': {'total': self.refreshes[i]},
+                               'seq_no': {'max_seq_no': self.max_seq_nos[i],
+                                          'local_checkpoint': self.max_seq_nos[i],
+                                          'global_checkpoint': self.max_seq_nos[i]}}]
+        totals = {'docs': {'count': sum(len(shard.docs) for shard in self.searchable), 'deleted': 0},
+                  'refresh': {'total': sum(self.refreshes)}}
+        return {'primaries': totals, 'total': totals, 'shards': shards}
+
+class _Shard:
+    # The searchable documents of a shard together with their doc values.
+
+    def __init__(self, index: str, number: int, docs: list, mappings: dict):
+        self.index = index
+        self.number = number
+        self.docs = docs
+        self.mappings = mappings
+        self.columns = {}
+
+    def column(self, field: str):
+        # Keyword fields are object arrays with None for missing values. Other fields
+        # are float arrays with NaN for missing values. Dates are epoch milliseconds.
+        if field not in self.columns:
+            values = [source.get(field) for _, source in self.docs]
+            if self.mappings.get(field, {}).get('type', 'keyword') in ['keyword', 'text']:
+                column = np.array(values + [None], dtype=object)[:-1]
+            else:
+                column = np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+            self.columns[field] = column
+        return self.columns[field]
+
+    def doc_values(self, rows: np.ndarray):
+        return _DocValues(self, rows)
+
+class _DocValues:
+    # The doc values of a subset of a shard's documents, which are passed to the map
+    # step of a scripted metric.
+
+    def __init__(self, shard: _Shard, rows: np.ndarray):
+        self.shard = shard
+        self.rows = rows
+
+    def __getitem__(self, field: str):
+        return self.shard.column(field)[self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+_worker_shards = {}
+
+def _initialize_worker(shards: dict):
+    _worker_shards.update(shards)
+
+def _worker_search_shard(shard_id: tuple, request: dict):
+    return _search_shard(_worker_shards[shard_id], request)
+
+def _search_shard(shard: _Shard, request: dict):
+    # Run the query and the shard level aggregations on one shard.
+
+    start = time.perf_counter_ns()
+    rows, scores = _query(shard, request['query'])
+    if request.get('slice') is not None:
+        keep = _slice(rows, request['slice'])
+        rows, scores = rows[keep], scores[keep]
+    query_nanos = time.perf_counter_ns() - start
+    hits = []
+    size = len(rows) if request['size'] is None else request['size']
+    if size > 0 and len(request.get('sort', [])) > 0:
+        values = [_sort_values(shard, rows, scores, field, request.get('shard_index')) for field, _ in request['sort']]
+        keys = [_signed(value, order) for value, (_, order) in zip(values, request['sort'])]
+        candidates = np.arange(len(rows))
+        if request.get('search_after') is not None:
+            candidates = np.flatnonzero(_after(keys, _sort_keys(request['search_after'], request['sort'])))
+        order = candidates[np.lexsort([key[candidates] for key in reversed(keys)])[:size]]
+        for i in order.tolist():
+            hit = _hit(shard, rows[i], None, request)
+            hit['sort'] = [None if np.isnan(value[i]) else _plain(value[i]) for value in values]
+            hits.append(hit)
+    elif size > 0:
+        order = np.argsort(-scores, kind='stable')[:size]
+        for row, score in zip(rows[order].tolist(), scores[order].tolist()):
+            hits.append(_hit(shard, row, score, request))
+    profile = {} if request.get('profile') else None
+    result = {'total': len(rows), 'hits': hits, 'aggs': _shard_aggs(shard, rows, scores, request['aggs'], profile)}
+    if profile is not None:
+        result['profile'] = {
+            'id': '[simulated][' + shard.index + '][' + str(shard.number) + ']',
+            'searches': [{'query': [{'type': next(iter(request['query'])),
+                                     'description': json.dumps(request['query']),
+                                     'time_in_nanos': query_nanos,
+                                     'breakdown': {},
+                                     'children': []}],
+                          'rewrite_time': 0,
+                          'collector': []}],
+            'aggregations': _profile_list(profile)
+        }
+    return result
+
+def _check_script(script_type: str, source):
+    # The Python equivalents can't catch Painless compile errors, so check for the
+    # ones which are easy to make.
+    if source is None:
+        return
+    match = _NARROWING_MATH.search(source)
+    if match is not None:
+        raise SimulatorError(400, 'compile error in ' + script_type + ': cannot cast from [double] in [' +
+                             match.group(0) + '...], cast the result of Math.min or Math.max explicitly')
+
+def _hit(shard: _Shard, row: int, score, request: dict):
+    doc_id, source = shard.docs[row]
+    hit = {'_index': shard.index, '_id': doc_id, '_score': score, '_source': _filter_source(source, request['source'])}
+    if len(request.get('docvalue_fields', [])) > 0:
+        hit['fields'] = _docvalue_fields(shard, row, request['docvalue_fields'])
+    return hit
+
+def _docvalue_fields(shard: _Shard, row: int, specs: list):
+    # The doc values of the fields in the format of the docvalue_fields response.
+    # Dates are formatted as ISO 8601 or as the requested epoch_millis strings.
+    fields = {}
+    for spec in specs:
+        field, format = (spec, None) if isinstance(spec, str) else (spec['field'], spec.get('format'))
+        value = shard.column(field)[row]
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            continue
+        field_type = shard.mappings.get(field, {}).get('type', 'keyword')
+        if field_type == 'date' and format == 'epoch_millis':
+            value = str(int(value))
+        elif field_type == 'date':
+            value = datetime.fromtimestamp(int(value) / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        elif field_type in ['long', 'integer', 'short', 'byte']:
+            value = int(value)
+        fields[field] = [_plain(value)]
+    return fields
+
+def _sort_fields(sort):
+    # Normalize the sort of a search to a list of (field, order) pairs.
+    fields = []
+    for spec in [sort] if isinstance(sort, (str, dict)) else (sort or []):
+        if isinstance(spec, str):
+            field, order = spec, 'desc' if spec == '_score' else 'asc'
+        else:
+            (field, order), = spec.items()
+            order = order.get('order', 'asc') if isinstance(order, dict) else order
+        if order not in ['asc', 'desc']:
+            raise SimulatorError(400, 'Unsupported sort order ' + str(order))
+        fields.append((field, order))
+    return fields
+
+def _sort_values(shard: _Shard, rows: np.ndarray, scores: np.ndarray, field: str, shard_index: int):
+    # The _shard_doc of a point in time search combines the shard's position in the
+    # point in time with the document's position in the shard.
+    if field == '_shard_doc':
+        return (np.int64(shard_index) << 32) + rows.astype(np.int64)
+    if field == '_doc':
+        return rows.astype(np.int64)
+    if field == '_score':
+        return scores
+    if shard.mappings.get(field, {}).get('type', 'keyword') in ['keyword', 'text']:
+        raise SimulatorError(400, 'Sorting on keyword field ' + field + ' isn\'t supported')
+    column = shard.column(field)[rows]
+    if shard.mappings.get(field, {}).get('type') in ['date', 'long', 'integer', 'short', 'byte']:
+        # Keep whole numbers exact, and their sort values integers, unless any are missing.
+        return column.astype(np.int64) if not np.isnan(column).any() else column
+    return column
+
+def _signed(values: np.ndarray, order: str):
+    # Sort keys in ascending order with missing values last.
+    keys = values.astype(np.float64) if order == 'asc' else -values.astype(np.float64)
+    return np.where(np.isnan(keys), np.inf, keys)
+
+def _sort_keys(values: list, sort: list):
+    return tuple(np.inf if value is None else (float(value) if order == 'asc' else -float(value))
+                 for value, (_, order) in zip(values, sort))
+
+def _after(keys: list, after: tuple):
+    # Which sort keys are lexicographically greater than after.
+    greater = np.zeros(len(keys[0]), dtype=bool)
+    equal = np.ones(len(keys[0]), dtype=bool)
+    for key, value in zip(keys, after):
+        greater |= equal & (key > value)
+        equal &= key == value
+    return greater
+
+def _slice(rows: np.ndarray, spec: dict):
+    # Slices partition each shard's documents by their position in the shard.
+    if spec['max'] < 2 or not 0 <= spec['id'] < spec['max']:
+        raise SimulatorError(400, 'Invalid slice ' + str(spec))
+    return rows % spec['max'] == spec['id']
+
+def _filter_source(source: dict, fields):
+    if fields is True:
+        return source
+    if fields is False:
+        return {}
+    fields = [fields] if isinstance(fields, str) else fields
+    return {key: value for key, value in source.items() if key in fields}
+
+def _query(shard: _Shard, query: dict):
+    # Return the rows which match and their scores.
+
+    mask, scores = _match(shard, query)
+    rows = np.flatnonzero(mask)
+    return rows, scores[rows]
+
+def _match(shard: _Shard, query: dict):
+    number_docs = len(shard.docs)
+    (query_type, clause), = query.items() if len(query) > 0 else [('match_all', {})]
+    ones = np.ones(number_docs)
+
+    if query_type == 'match_all':
+        return np.ones(number_docs, dtype=bool), ones
+
+    if query_type == 'term':
+        (field, value), = clause.items()
+        value = value['value'] if isinstance(value, dict) else value
+        return _equals(shard.column(field), [value]), ones
+
+    if query_type == 'terms':
+        (field, values), = clause.items()
+        return _equals(shard.column(field), values), ones
+
+    if query_type == 'range':
+        (field, bounds), = clause.items()
+        column = shard.column(field)
+        mask = ~np.isnan(column)
+        for bound, compare in [('gte', np.greater_equal), ('gt', np.greater),
+                               ('lte', np.less_equal), ('lt', np.less)]:
+            if bound in bounds:
+                mask &= compare(column, float(bounds[bound]))
+        return mask, ones
+
+    if query_type == 'bool':
+        mask = np.ones(number_docs, dtype=bool)
+        scores = np.zeros(number_docs)
+        for occur in ['must', 'filter']:
+            for clause_query in _as_list(clause.get(occur, [])):
+                clause_mask, clause_scores = _match(shard, clause_query)
+                mask &= clause_mask
+                if occur == 'must':
+                    scores += clause_scores
+        should = _as_list(clause.get('should', []))
+        if len(should) > 0:
+            should_mask = np.zeros(number_docs, dtype=bool)
+            for clause_query in should:
+                clause_mask, clause_scores = _match(shard, clause_query)
+                should_mask |= clause_mask
+                scores += np.where(clause_mask, clause_scores, 0)
+            if 'must' not in clause and 'filter' not in clause:
+                mask &= should_mask
+        for clause_query in _as_list(clause.get('must_not', [])):
+            mask &= ~_match(shard, clause_query)[0]
+        return mask, np.where(scores > 0, scores, 1.0)
+
+    if query_type == 'function_score':
+        mask, scores = _match(shard, clause.get('query', {'match_all': {}}))
+        if 'random_score' in clause:
+            seed = clause['random_score'].get('seed')
+            rng = np.random.default_rng(None if seed is None else [int(seed), shard.number])
+            scores = rng.random(number_docs)
+        return mask, scores
+
+    raise SimulatorError(400, 'Unsupported query ' + query_type)
+
+def _equals(column: np.ndarray, values: list):
+    if column.dtype == object:
+        return np.isin(column, np.array(values, dtype=object))
+    return np.isin(column, np.array(values, dtype=np.float64))
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+def _shard_aggs(shard: _Shard, rows: np.ndarray, scores: np.ndarray, aggs: dict, profile: dict = None):
+    # Compute the partial result of each aggregation on one shard. If profile is
+    # not None the time spent in each aggregation is added to it.
+
+    partials = {}
+    for name, agg in aggs.items():
+        sub_aggs = agg.get('aggs', {})
+        agg_type = next(key for key in agg if key not in ['aggs', 'meta'])
+        spec = agg[agg_type]
+        start = time.perf_counter_ns()
+        node = _profile_node(profile, name, agg_type)
+        children = None if node is None else node['children']
+
+        if agg_type == 'sampler':
+            order = np.argsort(-scores, kind='stable')[:spec.get('shard_size', 100)]
+            sample = np.sort(order)
+            partials[name] = {'doc_count': len(sample),
+                              'aggs': _shard_aggs(shard, rows[sample], scores[sample], sub_aggs, children)}
+
+        elif agg_type == 'random_sampler':
+            probability = spec['probability']
+            if probability == 1:
+                sample = np.arange(len(rows))
+            else:
+                seed = spec.get('seed')
+                rng = np.random.default_rng(None if seed is None else [int(seed), shard.number])
+                sample = np.flatnonzero(rng.random(len(shard.docs))[rows] < probability)
+            partials[name] = {'doc_count': len(sample),
+                              'aggs': _shard_aggs(shard, rows[sample], scores[sample], sub_aggs, children)}
+
+        elif agg_type == 'terms':
+            column = shard.column(spec['field'])[rows]
+            present = np.flatnonzero(_present(column))
+            keys, members = _groups(column[present])
+            # Each shard returns its top shard_size terms, like Elasticsearch.
+            size = spec.get('size', 10)
+            shard_size = spec.get('shard_size', int(size * 1.5 + 10))
+            order = sorted(range(len(keys)), key=lambda i: (-len(members[i]), keys[i]))[:shard_size]
+            buckets = {}
+            for i in order:
+                selected = present[members[i]]
+                buckets[_key(keys[i])] = (len(selected),
+                                          _shard_aggs(shard, rows[selected], scores[selected], sub_aggs, children))
+            partials[name] = {'buckets': buckets,
+                              'other': len(present) - sum(len(members[i]) for i in order)}
+
+        elif agg_type == 'composite':
+            names = []
+            columns = []
+            for source in spec['sources']:
+                (source_name, value_source), = source.items()
+                (source_type, source_spec), = value_source.items()
+                column = shard.column(source_spec['field'])[rows]
+                if source_type == 'date_histogram':
+                    column = _histogram_keys(column, source_spec)
+                elif source_type != 'terms':
+                    raise SimulatorError(400, 'Unsupported composite source ' + source_type)
+                names.append(source_name)
+                columns.append(column)
+            keep = np.ones(len(rows), dtype=bool)
+            for column in columns:
+                keep &= _present(column)
+            keep = np.flatnonzero(keep)
+            # Encode the composite key of each document as a mixed radix code of the
+            # ordinals of its values, which sorts in the same order as the keys.
+            codes = np.zeros(len(keep), dtype=np.int64)
+            values = []
+            for column in columns:
+                unique, ordinals = np.unique(column[keep], return_inverse=True)
+                codes = codes * len(unique) + ordinals.reshape(-1)
+                values.append(unique)
+            unique_codes, members = _groups(codes)
+            keys = []
+            for code in unique_codes.tolist():
+                key = []
+                for unique in reversed(values):
+                    code, ordinal = divmod(code, len(unique))
+                    key.append(_key(unique[ordinal]))
+                keys.append(tuple(reversed(key)))
+            after = spec.get('after')
+            first = 0 if after is None else bisect.bisect_right(keys, tuple(after[source_name] for source_name in names))
+            buckets = []
+            for i in range(first, min(first + spec.get('size', 10), len(keys))):
+                selected = keep[members[i]]
+                buckets.append((keys[i], len(selected), _shard_aggs(shard, rows[selected], scores[selected], sub_aggs, children)))
+            partials[name] = {'names': names, 'buckets': buckets}
+
+        elif agg_type == 'date_histogram':
+            column = _histogram_keys(shard.column(spec['field'])[rows], spec)
+            present = np.flatnonzero(_present(column))
+            keys, members = _groups(column[present])
+            buckets = {}
+            for key, key_members in zip(keys.tolist(), members):
+                selected = present[key_members]
+                buckets[int(key)] = (len(selected), _shard_aggs(shard, rows[selected], scores[selected], sub_aggs, children))
+            partials[name] = {'buckets': buckets, 'interval': _interval(spec),
+                              'min_doc_count': spec.get('min_doc_count', 0)}
+
+        elif agg_type == 'scripted_metric':
+            implementation = spec['implementation']()
+            params = spec['params']
+            state = implementation.init(params)
+            initialized = time.perf_counter_ns()
+            state = implementation.map(state, params, shard.doc_values(rows))
+            mapped = time.perf_counter_ns()
+            partials[name] = implementation.combine(state, params)
+            if node is not None:
+                node['breakdown']['initialize'] += initialized - start
+                node['breakdown']['collect'] += mapped - initialized
+                node['breakdown']['build_aggregation'] += time.perf_counter_ns() - mapped
+
+        else:
+            raise SimulatorError(400, 'Unsupported aggregation ' + agg_type)
+
+        if node is not None:
+            elapsed = time.perf_counter_ns() - start
+            node['time_in_nanos'] += elapsed
+            if agg_type != 'scripted_metric':
+                node['breakdown']['collect'] += elapsed
+
+    return partials
+
+def _profile_node(profile: dict, name: str, agg_type: str):
+    # Get the profile of the named aggregation, which accumulates over buckets of
+    # its parent like a single Elasticsearch aggregator.
+
+    if profile is None:
+        return None
+    if name not in profile:
+        profile[name] = {'type': _AGGREGATORS.get(agg_type, agg_type),
+                         'description': name,
+                         'time_in_nanos': 0,
+                         'breakdown': {'initialize': 0, 'collect': 0, 'build_aggregation': 0},
+                         'children': {}}
+    return profile[name]
+
+def _profile_list(profile: dict):
+    return [dict(node, children=_profile_list(node['children'])) for node in profile.values()]
+
+
+def _reduce_aggs(aggs: dict, partials: list):
+    # Merge the partial results of each aggregation from every shard.
+
+    results = {}
+    for name, agg in aggs.items():
+        sub_aggs = agg.get('aggs', {})
+        agg_type = next(key for key in agg if key not in ['aggs', 'meta'])
+        spec = agg[agg_type]
+        shard_partials = [partial[name] for partial in partials if name in partial]
+
+        if agg_type == 'sampler':
+            result = {'doc_count': sum(partial['doc_count'] for partial in shard_partials)}
+            result.update(_reduce_aggs(sub_aggs, [partial['aggs'] for partial in shard_partials]))
+
+        elif agg_type == 'random_sampler':
+            result = {'doc_count': sum(partial['doc_count'] for partial in shard_partials),
+                      'probability': spec['probability']}
+            if 'seed' in spec:
+                result['seed'] = spec['seed']
+            result.update(_reduce_aggs(sub_aggs, [partial['aggs'] for partial in shard_partials]))
+
+        elif agg_type == 'terms':
+            counts = {}
+            for partial in shard_partials:
+                for key, (count, _) in partial['buckets'].items():
+                    counts[key] = counts.get(key, 0) + count
+            keys = sorted(counts, key=lambda key: (-counts[key], key))[:spec.get('size', 10)]
+            buckets = []
+            for key in keys:
+                bucket = {'key': key, 'doc_count': counts[key]}
+                bucket.update(_reduce_aggs(sub_aggs, [partial['buckets'][key][1]
+                                                      for partial in shard_partials if key in partial['buckets']]))
+                buckets.append(bucket)
+            total = sum(sum(count for count, _ in partial['buckets'].values()) + partial['other']
+                        for partial in shard_partials)
+            result = {'doc_count_error_upper_bound': 0,
+                      'sum_other_doc_count': total - sum(counts[key] for key in keys),
+                      'buckets': buckets}
+
+        elif agg_type == 'composite':
+            merged = {}
+            for partial in shard_partials:
+                names = partial['names']
+                for key, count, sub_partials in partial['buckets']:
+                    entry = merged.setdefault(key, [0, []])
+                    entry[0] += count
+                    entry[1].append(sub_partials)
+            buckets = []
+            for key in sorted(merged)[:spec.get('size', 10)]:
+                bucket = {'key': dict(zip(names, key)), 'doc_count': merged[key][0]}
+                bucket.update(_reduce_aggs(sub_aggs, merged[key][1]))
+                buckets.append(bucket)
+            result = {'buckets': buckets}
+            if len(buckets) > 0:
+                result['after_key'] = buckets[-1]['key']
+
+        elif agg_type == 'date_histogram':
+            merged = {}
+            for partial in shard_partials:
+                for key, (count, sub_partials) in partial['buckets'].items():
+                    entry = merged.setdefault(key, [0, []])
+                    entry[0] += count
+                    entry[1].append(sub_partials)
+            keys = sorted(merged)
+            if len(keys) > 0 and spec.get('min_doc_count', 0) == 0:
+                keys = list(range(keys[0], keys[-1] + 1, _interval(spec)))
+            buckets = []
+            for key in keys:
+                count, sub_partials = merged.get(key, (0, []))
+                bucket = {'key': key, 'doc_count': count}
+                bucket.update(_reduce_aggs(sub_aggs, sub_partials))
+                buckets.append(bucket)
+            result = {'buckets': buckets}
+
+        elif agg_type == 'scripted_metric':
+            # Values are converted to the types they'd have after a JSON round trip.
+            if spec['return_states']:
+                result = {'value': _plain(shard_partials)}
+            else:
+                result = {'value': _plain(spec['implementation']().reduce(shard_partials, spec['params']))}
+
+        results[name] = result
+
+    return results
+
+def _groups(values: np.ndarray):
+    # Return the sorted unique values and the positions of each.
+    keys, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse.reshape(-1), kind='stable')
+    return keys, np.split(order, np.cumsum(counts)[:-1])
+
+def _present(column: np.ndarray):
+    if column.dtype == object:
+        return np.array([value is not None for value in column.tolist()], dtype=bool)
+    return ~np.isnan(column)
+
+def _key(value):
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return int(value)
+    return value.item() if isinstance(value, np.generic) else value
+
+def _interval(spec: dict):
+    interval = spec.get('fixed_interval', spec.get('calendar_interval', spec.get('interval')))
+    if interval is None:
+        raise SimulatorError(400, 'date_histogram requires an interval')
+    interval = str(interval)
+    if interval[-2:] == 'ms':
+        return int(interval[:-2])
+    number = interval[:-1] if len(interval) > 1 else '1'
+    if interval[-1] not in _UNITS:
+        raise SimulatorError(400, 'Unsupported interval ' + interval)
+    return int(number) * _UNITS[interval[-1]]
+
+def _histogram_keys(column: np.ndarray, spec: dict):
+    interval = _interval(spec)
+    return np.floor(column / interval) * interval
+
+def _plain(value):
+    if isinstance(value, dict):
+        return {str(key): _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _millis(start: float):
+    return int(1000 * (time.perf_counter() - start))
@@ -0,0 +1,167 @@
+import json
+import numpy as np
+import os
+
+# The column types. Dates are stored as int64 epoch milliseconds and keywords as
+# int32 ordinals into a dictionary of the values, with -1 for missing values.
+DATE = 'date'
+KEYWORD = 'keyword'
+
+_DTYPES = {DATE: np.int64, KEYWORD: np.int32}
+
+class SnapshotWriter:
+    '''
+    Write the documents of a data set to a directory as one column per field.
+
+    Documents are appended in batches as they are generated and each column is
+    streamed to disk, so the whole data set is never held in memory. When the writer
+    is closed each column is saved as a .npy file, which read memory maps, and the
+    field types and keyword dictionaries are saved in meta.json.
+    '''
+    def __init__(self,
+                 directory: str,
+                 fields: dict,
+                 chunk_size: int = 100000):
+        '''
+        @param fields A dictionary from field name to DATE or KEYWORD.
+        @param chunk_size The number of documents to buffer by tee.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fields = dict(fields)
+        self.chunk_size = chunk_size
+        self.number_docs = 0
+        self.dictionaries = {field: {} for field, type in self.fields.items() if type == KEYWORD}
+        self.__files = {field: open(self.__path(field) + '.tmp', 'wb') for field in self.fields}
+
+    def append(self, columns: dict):
+        '''
+        Append a batch of documents.
+
+        @param columns A dictionary from field name to an equal length sequence of
+        values. Missing keyword values are None. Fields which aren't present are
+        missing in every document of the batch.
+        '''
+        number = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+        for field, type in self.fields.items():
+            if field not in columns:
+                values = np.full(number, -1, dtype=_DTYPES[type])
+            elif type == KEYWORD:
+                values = self.__encode(field, columns[field])
+            else:
+                values = np.asarray(columns[field]).astype(_DTYPES[type])
+            if len(values) != number:
+                raise ValueError('Column ' + field + ' has ' + str(len(values)) + ' values, expected ' + str(number))
+            values.tofile(self.__files[field])
+        self.number_docs += number
+
+    def tee(self, docs):
+        '''
+        Append the documents of a stream of document dictionaries as they pass
+        through it.
+        '''
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) == self.chunk_size:
+                self.append(self.__columns(batch))
+                batch = []
+            yield doc
+        if len(batch) > 0:
+            self.append(self.__columns(batch))
+
+    def close(self):
+        '''
+        Save the columns as .npy files and write meta.json.
+        '''
+        for field, file in self.__files.items():
+            file.close()
+            dtype = _DTYPES[self.fields[field]]
+            if self.number_docs == 0:
+                np.save(self.__path(field), np.empty(0, dtype=dtype))
+            else:
+                raw = np.memmap(self.__path(field) + '.tmp', dtype=dtype, mode='r')
+                column = np.lib.format.open_memmap(self.__path(field), mode='w+', dtype=dtype,
+                                                   shape=(self.number_docs,))
+                for start in range(0, self.number_docs, self.chunk_size):
+                    column[start:start + self.chunk_size] = raw[start:start + self.chunk_size]
+                column.flush()
+                del column, raw
+            os.remove(self.__path(field) + '.tmp')
+
+        meta = {
+            'number_docs': self.number_docs,
+            'fields': self.fields,
+            'dictionaries': {field: list(dictionary) for field, dictionary in self.dictionaries.items()}
+        }
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+
+    def __encode(self, field: str, values):
+        values = np.asarray(values, dtype=object)
+        ordinals = np.full(len(values), -1, dtype=np.int32)
+        present = np.flatnonzero(np.not_equal(values, None))
+        if len(present) > 0:
+            unique, inverse = np.unique(values[present].astype(str), return_inverse=True)
+            dictionary = self.dictionaries[field]
+            lookup = np.array([dictionary.setdefault(value, len(dictionary)) for value in unique.tolist()],
+                              dtype=np.int32)
+            ordinals[present] = lookup[inverse.reshape(-1)]
+        return ordinals
+
+    def __columns(self, docs: list):
+        return {field: [doc.get(field) for doc in docs] for field in self.fields}
+
+    def __path(self, field: str):
+        return os.path.join(self.directory, field + '.npy')
+
+class Snapshot:
+    '''
+    A data set written by SnapshotWriter.
+    '''
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as file:
+            meta = json.load(file)
+        self.number_docs = meta['number_docs']
+        self.fields = meta['fields']
+        self.dictionaries = meta['dictionaries']
+
+    def column(self, field: str):
+        '''
+        The values of a field as a read only memory mapped array, so loading it
+        doesn't copy or read the whole file. Keyword fields are ordinals into
+        dictionary(field).
+        '''
+        return np.load(os.path.join(self.directory, field + '.npy'), mmap_mode='r')
+
+    def dictionary(self, field: str):
+        return self.dictionaries[field]
+
+    def batches(self, batch_size: int = 100000):
+        '''
+        Serialize the documents as JSON in batches, for BulkIndexer.index_serialized.
+        Missing keyword values are omitted.
+        '''
+        columns = {field: self.column(field) for field in self.fields}
+        dictionaries = {field: np.array([json.dumps(value) for value in dictionary] + [''], dtype=object)
+                        for field, dictionary in self.dictionaries.items()}
+        for start in range(0, self.number_docs, batch_size):
+            end = min(start + batch_size, self.number_docs)
+            docs = np.full(end - start, '', dtype=object)
+            for field, type in self.fields.items():
+                values = np.asarray(columns[field][start:end])
+                if type == KEYWORD:
+                    # Ordinal -1 indexes the empty string at the end of the dictionary.
+                    encoded = dictionaries[field][values]
+                    prefix = np.where(values >= 0, ',"' + field + '":', '')
+                    docs = docs + prefix.astype(object) + encoded
+                else:
+                    docs = docs + (',"' + field + '":') + values.astype(str).astype(object)
+            yield ['{' + doc[1:] + '}' for doc in docs.tolist()]
+
+def read(directory: str):
+    '''
+    Read the snapshot written to directory.
+    '''
+    return Snapshot(directory)